@@ -16,6 +16,7 @@ import struct
 import sys
 import time
 import threading
+import multiprocessing
 import Queue
 
 # todo : replace by one empty shell of ours
@@ -47,105 +48,83 @@ def alignEncryption(way, data):
   # the index of the alignement
   '''
   log.info('trying to align on data ')
-  blocksize = way.engine.block_size
-  # try to find a packetlen
-  read_offset = 1 # len(data) # check only start of packet
-  #for i in range(0, len(data)-blocksize, len(data) ): # check only start of packet
-  for i in range(0, len(data)-blocksize, read_offset ): # check all offsets
-    # tests shows Message are often data[blocksize:] 
-    log.debug('trying index %d'%(i))
-    header = way.engine.decrypt( data[i:i+blocksize] )
-    #log.debug('after align  decrypt %s'%repr(way.engine.getCounter()))
-    packet_size = struct.unpack('>I', header[:4])[0]
-    # reset engine to initial state
-    way.engine.sync(way.context)
-    if  0 < packet_size <= PACKET_MAX_SIZE:
-      log.debug('Auto align done: We found a acceptable packet size(%d) at %d '%(packet_size, i))
-      if (packet_size - (blocksize-4)) % blocksize == 0 :
-        log.debug('Auto align found : packet size(%d) at %d  '%(packet_size, i))
-        # save previous data
-        prev = data[:i]
-        next = data[i:]
-        return prev, next
-      else:
-        log.debug('bad blocking packetsize %d is not correct for blocksize'%((packet_size - (blocksize-4)) % blocksize))    
-    # goto next byte
+  for i in openssh.alignCandidates(way, data):
+    # the end of the file is as far as we can check
+    if openssh.validateAlignment(way, data, i) is False:
+      continue
+    log.debug('Auto align found : packet at %d  '%(i))
+    # save previous data
+    prev = data[:i]
+    next = data[i:]
+    return prev, next
   return None
 
 
-def rfindAlign(way, data):
-  ''' find alignement backwards
-    we need to backtrack from  prev_i = (index-blocksize)-- # smallest packet is at least mac_len+int_size+padding
-    with counter = counter-2 ( // block_size) // counter-1 is useless when > 16
-        smallest case scenarios packet_size = 28, 12 for disconnects ? 
-        And this is only to find a valid packet_size
-    and find a value x for which  x+prev_i < index # packet_size is not in clear stoupid..
+# packet sizes, in blocks, tried locally before using the process pool
+SCAN_LOCAL = 64
+# packet sizes, in blocks, per task of the pool
+SCAN_CHUNK = 1024
+
+def _scanTasks(data, key, counter, end, mac_len, blocksize, kStart, kStop):
+  ''' splits a ctrScanBack in tasks carrying only their slice of data '''
+  for k in xrange(kStart, kStop, SCAN_CHUNK):
+    kEnd = min(k+SCAN_CHUNK, kStop)
+    base = max(0, end - mac_len - (kEnd-1)*blocksize)
+    yield (data[base:end], key, counter, end-base, mac_len, blocksize, k, kEnd)
+
+def rfindAlign(way, data, processes=None):
+  ''' find alignement backwards, from the end of data where the engine counter is.
+    The packet before a boundary at index, with its mac, is k blocks long. 
+    It starts at index-mac_len-k*blocksize, with the counter counter-k, and 
+    decrypts to a packet_size of k*blocksize-4. 
+    So we can try every k, from the smallest packet, and chain the boundaries 
+    back to the start of data.
+    Big values of k are tried in chunks by a pool of processes.
+
+    returns the earliest boundary of the chain and an engine snapshot for it, 
+    or -1, None.
   '''
-  logging.getLogger('align').setLevel(logging.DEBUG)
-  #logging.getLogger('engine').setLevel(logging.DEBUG)
-
   log.debug('trying to backwards align on data ')
-  blocksize = way.engine.block_size
-  # try to find a packetlen
-  read_offset = 1 # len(data) # check only start of packet
-
-  # reset engine to initial state
-  way.engine.sync(way.context)
-  # save current counter
-  lastGoodCounter = way.engine.counter
-  lastGoodIndex = len(data)
-
-  log.debug('orig counter:')
-  log.debug(repr(way.engine.getCounter()))
-  log.debug('backwards counters:')
-  
-  #for i in range(0, len(data)-blocksize, len(data) ): # check only start of packet
-  #for i in range(len(data)-blocksize, -1 , -1 ): # check all offsets
-  two = True
-  i = len(data)
-  while i>0:
-
-    ## STEP 1 : prepare counter backwards 2 (packet_size+) 
-    ## # possible corner case, if no packet payload, only one decCounter should be needed ( disconnections ?? )
-    ## # test1 : if index-prev_i < mac_len + 4 + 12(padding), test with simple decCounter
-    ## # lets ignore that for now
-
-    # reset engine ctr to previous iteration and decrease counter 2 times
-    way.engine.counter = (ctypes.c_ubyte*blocksize).from_buffer_copy( lastGoodCounter )
-    way.engine.decCounter()
-    way.engine.decCounter()
-    log.debug('after decCounter %s'%repr(way.engine.getCounter()))
-    counter = (ctypes.c_ubyte*blocksize).from_buffer_copy( way.engine.counter )
-
-    ## STEP 2 : test all offset for a valid packet_size
-    for i in range(lastGoodIndex-blocksize, -1 , -1 ): # check all offsets ( -blocksize+4 ?)
-      header = way.engine.decrypt( data[i:i+blocksize] ) # read from end to start
-      #log.debug('after    decrypt %s'%repr(way.engine.getCounter()))
-      packet_size = struct.unpack('>I', header[:4])[0]
-      #log.debug('packet_size %d'%( packet_size ))
-      if  0 <= packet_size <= PACKET_MAX_SIZE:
-        log.debug('Auto align done: We found a acceptable packet size(%d) at %d '%(packet_size, i))
-        if (packet_size - (blocksize-4)) % blocksize == 0 :
-          log.debug('Auto align found : packet size(%d) at %d  '%(packet_size, i))
-          # save previous data
-          lastGoodIndex = i
-          lastGoodCounter = (ctypes.c_ubyte*blocksize).from_buffer_copy(counter)     # save current counter for next iteration
-          break # go to search the previous packet
-        else:
-          log.debug('bad blocking packetsize %d is not correct for blocksize'%((packet_size - (blocksize-4)) % blocksize))    
-      # clean and reset
-      way.engine.counter = (ctypes.c_ubyte*blocksize).from_buffer_copy( counter )
-
-      #if lastGoodIndex-i > 20000:
-      #  raise IndexError('did not find a valid offset')
-
-  if lastGoodIndex == len(data):
+  engine = way.engine
+  blocksize = engine.block_size
+  mac_len = way.context.mac.mac_len
+  key = ctypes.string_at(ctypes.addressof(engine.key), ctypes.sizeof(engine.key))
+  initial = engine.snapshot()
+  counter = int(engine.getCounter().encode('hex'), 16)
+  kMax = (PACKET_MAX_SIZE+4) // blocksize
+  index = len(data)
+  nb = 0
+  pool = None
+  try:
+    while True:
+      kStop = min(kMax, (index-mac_len) // blocksize) + 1
+      k = openssh.ctrScanBack(data, key, counter, index, mac_len, blocksize, 1, min(SCAN_LOCAL, kStop))
+      if k is None and kStop > SCAN_LOCAL:
+        if pool is None:
+          pool = multiprocessing.Pool(processes)
+        for k in pool.imap(openssh._ctrScanBack, _scanTasks(data, key, counter, index, mac_len, blocksize, SCAN_LOCAL, kStop)):
+          if k is not None:
+            break
+      if k is None:
+        break
+      index -= mac_len + k*blocksize
+      counter -= k
+      nb += 1
+      log.debug('packet of %d blocks at %d'%(k, index))
+  finally:
+    if pool is not None:
+      pool.terminate()
+  if nb == 0:
     return -1, None
-
-  return lastGoodIndex, lastGoodCounter
+  log.debug('found a chain of %d packets back to index %d'%(nb, index))
+  engine.setCounter(('%0*x'%(2*blocksize, counter % (1 << (8*blocksize)))).decode('hex'))
+  found = engine.snapshot()
+  engine.restore(initial)
+  return index, found
 
 
 
+import stream
 from network import Sniffer
 from stream  import TCPStream
 class PcapFileSniffer2(Sniffer):
@@ -158,8 +137,8 @@ class PcapFileSniffer2(Sniffer):
     from scapy.all import sniff
     sniff(store=0, prn=self.enqueue, offline=self.pcapfile)
     return
-  def addStream(self, connection):
-    ''' forget that stream '''
+  def addStream(self, connection, backend=stream.BACKEND_SOCKET):
+    ''' register that stream '''
     shost,sport = connection.local_address
     dhost,dport = connection.remote_address
     if shost.startswith('127.') or shost.startswith('::1'):
@@ -169,10 +148,8 @@ class PcapFileSniffer2(Sniffer):
       log.warning('=============================================================')
     #q = multiprocessing.Queue(QUEUE_SIZE)
     q = Queue.Queue(50000)
-    st = TCPStream2(q, connection)
-    #save in both directions
-    self.streams[(shost,sport,dhost,dport)] = (st,q)
-    self.streams[(dhost,dport,shost,sport)] = (st,q)
+    st = TCPStream2(q, connection, backend, self.timers)
+    self.flows.add(connection, st, q)
     return st
 
 class TCPStream2(TCPStream):
@@ -181,8 +158,8 @@ class TCPStream2(TCPStream):
     retry=1
     while self.check():
       try:
-        for p in self.inQueue.get(block=True, timeout=1):
-          self.triage(p)
+        for p, inbound in self.inQueue.get(block=True, timeout=1):
+          self.triage(p, inbound)
           self.inQueue.task_done()
       except Queue.Empty,e:
         if retry > 2:
@@ -190,6 +167,7 @@ class TCPStream2(TCPStream):
         retry+=1
         log.debug('Empty queue')
         pass
+      self.checkExpired()
     self.finish()
     pass
 
@@ -256,7 +234,7 @@ class SimpleBufferSocket():
     self.offset = 0
     self.closed = False
 
-  def recv(self, n = BUFSIZE):
+  def recv(self, n = BUFSIZE, flags = 0):
     if self.closed:
       raise IOError()
     ret = self.buf[self.offset:self.offset+n]
@@ -390,10 +368,7 @@ def dec(way, basename):
     log.info('Backwards decryption managed up to %d bytes offset:%d'%(len(prev)-prev_index, prev_index))
 
     ## STEP 4 : decrypt backwards data
-    fakecontext = Dummy()
-    fakecontext.__dict__ = dict(way.context.__dict__)
-    way.engine.sync(fakecontext)
-    way.engine.counter = prev_counter
+    way.engine.restore(prev_counter)
     fout = file('%s.raw'%prevfilename,'w')
     prev_data = decrypt( way.engine, prev[prev_index:] , way.context.block_size, way.context.mac.mac_len )
     fout.write(prev_data)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Loic Jaquemet loic.jaquemet+python@gmail.com
+#
+
+__author__ = "Loic Jaquemet loic.jaquemet+python@gmail.com"
+
+'''
+Decodes Ethernet/SLL/IPv4/IPv6/TCP headers straight from captured bytes,
+without scapy. Frames can be str, mmap or memoryview. Headers are read in
+place with struct.unpack_from, only the TCP payload is copied, into a
+stream.Segment.
+'''
+
+import logging
+import socket
+import struct
+
+from stream import Segment
+
+log=logging.getLogger('decode')
+
+# pcap link types
+DLT_NULL = 0
+DLT_EN10MB = 1
+DLT_RAW = 12
+DLT_RAW_OPENBSD = 14
+DLT_LOOP = 108
+LINKTYPE_RAW = 101
+DLT_LINUX_SLL = 113
+DLT_LINUX_SLL2 = 276
+LINK_TYPES = (DLT_NULL, DLT_EN10MB, DLT_RAW, DLT_RAW_OPENBSD, DLT_LOOP, LINKTYPE_RAW,
+              DLT_LINUX_SLL, DLT_LINUX_SLL2)
+
+ETH_P_IP = 0x0800
+ETH_P_IPV6 = 0x86DD
+ETH_P_8021Q = 0x8100
+ETH_P_8021AD = 0x88A8
+
+IPPROTO_TCP = 6
+# IPv6 extension headers we can walk over
+_IPV6_EXTENSIONS = (0, 43, 60)
+_IPV6_FRAGMENT = 44
+# DLT_NULL address families for IPv6 on BSDs, linux, darwin
+_AF_INET6 = (10, 24, 28, 30)
+
+# pcap files
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+
+_H = struct.Struct('!H')
+_IPV4 = struct.Struct('!BxHxxHxBxx4s4s') # vhl, len, frag, proto, src, dst
+_IPV6 = struct.Struct('!4xHBx16s16s') # payload len, next header, src, dst
+_TCP = struct.Struct('!HHI4xBB') # sport, dport, seq, data offset, flags
+
+
+def _copy(data, start, end):
+  d = data[start:end]
+  if not isinstance(d, str):
+    d = d.tobytes()
+  return d
+
+def parseTCP(data, offset, end, src, dst):
+  ''' returns a Segment for the TCP header at data[offset:] '''
+  if end - offset < _TCP.size:
+    return None
+  sport, dport, seq, doff, flags = _TCP.unpack_from(data, offset)
+  start = offset + ((doff >> 4) * 4)
+  if start > end:
+    return None
+  return Segment(src, sport, dst, dport, seq, flags, _copy(data, start, end))
+
+def parseIPv4(data, offset, captured):
+  if captured - offset < 20:
+    return None
+  vhl, length, frag, proto, src, dst = _IPV4.unpack_from(data, offset)
+  if proto != IPPROTO_TCP:
+    return None
+  if frag & 0x3fff: # MF or fragment offset. no IP reassembly.
+    return None
+  # length is 0 on TSO-ed packets. Trust the capture.
+  end = captured if length == 0 else min(offset + length, captured)
+  return parseTCP(data, offset + (vhl & 0x0f) * 4, end, socket.inet_ntoa(src), socket.inet_ntoa(dst))
+
+def parseIPv6(data, offset, captured):
+  if captured - offset < 40:
+    return None
+  length, nxt, src, dst = _IPV6.unpack_from(data, offset)
+  end = captured if length == 0 else min(offset + 40 + length, captured)
+  offset += 40
+  while nxt in _IPV6_EXTENSIONS:
+    if end - offset < 8:
+      return None
+    nxt = ord(data[offset])
+    offset += (ord(data[offset+1]) + 1) * 8
+  if nxt != IPPROTO_TCP: # or _IPV6_FRAGMENT. no IP reassembly.
+    return None
+  return parseTCP(data, offset, end, socket.inet_ntop(socket.AF_INET6, src), socket.inet_ntop(socket.AF_INET6, dst))
+
+def parseNetwork(data, offset, ethertype, captured=None):
+  ''' returns a Segment for the network header at data[offset:], or None if
+  that is not a TCP segment.'''
+  if captured is None:
+    captured = len(data)
+  if ethertype == ETH_P_IP:
+    return parseIPv4(data, offset, captured)
+  elif ethertype == ETH_P_IPV6:
+    return parseIPv6(data, offset, captured)
+  return None
+
+def _ipVersion(data, offset):
+  v = ord(data[offset]) >> 4
+  if v == 4:
+    return ETH_P_IP
+  elif v == 6:
+    return ETH_P_IPV6
+  return None
+
+def checkLinkType(linktype):
+  ''' @raise ValueError: if parseFrame() can not decode that pcap link type '''
+  if linktype not in LINK_TYPES:
+    raise ValueError('Unsupported link type %d'%(linktype))
+  return linktype
+
+def parseFrame(data, linktype):
+  ''' returns a Segment for a captured frame of this pcap link type, or None
+  if that is not a TCP segment. The link type is checked once, with 
+  checkLinkType(), when the capture is opened.'''
+  captured = len(data)
+  try:
+    if linktype == DLT_EN10MB:
+      offset = 14
+      ethertype = _H.unpack_from(data, 12)[0]
+      while ethertype in (ETH_P_8021Q, ETH_P_8021AD):
+        ethertype = _H.unpack_from(data, offset+2)[0]
+        offset += 4
+    elif linktype == DLT_LINUX_SLL:
+      offset = 16
+      ethertype = _H.unpack_from(data, 14)[0]
+    elif linktype == DLT_LINUX_SLL2:
+      offset = 20
+      ethertype = _H.unpack_from(data, 0)[0]
+    elif linktype in (DLT_RAW, DLT_RAW_OPENBSD, LINKTYPE_RAW):
+      offset = 0
+      ethertype = _ipVersion(data, 0)
+    elif linktype in (DLT_NULL, DLT_LOOP):
+      offset = 4
+      family = struct.unpack_from('=I' if linktype == DLT_NULL else '!I', data, 0)[0]
+      if family > 0xffff: # other endianness
+        family = socket.ntohl(family)
+      ethertype = ETH_P_IP if family == 2 else (ETH_P_IPV6 if family in _AF_INET6 else None)
+    else:
+      return None
+    return parseNetwork(data, offset, ethertype, captured)
+  except (struct.error, IndexError), e:
+    # truncated headers
+    log.debug('bad frame: %s'%(e))
+    return None
+
+def readPcapFile(f):
+  ''' yields (timestamp, linktype, frame) from a classic pcap file.
+  @raise ValueError: if it is not a classic pcap file (pcapng ?), or of an
+    unsupported link type
+  '''
+  head = f.read(24)
+  if len(head) < 24:
+    raise ValueError('not a pcap file')
+  for endian in ('<', '>'):
+    magic = struct.unpack(endian+'I', head[:4])[0]
+    if magic in (PCAP_MAGIC, PCAP_MAGIC_NS):
+      break
+  else:
+    raise ValueError('not a pcap file')
+  divisor = 1e6 if magic == PCAP_MAGIC else 1e9
+  linktype = checkLinkType(struct.unpack(endian+'I', head[20:24])[0] & 0x0fffffff)
+  record = struct.Struct(endian+'IIII') # sec, usec, caplen, len
+  while True:
+    h = f.read(record.size)
+    if len(h) < record.size:
+      return
+    sec, frac, caplen, length = record.unpack(h)
+    frame = f.read(caplen)
+    if len(frame) < caplen:
+      return
+    yield sec + frac/divisor, linktype, frame
+
@@ -23,22 +23,94 @@ libopenssl=cdll.LoadLibrary(_libssl)
 
 
 
+# size of the reusable output buffer of an engine. It grows with the biggest request.
+OUTPUT_BUFFER_SIZE = 4096
+
+def _inputBuffer(data):
+  ''' returns something we can give to libcrypto as a const unsigned char *,
+  without copying data when possible.'''
+  if isinstance(data, str):
+    return data # ctypes gives the str internal buffer
+  elif isinstance(data, bytearray):
+    return (ctypes.c_char*len(data)).from_buffer(data)
+  elif isinstance(data, ctypes.Array):
+    return data
+  elif isinstance(data, memoryview):
+    return data.tobytes() # no old-style buffer interface on memoryview, one memcpy
+  return str(data)
+
+def _outputBuffer(out, offset, bLen):
+  ''' returns a ctypes view on bLen bytes of the writable buffer out, at offset. '''
+  if offset+bLen > len(out):
+    raise ValueError('output buffer too small: %d bytes at offset %d, %d available'%(bLen, offset, len(out)))
+  if isinstance(out, bytearray):
+    return (ctypes.c_char*bLen).from_buffer(out, offset)
+  elif isinstance(out, ctypes.Array):
+    return (ctypes.c_char*bLen).from_address(ctypes.addressof(out)+offset)
+  raise TypeError('output buffer must be a bytearray or a ctypes array, not %s'%(type(out)))
+
+
 class Engine:
   block_size = 16
+  _outbuf = None
+  # the ctypes attributes that change while decrypting. The key schedules don't.
+  _state = ()
   
   def decrypt(self,block):
-    ''' decrypts '''
+    ''' decrypts block (str, bytearray or memoryview) and returns a str.
+    The ciphertext is given as is to libcrypto, the plaintext goes through a
+    reusable output buffer.
+    '''
+    bLen=len(block)
+    dest=self._getOutputBuffer(bLen)
+    if self._decrypt(_inputBuffer(block), dest, bLen) is None:
+      return None
+    return ctypes.string_at(dest, bLen)
+
+  def decryptInto(self, block, out, offset=0):
+    ''' decrypts block (str, bytearray or memoryview) into the writable buffer out 
+    (bytearray or ctypes array), at offset. block and out can be the same bytearray.
+    
+    @return: the number of bytes written, or None on error.
+    '''
     bLen=len(block)
-    data=(ctypes.c_ubyte*bLen )() ## TODO string_at should work here
-    for i in range(0, bLen ):
-      #print i, block[i] 
-      data[i]=ord(block[i])
-    # no way....
-    return self._decrypt(data,bLen)
+    if self._decrypt(_inputBuffer(block), _outputBuffer(out, offset, bLen), bLen) is None:
+      return None
+    return bLen
   
-  def _decrypt(self,data,bLen):
+  def _getOutputBuffer(self, bLen):
+    if self._outbuf is None or len(self._outbuf) < bLen:
+      self._outbuf = ctypes.create_string_buffer(max(bLen, OUTPUT_BUFFER_SIZE))
+    return self._outbuf
+
+  def _decrypt(self, src, dest, bLen):
+    ''' decrypts bLen bytes from src to dest. returns None on error. '''
     raise NotImplementedError
 
+  def snapshot(self):
+    ''' returns the mutable state of the engine (iv, counter, RC4 state),
+    for restore(). Unlike sync(), nothing is re-derived from the context.
+    '''
+    return tuple(ctypes.string_at(ctypes.addressof(getattr(self, name)), ctypes.sizeof(getattr(self, name)))
+                 for name in self._state)
+
+  def restore(self, snapshot):
+    ''' puts back a snapshot() of this engine, or of one of its clones '''
+    for name, value in zip(self._state, snapshot):
+      ctypes.memmove(ctypes.addressof(getattr(self, name)), value, len(value))
+    return
+
+  def clone(self):
+    ''' returns an engine on the same key schedule, with a copy of the
+    mutable state. Clones can decrypt in other threads.
+    '''
+    other = copy.copy(self)
+    for name in self._state:
+      obj = getattr(self, name)
+      setattr(other, name, type(obj).from_buffer_copy(obj))
+    other._outbuf = None
+    return other
+
 
 def myhex(bstr):
   s=''
@@ -48,28 +120,26 @@ def myhex(bstr):
 
 
 class StatefulAES_CBC_Engine(Engine):
+  _state = ('iv',)
   def __init__(self, context  ):
     self.sync(context)
     self._AES_cbc=libopenssl.AES_cbc_encrypt
     log.debug('cipher:%s block_size: %d key_len: %d '%(context.name, context.block_size, context.key_len))
   
-  def _decrypt(self, src, bLen):
+  def _decrypt(self, src, dest, bLen):
     if bLen % AES_BLOCK_SIZE:
       log.error("Sugar, why do you give me a block the wrong size: %d not modulo of %d"%(bLen, AES_BLOCK_SIZE))
       return None
-    buf=(ctypes.c_ubyte*AES_BLOCK_SIZE)() # TODO string_at + from_address
-    dest=(ctypes.c_ubyte*bLen)() # TODO string_at + from_address
     enc=ctypes.c_uint(0)  ## 0 is decrypt for inbound traffic
     #log.debug('BEFORE %s'%( myhex(self.aes_key_ctx.getCounter())) )
     #void AES_cbc_encrypt(
     #      const unsigned char *in, unsigned char *out, const unsigned long length, 
     #           const AES_KEY *key, unsigned char ivec[AES_BLOCK_SIZE], const int enc
     #        	  )
-    self._AES_cbc( ctypes.byref(src), ctypes.byref(dest), bLen, ctypes.byref(self.key), 
+    self._AES_cbc( src, dest, bLen, ctypes.byref(self.key), 
               ctypes.byref(self.iv), enc ) 
     ##log.debug('AFTER  %s'%( myhex(self.aes_key_ctx.getCounter())) )
-    #print self, repr(model.array2bytes(dest))
-    return model.array2bytes(dest)
+    return True
   
   def sync(self, context):
     ''' refresh the crypto state '''
@@ -82,6 +152,7 @@ class StatefulAES_CBC_Engine(Engine):
 
 
 class StatefulAES_Ctr_Engine(Engine):
+  _state = ('counter',)
   #ctx->cipher->do_cipher(ctx,out,in,inl);
   # -> openssl.AES_ctr128_encrypt(&in,&out,length,&aes_key, ivecArray, ecount_bufArray, &num )
   #AES_encrypt(ivec, ecount_buf, key); # aes_key is struct with cnt, key is really AES_KEY->aes_ctx
@@ -89,16 +160,17 @@ class StatefulAES_Ctr_Engine(Engine):
   def __init__(self, context ):
     self.sync(context)
     self._AES_ctr=libopenssl.AES_ctr128_encrypt
+    self._ecount_buf=(ctypes.c_ubyte*AES_BLOCK_SIZE)()
     log.debug('cipher:%s block_size: %d key_len: %d '%(context.name, context.block_size, context.key_len))
   
-  def _decrypt(self,block, bLen):
+  def _decrypt(self, src, dest, bLen):
     if bLen % AES_BLOCK_SIZE:
       log.error("Sugar, why do you give me a block the wrong size: %d not modulo of %d"%(bLen, AES_BLOCK_SIZE))
       return None
-    buf=(ctypes.c_ubyte*AES_BLOCK_SIZE)()
-    dest=(ctypes.c_ubyte*bLen)()
+    buf=self._ecount_buf
     num=ctypes.c_uint()
-    log.debug('BEFORE a %s : decrypt %d bytes'%( repr(self.getCounter()) , bLen ) )
+    if log.isEnabledFor(logging.DEBUG):
+      log.debug('BEFORE a %s : decrypt %d bytes'%( repr(self.getCounter()) , bLen ) )
     #void AES_ctr128_encrypt(
     #      const unsigned char *in, unsigned char *out, const unsigned long length, 
     #           const AES_KEY *key, unsigned char ivec[AES_BLOCK_SIZE],     
@@ -106,7 +178,7 @@ class StatefulAES_Ctr_Engine(Engine):
     # debug counter overflow
     ###last=self.aes_key_ctx.getCounter()[-1]
     ###before=self.getCounter()
-    self._AES_ctr( ctypes.byref(block), ctypes.byref(dest), bLen, ctypes.byref(self.key), 
+    self._AES_ctr( src, dest, bLen, ctypes.byref(self.key), 
               ctypes.byref(self.counter), ctypes.byref(buf), ctypes.byref(num) ) 
     '''
     newlast=self.aes_key_ctx.getCounter()[-1]
@@ -116,9 +188,10 @@ class StatefulAES_Ctr_Engine(Engine):
       log.warning('Before %s'%(before))
       log.warning('After  %s'%(after))
     '''
-    log.debug('AFTER a %s'%repr(self.getCounter()))
+    if log.isEnabledFor(logging.DEBUG):
+      log.debug('AFTER a %s'%repr(self.getCounter()))
     #log.debug('AFTER x %s'%( myhex(self.aes_key_ctx.getCounter())) )
-    return model.array2bytes(dest)
+    return True
   
   def sync(self, context):
     ''' refresh the crypto state '''
@@ -131,6 +204,11 @@ class StatefulAES_Ctr_Engine(Engine):
     #log.debug('Counter value is %s'%(myhex(self.aes_key_ctx.getCounter())) )
     #log.debug('Key CTX:%s'%( self.aes_key_ctx.toString() ) )
 
+  def clone(self):
+    other = Engine.clone(self)
+    other._ecount_buf=(ctypes.c_ubyte*AES_BLOCK_SIZE)()
+    return other
+
   def getCounter(self):
     #return myhex(self.aes_key_ctx.getCounter())
     return model.array2bytes(self.counter)
@@ -149,6 +227,29 @@ class StatefulAES_Ctr_Engine(Engine):
       if ctr[i] != 0xff: # underflow
         return
 
+  def addCounter(self, n):
+    ''' moves the big endian counter n blocks forward, or backward if n < 0 '''
+    ctr=self.counter
+    for i in range(len(ctr)-1,-1,-1):
+      if n == 0:
+        return
+      n += ctr[i]
+      ctr[i] = n & 0xff
+      n >>= 8
+
+  def setCounter(self, value):
+    ''' sets the counter from a getCounter() value '''
+    ctypes.memmove(self.counter, value, len(value))
+
+  def getKeystreamBlock(self):
+    ''' returns the keystream of the next block, without moving the counter.
+    The first plaintext block at any offset is data[i:i+16] ^ keystream.
+    '''
+    ks=(ctypes.c_ubyte*AES_BLOCK_SIZE)()
+    #void AES_encrypt(const unsigned char *in, unsigned char *out, const AES_KEY *key);
+    libopenssl.AES_encrypt( ctypes.byref(self.counter), ctypes.byref(ks), ctypes.byref(self.key) )
+    return model.array2bytes(ks)
+
 '''
 # reverse aes ...
 
@@ -178,22 +279,21 @@ that means backwards AES is :
 
 
 class StatefulBlowfish_CBC_Engine(Engine):
+  _state = ('iv',)
   def __init__(self, context  ):
     self.sync(context)
     self._BF_cbc=libopenssl.BF_cbc_encrypt
     log.debug('cipher:%s block_size: %d key_len: %d '%(context.name, context.block_size, context.key_len))
   
-  def _decrypt(self, src, bLen):
+  def _decrypt(self, src, dest, bLen):
     BF_ROUNDS	= 16
     BF_BLOCK = 8
-    dest=(ctypes.c_ubyte*bLen)()
     enc=ctypes.c_uint(0)  ## 0 is decrypt for inbound traffic ## ctx.evpCipherCtx.encrypt [0,1]
     #void BF_cbc_encrypt(const unsigned char *in, unsigned char *out, long length,
     #	const BF_KEY *schedule, unsigned char *ivec, int enc);
-    self._BF_cbc( ctypes.byref(src), ctypes.byref(dest), bLen, ctypes.byref(self.key), 
+    self._BF_cbc( src, dest, bLen, ctypes.byref(self.key), 
               ctypes.byref(self.iv), enc ) 
-    #print self, repr(model.array2bytes(dest))
-    return model.array2bytes(dest)
+    return True
   
   def sync(self, context):
     ''' refresh the crypto state '''
@@ -205,20 +305,19 @@ class StatefulBlowfish_CBC_Engine(Engine):
     log.info('IV value is %s'%(myhex(context.evpCtx.iv)) )
 
 class StatefulCAST_CBC_Engine(Engine):
+  _state = ('iv',)
   def __init__(self, context  ):
     self.sync(context)
     self._CAST_cbc=libopenssl.CAST_cbc_encrypt
     log.debug('cipher:%s block_size: %d key_len: %d '%(context.name, context.block_size, context.key_len))
   
-  def _decrypt(self, src, bLen):
-    dest=(ctypes.c_ubyte*bLen)()
+  def _decrypt(self, src, dest, bLen):
     enc=ctypes.c_uint(0)  ## 0 is decrypt for inbound traffic
     #void CAST_cbc_encrypt(const unsigned char *in, unsigned char *out, long length,
 		#      const CAST_KEY *ks, unsigned char *iv, int enc);
-    self._CAST_cbc( ctypes.byref(src), ctypes.byref(dest), bLen, ctypes.byref(self.key), 
+    self._CAST_cbc( src, dest, bLen, ctypes.byref(self.key), 
               ctypes.byref(self.iv), enc ) 
-    #print self, repr(model.array2bytes(dest))
-    return model.array2bytes(dest)
+    return True
   
   def sync(self, context):
     ''' refresh the crypto state '''
@@ -230,20 +329,19 @@ class StatefulCAST_CBC_Engine(Engine):
     log.info('IV value is %s'%(myhex(context.evpCtx.iv)) )
 
 class StatefulDES_CBC_Engine(Engine):
+  _state = ('iv',)
   def __init__(self, context  ):
     self.sync(context)
     self._DES_cbc=libopenssl.DES_cbc_encrypt
     log.debug('cipher:%s block_size: %d key_len: %d '%(context.name, context.block_size, context.key_len))
   
-  def _decrypt(self, src, bLen):
-    dest=(ctypes.c_ubyte*bLen)()
+  def _decrypt(self, src, dest, bLen):
     enc=ctypes.c_uint(0)  ## 0 is decrypt for inbound traffic
     #void CAST_cbc_encrypt(const unsigned char *in, unsigned char *out, long length,
 		#      const CAST_KEY *ks, unsigned char *iv, int enc);
-    self._CAST_cbc( ctypes.byref(src), ctypes.byref(dest), bLen, ctypes.byref(self.key), 
+    self._CAST_cbc( src, dest, bLen, ctypes.byref(self.key), 
               ctypes.byref(self.iv), enc ) 
-    #print self, repr(model.array2bytes(dest))
-    return model.array2bytes(dest)
+    return True
   
   def sync(self, context):
     ''' refresh the crypto state '''
@@ -255,20 +353,18 @@ class StatefulDES_CBC_Engine(Engine):
     log.info('IV value is %s'%(myhex(context.evpCtx.iv)) )
 
 class StatefulRC4_Engine(Engine):
+  # the RC4 key is the cipher state
+  _state = ('key',)
   def __init__(self, context  ):
     self.sync(context)
     self._RC4=libopenssl.RC4
     log.debug('cipher:%s block_size: %d key_len: %d '%(context.name, context.block_size, context.key_len))
   
-  def _decrypt(self, src, bLen):
-    dest=(ctypes.c_ubyte*bLen)()
-
+  def _decrypt(self, src, dest, bLen):
     #void RC4(RC4_KEY *key, unsigned long len, const unsigned char *indata,
 		#    unsigned char *outdata);
-    self._RC4( ctypes.byref(self.key), bLen, ctypes.byref(src), ctypes.byref(dest) ) 
-
-    #print self, repr(model.array2bytes(dest))
-    return model.array2bytes(dest)
+    self._RC4( ctypes.byref(self.key), bLen, src, dest ) 
+    return True
   
   def sync(self, context):
     ''' refresh the crypto state '''
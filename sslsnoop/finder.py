@@ -14,6 +14,7 @@ import time
 
 import psutil
 
+import network
 import openssh
 import openssl
 import utils
@@ -59,11 +60,8 @@ def pgrep(name):
       pids.append(name)
   return pids
 
-def makeFilter(conn):
-  # [connection(fd=3, family=2, type=1, local_address=('192.168.1.101', 36386), remote_address=('213.186.33.2', 22), status='ESTABLISHED')]
-  pcap_filter = "host %s and port %s and host %s and port %s" %(conn.local_address[0],conn.local_address[1] ,
-                            conn.remote_address[0],conn.remote_address[1]  )
-  return pcap_filter
+# moved to network, where the Sniffer builds its BPF filter
+makeFilter = network.makeFilter
 
 
     
@@ -32,10 +32,10 @@ discarded. [1]_
 """
 
 from __future__ import generators
-import time
-from heapq import heappush, heappop, heapify
+import itertools
+from collections import OrderedDict
 
-__version__ = "0.2"
+__version__ = "0.3"
 __all__ = ['CacheKeyError', 'LRUCache', 'DEFAULT_SIZE']
 __docformat__ = 'reStructuredText en'
 
@@ -57,6 +57,13 @@ class LRUCache(object):
     emulate a Python mapping type. You can use an LRU cache more or less like
     a Python dictionary, with the exception that objects you put into the
     cache may be discarded before you take them out.
+
+    Records are kept in an OrderedDict in LRU order, a hit moves the record
+    to the end, eviction pops the first one. Both are O(1).
+
+    The cache can also be bounded in bytes with 'maxbytes'. The size of an
+    object is given by 'sizeof', len() by default. 'onEvict(key, obj)' is
+    called for every record discarded to make room, not for deletions.
     
     Some example usage::
 	
@@ -90,106 +97,102 @@ class LRUCache(object):
         print j, cache[j] # iterator produces keys, not values
     """
     
-    class __Node(object):
-        """Record of a cached value. Not for public consumption."""
-        
-        def __init__(self, key, obj, timestamp):
-            object.__init__(self)
-            self.key = key
-            self.obj = obj
-            self.atime = timestamp
-            self.mtime = self.atime
-    
-        def __cmp__(self, other):
-            return cmp(self.atime, other.atime)
+    # a logical clock, for mtime
+    __clock = itertools.count(1)
 
-        def __repr__(self):
-            return "<%s %s => %s (%s)>" % \
-                   (self.__class__, self.key, self.obj, \
-                    time.asctime(time.localtime(self.atime)))
-
-    def __init__(self, size=DEFAULT_SIZE):
+    def __init__(self, size=DEFAULT_SIZE, maxbytes=None, sizeof=len, onEvict=None):
         # Check arguments
         if size <= 0:
             raise ValueError, size
         elif type(size) is not type(0):
             raise TypeError, size
+        if maxbytes is not None and maxbytes <= 0:
+            raise ValueError, maxbytes
         object.__init__(self)	
-        self.__heap = []
-        self.__dict = {}
+        # key => [obj, mtime, nbytes]
+        self.__dict = OrderedDict()
+        self.__bytes = 0
+        self.maxbytes = maxbytes
+        """Maximum total sizeof() of the cached objects, or None."""
+        self.sizeof = sizeof
+        self.onEvict = onEvict
         self.size = size
         """Maximum size of the cache.
         If more than 'size' elements are added to the cache,
         the least-recently-used ones will be discarded."""
     
     def __len__(self):
-        return len(self.__heap)
+        return len(self.__dict)
     
     def __contains__(self, key):
-        return self.__dict.has_key(key)
+        return key in self.__dict
     
     def __setitem__(self, key, obj):
-        if self.__dict.has_key(key):
-            node = self.__dict[key]
-            node.obj = obj
-            node.atime = time.time()
-            node.mtime = node.atime
-            heapify(self.__heap)
-        else:
-            # size may have been reset, so we loop
-            while len(self.__heap) >= self.size:
-                lru = heappop(self.__heap)
-                del self.__dict[lru.key]
-            node = self.__Node(key, obj, time.time())
-            self.__dict[key] = node
-            heappush(self.__heap, node)
-    
+        nbytes = 0
+        if self.maxbytes is not None:
+            nbytes = self.sizeof(obj)
+        node = self.__dict.pop(key, None)
+        if node is not None:
+            self.__bytes -= node[2]
+        self.__dict[key] = [obj, self.__clock.next(), nbytes]
+        self.__bytes += nbytes
+        # size may have been reset, so we loop
+        self.__shrink(self.size)
+
     def __getitem__(self, key):
-        if not self.__dict.has_key(key):
+        try:
+            node = self.__dict.pop(key)
+        except KeyError:
             raise CacheKeyError(key)
-        else:
-            node = self.__dict[key]
-            node.atime = time.time()
-            heapify(self.__heap)
-            return node.obj
+        self.__dict[key] = node
+        return node[0]
     
     def __delitem__(self, key):
-        if not self.__dict.has_key(key):
+        try:
+            node = self.__dict.pop(key)
+        except KeyError:
             raise CacheKeyError(key)
-        else:
-            node = self.__dict[key]
-            del self.__dict[key]
-            self.__heap.remove(node)
-            heapify(self.__heap)
-            return node.obj
+        self.__bytes -= node[2]
+        return node[0]
 
     def __iter__(self):
-        copy = self.__heap[:]
-        while len(copy) > 0:
-            node = heappop(copy)
-            yield node.key
-        raise StopIteration
+        return iter(self.__dict.keys())
+
+    def __shrink(self, size):
+        """discards LRU records down to size records and maxbytes bytes,
+        keeping at least the most recent one."""
+        d = self.__dict
+        while len(d) > size or (self.maxbytes is not None and self.__bytes > self.maxbytes and len(d) > 1):
+            key, node = d.popitem(last=False)
+            self.__bytes -= node[2]
+            if self.onEvict is not None:
+                self.onEvict(key, node[0])
 
     def __setattr__(self, name, value):
         object.__setattr__(self, name, value)
-        # automagically shrink heap on resize
+        # automagically shrink on resize
         if name == 'size':
-            while len(self.__heap) > value:
-                lru = heappop(self.__heap)
-                del self.__dict[lru.key]
+            self.__shrink(value)
+        elif name == 'maxbytes' and value is not None and 'size' in self.__dict__:
+            self.__shrink(self.size)
         
     def __repr__(self):
-        return "<%s (%d elements)>" % (str(self.__class__), len(self.__heap))
+        return "<%s (%d elements)>" % (str(self.__class__), len(self.__dict))
+
+    def nbytes(self):
+        """Return the total sizeof() of the cached objects, 0 without maxbytes."""
+        return self.__bytes
 
     def mtime(self, key):
         """Return the last modification time for the cache record with key.
+        That is a logical clock, increasing on every store in any LRUCache,
+        not a wall clock time. Compare it to other mtime() values.
         May be useful for cache instances where the stored values can get
         'stale', such as caching file or network resource contents."""
-        if not self.__dict.has_key(key):
+        try:
+            return self.__dict[key][1]
+        except KeyError:
             raise CacheKeyError(key)
-        else:
-            node = self.__dict[key]
-            return node.mtime
 
 if __name__ == "__main__":
     cache = LRUCache(25)
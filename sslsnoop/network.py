@@ -7,16 +7,28 @@
 __author__ = "Loic Jaquemet loic.jaquemet+python@gmail.com"
 
 import logging,os,socket,select, sys,time
-import multiprocessing, Queue
+import multiprocessing, Queue, threading
 import scapy.config
 
-from lrucache import LRUCache
-
+import decode
+import ring
 import stream
+import timers
+import tpacket
 
 log = logging.getLogger('network')
 
 QUEUE_SIZE = 15000
+SNAPLEN = 65535
+# packets read by one dispatch(), when reading them one by one
+DISPATCH_MAX = 1000
+
+got_pypcap = False
+try:
+  import pcap
+  got_pypcap = True
+except ImportError:
+  pass
 
 def hexify(data):
   s=''
@@ -29,8 +41,118 @@ def hexify(data):
   #s+="\r\n"
   return s
 
+def makeFilter(conn):
+  ''' returns the pcap filter expression of that connection '''
+  # [connection(fd=3, family=2, type=1, local_address=('192.168.1.101', 36386), remote_address=('213.186.33.2', 22), status='ESTABLISHED')]
+  pcap_filter = "host %s and port %s and host %s and port %s" %(conn.local_address[0],conn.local_address[1] ,
+                            conn.remote_address[0],conn.remote_address[1]  )
+  return pcap_filter
+
+def combineFilters(base, filters):
+  ''' returns the base filter restricted to any of these filters.
+  No filters at all matches nothing.'''
+  if len(filters) == 0:
+    return '(%s) and not (%s)'%(base, base)
+  return '(%s) and ((%s))'%(base, ') or ('.join(filters))
+
+def setScapyFilter(sock, rules):
+  ''' replace the BPF filter of a scapy L2listen socket '''
+  ins = getattr(sock, 'ins', sock)
+  if hasattr(ins, 'setfilter'): # use_pcap sockets
+    ins.setfilter(rules)
+    return
+  from scapy.arch.linux import attach_filter
+  try:
+    attach_filter(ins, rules)
+  except TypeError: # newer scapy wants the interface
+    attach_filter(ins, rules, getattr(sock, 'iface', None))
+  return
+
+def isLoopback(connection):
+  host = connection.local_address[0]
+  return host.startswith('127.') or host == '::1' or host.startswith('::ffff:127.')
+
+def flowKey(shost, sport, dhost, dport):
+  ''' returns the direction-normalized key of a connection, and the direction
+  bit: True if (shost,sport) is the first endpoint of that key.'''
+  if (shost,sport) <= (dhost,dport):
+    return (shost,sport,dhost,dport), True
+  return (dhost,dport,shost,sport), False
+
+
+class Flow(object):
+  ''' One tracked connection. hits and drops are counted per direction,
+  indexed by the direction bit of the packets.'''
+  __slots__ = ('key', 'connection', 'stream', 'queue', 'localFirst', 'hits', 'drops')
+  def __init__(self, key, localFirst, connection, stream, queue):
+    self.key = key
+    self.localFirst = localFirst
+    self.connection = connection
+    self.stream = stream
+    self.queue = queue
+    self.hits = [0,0]
+    self.drops = [0,0]
+
+  def isInbound(self, first):
+    ''' packets with that direction bit are going to the local address '''
+    return first != self.localFirst
+
+  def __repr__(self):
+    return '<Flow %s:%s-%s:%s hits:%d drops:%d>'%(self.key+(sum(self.hits), sum(self.drops)))
+
+
+class FlowTable:
+  ''' The connections tracked by a Sniffer. One entry per connection, looked up
+  with a single dict access whatever the direction of the packet.'''
+  def __init__(self):
+    self.flows = {}
+    self.misses = 0
+
+  def add(self, connection, stream, queue):
+    shost,sport = connection.local_address
+    dhost,dport = connection.remote_address
+    key, localFirst = flowKey(shost, sport, dhost, dport)
+    if key in self.flows:
+      raise ValueError('Stream already exists')
+    flow = Flow(key, localFirst, connection, stream, queue)
+    self.flows[key] = flow
+    return flow
+
+  def lookup(self, shost, sport, dhost, dport):
+    ''' returns (flow, direction bit) or (None, None) and counts the hit '''
+    key, first = flowKey(shost, sport, dhost, dport)
+    flow = self.flows.get(key)
+    if flow is None:
+      self.misses += 1
+      return None, None
+    flow.hits[first] += 1
+    return flow, first
+
+  def remove(self, key):
+    return self.flows.pop(key, None)
+
+  def __contains__(self, connectionTuple):
+    return flowKey(*connectionTuple)[0] in self.flows
+
+  def __len__(self):
+    return len(self.flows)
+
+  def __iter__(self):
+    return iter(self.flows.values())
+
+  def stats(self):
+    ''' returns a list of (key, hits, drops), hits and drops being (local->remote, remote->local) '''
+    ret = []
+    for flow in self.flows.values():
+      out, inb = int(flow.localFirst), int(not flow.localFirst)
+      ret.append((flow.key, (flow.hits[out], flow.hits[inb]), (flow.drops[out], flow.drops[inb])))
+    return ret
+
+
 class Sniffer():
   worker=None
+  # captures big loopback segments whole
+  fullLoopback = False
   def __init__(self,filterRules='tcp', packetCount=0, timeout=None):
     ''' 
     This sniffer can run in a thread. But it should be one of the few thread running (BPL) 
@@ -48,89 +170,253 @@ class Sniffer():
     self.packetCount = packetCount
     self.timeout = timeout
     #
-    self.streams = {}
+    self.flows = FlowTable()
+    # gap timeouts of all our streams
+    self.timers = timers.TimerWheel()
     self._running_thread = None
+    # the capture handle carrying our BPF filter, while run() is running
+    self._capture = None
+    self._filterLock = threading.Lock()
+    # triage in the capture thread, see register()
+    self.inline = False
+    self._more = False
     return
   
 
   def run(self):
     # scapy - with config initialised
-    #scapy.sendrecv.sniff(count=self.packetCount,timeout=self.timeout,store=0,filter=self.filterRules,prn=self.cbSSHPacket)
-    from scapy.all import sniff
-    log.info('Using L2listen = %s'%(scapy.config.conf.L2listen)) 
+    # we own the L2listen socket, so that the filter follows the tracked connections.
+    L2listen = scapy.config.conf.L2listen
+    log.info('Using L2listen = %s'%(L2listen)) 
     # XXX TODO, define iface from saddr and daddr // scapy.all.read_routes()
-    sniff(count=self.packetCount, timeout=self.timeout, store=0, filter=self.filterRules, prn=self.enqueue, iface='any')
+    sock = L2listen(iface='any', filter=self.currentFilter())
+    self._attach(sock)
+    enqueue = self.enqueue
+    count = 0
+    end = None
+    if self.timeout is not None:
+      end = time.time() + self.timeout
+    try:
+      while True:
+        remain = None
+        if end is not None:
+          remain = end - time.time()
+          if remain <= 0:
+            break
+        sel = select.select([sock],[],[],remain)
+        if sock in sel[0]:
+          p = sock.recv(SNAPLEN)
+          if p is None:
+            break
+          enqueue(p)
+          count += 1
+          if count == self.packetCount:
+            break
+    finally:
+      self._attach(None)
+      sock.close()
     log.warning('============ SNIFF Terminated ====================')
     return
 
+  def open(self):
+    ''' opens and filters the capture handle for dispatch() '''
+    sock = scapy.config.conf.L2listen(iface='any', filter=self.currentFilter())
+    self._attach(sock)
+    return sock
+
+  def dispatch(self):
+    ''' reads the packets already captured, without blocking. '''
+    sock = self._capture
+    enqueue = self.enqueue
+    n = 0
+    while n < DISPATCH_MAX and sock in select.select([sock],[],[],0)[0]:
+      p = sock.recv(SNAPLEN)
+      if p is None:
+        break
+      enqueue(p)
+      n += 1
+    self._more = (n == DISPATCH_MAX)
+    self.expire()
+    return n
+
+  def close(self):
+    ''' closes the capture handle of open(), and finishes the inline streams '''
+    capture = self._capture
+    self._attach(None)
+    if hasattr(capture, 'close'):
+      capture.close()
+    if self.inline:
+      for flow in self.flows:
+        if flow.stream is not None:
+          flow.stream.finish()
+    return
+
+  def fileno(self):
+    return self._capture.fileno()
+
+  def pending(self):
+    ''' True if dispatch() stopped before reading all the captured packets '''
+    return self._more
+
+  def register(self, supervisor):
+    ''' capture in the handlers of an output.Supervisor, instead of a run() thread.
+    Segments are triaged by dispatch(), the TCPStreams have no thread, and the
+    gap timers are run by dispatch() too. Call before makeStream().
+    '''
+    self.inline = True
+    self.open()
+    supervisor.add(self, self.dispatch, budget=1, name='sniffer', interval=self.timers.tick)
+    return
+
+  def expire(self):
+    ''' runs the gap timers of inline streams '''
+    if self.inline and self.timers.expire() > 0:
+      for flow in self.flows:
+        if flow.stream is not None:
+          flow.stream.checkExpired()
+    return
+
+  def currentFilter(self):
+    ''' returns the BPF expression for the tracked connections '''
+    return combineFilters(self.filterRules, [makeFilter(flow.connection) for flow in self.flows])
+
+  def _setFilter(self, capture, rules):
+    ''' compile and attach rules to the capture handle. The kernel swaps socket
+    filters atomically, there is no window where the socket is unfiltered.'''
+    setScapyFilter(capture, rules)
+
+  def _attach(self, capture):
+    ''' the capture handle used by run(), or None '''
+    self._filterLock.acquire()
+    try:
+      self._capture = capture
+      if capture is not None:
+        self._setFilter(capture, self.currentFilter())
+    finally:
+      self._filterLock.release()
+    return
+
+  def updateFilter(self):
+    ''' recompile the filter after a change in the tracked connections '''
+    self._filterLock.acquire()
+    try:
+      if self._capture is None:
+        return
+      rules = self.currentFilter()
+      try:
+        self._setFilter(self._capture, rules)
+        log.debug('BPF filter is now %s'%(rules))
+      except Exception,e:
+        log.error('could not set the BPF filter %s: %s'%(rules, e))
+    finally:
+      self._filterLock.release()
+    return
+
   def hasStream(self, packet):
     ''' checks if the stream has a queue '''
-    (shost,sport,dhost,dport) = getConnectionTuple(packet)
-    return (shost,sport,dhost,dport) in self.streams
+    return getConnectionTuple(packet) in self.flows
 
   def getStream(self, packet):
     ''' returns the queue for that stream '''
-    if self.hasStream(packet):
-      return self.streams[getConnectionTuple(packet)]
-    #log.debug('Packet with no such connection %s %s %s %s'%(getConnectionTuple(packet)))
-    return None,None
+    flow, first = self.flows.lookup(*getConnectionTuple(packet))
+    if flow is None:
+      return None,None
+    return flow.stream, flow.queue
 
-  def addStream(self, connection):
-    ''' forget that stream '''
+  def addStream(self, connection, backend=stream.BACKEND_SOCKET):
+    ''' register that stream '''
     shost,sport = connection.local_address
     dhost,dport = connection.remote_address
-    if shost.startswith('127.') or shost.startswith('::1'):
+    if isLoopback(connection) and not self.fullLoopback:
       log.warning('=============================================================')
       log.warning('scapy is gonna truncate big packet on the loopback interface.')
-      log.warning('please change your test params,or use offline mode with pcap.')
+      log.warning('please use network.LoopbackSniffer, or offline mode with pcap.')
       log.warning('=============================================================')
     #q = multiprocessing.Queue(QUEUE_SIZE)
     q = Queue.Queue(QUEUE_SIZE)
-    st = stream.TCPStream(q, connection)
-    #save in both directions
-    self.streams[(shost,sport,dhost,dport)] = (st,q)
-    self.streams[(dhost,dport,shost,sport)] = (st,q)
+    st = stream.TCPStream(q, connection, backend, self.timers)
+    self.flows.add(connection, st, q)
     return st
   
   def dropStream(self, packet):
     ''' forget that stream '''
-    if self.hasStream(packet):
-      (shost,sport,dhost,dport) = getConnectionTuple(packet)
-      if (shost,sport,dhost,dport) in self.streams:
-        del self.streams[(shost,sport,dhost,dport)]
-      if (dhost,dport,shost,sport) in self.streams:
-        del self.streams[(dhost,dport,shost,sport)]
-      log.info('Dropped %s,%s,%s,%s from valid connections.'%(shost,sport,dhost,dport))
+    key = flowKey(*getConnectionTuple(packet))[0]
+    if self.flows.remove(key) is not None:
+      self.updateFilter()
+      log.info('Dropped %s,%s,%s,%s from valid connections.'%key)
     return None
     
   def enqueue(self, packet):
-    st,q = self.getStream(packet)
-    if q is None:
+    (shost,sport,dhost,dport) = getConnectionTuple(packet)
+    flow, first = self.flows.lookup(shost,sport,dhost,dport)
+    if flow is None:
+      return
+    inbound = flow.isInbound(first)
+    if self.inline and flow.stream is not None:
+      flow.stream.triage(packet, inbound)
       return
+    q = flow.queue
+    shared = isinstance(q, ring.SegmentQueue)
     try:
-      log.debug('Queuing a packet from %s:%s\t-> %s:%s'%(getConnectionTuple(packet)))
-      q.put_nowait(packet)
+      if log.isEnabledFor(logging.DEBUG):
+        log.debug('Queuing a packet from %s:%s\t-> %s:%s'%(shost,sport,dhost,dport))
+      if shared:
+        q.put_nowait((packet, inbound))
+      else: # the Stream gets lists, like from a SegmentQueue
+        q.put_nowait([(packet, inbound)])
     except Queue.Full:
-      log.warning('a Queue is Full (%d). lost packet for %s'%(q.qsize(), repr(st.connection)))
-      self.dropStream( packet )
+      flow.drops[first] += 1
+      if shared:
+        # never wait for a worker, that stalls the capture of all the flows.
+        # the worker sees a hole, its gap timer skips it and resynchronizes.
+        if flow.drops[first] == 1:
+          log.warning('the ring of %s is full, losing segments'%(repr(flow.connection)))
+        return
+      log.warning('a Queue is Full (%d). lost packet for %s'%(q.qsize(), repr(flow.connection)))
+      self.flows.remove(flow.key)
+      self.updateFilter()
+      log.info('Dropped %s,%s,%s,%s from valid connections.'%flow.key)
     except Exception,e:
       log.error(e)
     return
 
-  def makeStream(self, connection):
+  def stats(self):
+    ''' returns (flow table misses, [(key, hits, drops), ...]) '''
+    return self.flows.misses, self.flows.stats()
+
+  def makeStream(self, connection, backend=stream.BACKEND_SOCKET):
     ''' create a TCP Stream recognized by sniffer 
       the Stream can be used to read captured data
       
       The Stream should be run is a thread or a subprocess (better because of GIL).
+
+      @param backend: stream.BACKEND_SOCKET or stream.BACKEND_PIPE
     '''
     shost,sport = connection.local_address
     dhost,dport = connection.remote_address
-    if (shost,sport,dhost,dport) in self.streams:
+    if (shost,sport,dhost,dport) in self.flows:
       raise ValueError('Stream already exists')
-    tcpstream = self.addStream(connection)
+    tcpstream = self.addStream(connection, backend)
+    self.updateFilter()
+    if not self.inline: # else, dispatch() runs the timers
+      self.timers.start()
     log.debug('Created a TCPStream for %s'%(tcpstream))
     return tcpstream
 
+  def makeSharedStream(self, connection, size=ring.RING_SIZE):
+    ''' register a connection whose Stream will run in another process.
+      Its packets go to a ring.SegmentQueue in shared memory. 
+      
+      Create it before forking the process that runs the Stream.
+
+      @return: the ring.SegmentQueue, to give to stream.TCPStream in the other process.
+    '''
+    q = ring.SegmentQueue(connection, size)
+    self.flows.add(connection, None, q)
+    self.updateFilter()
+    log.debug('Created a shared SegmentQueue for %s'%(q))
+    return q
+
 
 def getConnectionTuple(packet):
   ''' Supposedly an IP/IPv6 model'''
@@ -146,24 +432,210 @@ def getConnectionTuple(packet):
  
 
 
+class PcapSniffer(Sniffer):
+  ''' Capture with libpcap (pypcap) and decode frames without scapy.
+    The stream layer gets stream.Segment instead of scapy packets.
+  '''
+  def __init__(self, filterRules='tcp', packetCount=0, timeout=None, iface='any', snaplen=SNAPLEN):
+    Sniffer.__init__(self, filterRules=filterRules, packetCount=packetCount, timeout=timeout)
+    self.iface = iface
+    self.snaplen = snaplen
+
+  def _setFilter(self, capture, rules):
+    capture.setfilter(rules)
+
+  def open(self):
+    pc = pcap.pcap(name=self.iface, snaplen=self.snaplen, promisc=False, immediate=True, timeout_ms=100)
+    decode.checkLinkType(pc.datalink())
+    pc.setnonblock(True)
+    self._attach(pc)
+    return pc
+
+  def dispatch(self):
+    pc = self._capture
+    linktype = pc.datalink()
+    parse = decode.parseFrame
+    enqueue = self.enqueue
+    def callback(ts, frame):
+      segment = parse(frame, linktype)
+      if segment is not None:
+        enqueue(segment)
+    n = pc.dispatch(-1, callback)
+    self.expire()
+    return n
+
+  def run(self):
+    pc = pcap.pcap(name=self.iface, snaplen=self.snaplen, promisc=False, immediate=True, timeout_ms=100)
+    linktype = decode.checkLinkType(pc.datalink())
+    self._attach(pc)
+    log.info('Using libpcap on %s linktype %d'%(self.iface, linktype)) 
+    parse = decode.parseFrame
+    enqueue = self.enqueue
+    count = 0
+    end = None
+    if self.timeout is not None:
+      end = time.time() + self.timeout
+    try:
+      for ts, frame in pc:
+        segment = parse(frame, linktype)
+        if segment is not None:
+          enqueue(segment)
+        count += 1
+        if count == self.packetCount or (end is not None and ts > end):
+          break
+    finally:
+      self._attach(None)
+    log.warning('============ SNIFF Terminated ====================')
+    return
+
+
+class MmapSniffer(Sniffer):
+  ''' Capture on a linux AF_PACKET TPACKET_V3 ring (see tpacket.py), without
+  libpcap nor scapy. Frames are decoded in place in the ring, one wakeup per
+  block of frames.
+
+    @param ringSize: bytes of the ring shared with the kernel
+    @param blockTimeout: ms before the kernel hands over a block that is not full
+
+    Frames cut by the ring are dropped and counted in self.truncated, the 
+    stream layer sees them as missing data. Packets on the loopback interface
+    are seen twice, going out and coming in, only the outgoing copy is kept.
+  '''
+  fullLoopback = True
+  def __init__(self, filterRules='tcp', packetCount=0, timeout=None, iface='any', 
+                ringSize=tpacket.BLOCK_SIZE*tpacket.BLOCK_COUNT, blockTimeout=tpacket.BLOCK_TIMEOUT,
+                blockSize=tpacket.BLOCK_SIZE):
+    Sniffer.__init__(self, filterRules=filterRules, packetCount=packetCount, timeout=timeout)
+    self.iface = iface
+    self.blockSize = blockSize
+    self.blockCount = max(1, ringSize//blockSize)
+    self.blockTimeout = blockTimeout
+    self.truncated = 0
+
+  def _setFilter(self, capture, rules):
+    capture.setFilter(rules)
+
+  def _openRing(self):
+    return tpacket.PacketRing(self.iface, self.blockSize, self.blockCount, self.blockTimeout)
+
+  def open(self):
+    capture = self._openRing()
+    self._attach(capture)
+    self._lo = tpacket.ifIndex('lo')
+    return capture
+
+  def dispatch(self):
+    capture = self._capture
+    parse = decode.parseNetwork
+    enqueue = self.enqueue
+    mm = capture.mm
+    lo = self._lo
+    outgoing = tpacket.PACKET_OUTGOING
+    n = 0
+    for offset, snaplen, wirelen, protocol, ifindex, pkttype in capture.frames(0):
+      if ifindex == lo and pkttype != outgoing:
+        continue
+      if snaplen < wirelen:
+        self.truncated += 1
+        continue
+      segment = parse(mm, offset, protocol, offset + snaplen)
+      if segment is not None:
+        enqueue(segment)
+      n += 1
+    self.expire()
+    return n
+
+  def run(self):
+    capture = self._openRing()
+    self._attach(capture)
+    log.info('Using a TPACKET_V3 ring of %dx%d bytes on %s'%(self.blockCount, self.blockSize, self.iface)) 
+    parse = decode.parseNetwork
+    enqueue = self.enqueue
+    mm = capture.mm
+    lo = tpacket.ifIndex('lo')
+    outgoing = tpacket.PACKET_OUTGOING
+    count = 0
+    end = None
+    if self.timeout is not None:
+      end = time.time() + self.timeout
+    try:
+      while True:
+        # wake up at least once per block timeout
+        for offset, snaplen, wirelen, protocol, ifindex, pkttype in capture.frames(self.blockTimeout/1000.):
+          if ifindex == lo and pkttype != outgoing:
+            continue
+          if snaplen < wirelen:
+            self.truncated += 1
+            continue
+          segment = parse(mm, offset, protocol, offset + snaplen)
+          if segment is not None:
+            enqueue(segment)
+          count += 1
+          if count == self.packetCount:
+            break
+        if count == self.packetCount > 0 or (end is not None and time.time() > end):
+          break
+    finally:
+      self._attach(None)
+      packets, drops = capture.stats()
+      log.info('ring stats: %d packets, %d dropped, %d truncated'%(packets, drops, self.truncated))
+      capture.close()
+    log.warning('============ SNIFF Terminated ====================')
+    return
+
+
+class LoopbackSniffer(MmapSniffer):
+  ''' Capture full size segments on the loopback interface.
+
+    TCP over lo is segmented by GSO only when leaving the stack, so the capture
+    gets segments up to 64KB, and bigger ones with an IP length of 0. The ring
+    blocks are big enough to hold them whole, whatever the lo MTU.
+  '''
+  def __init__(self, filterRules='tcp', packetCount=0, timeout=None, 
+                ringSize=tpacket.BLOCK_SIZE*tpacket.BLOCK_COUNT, blockTimeout=tpacket.BLOCK_TIMEOUT):
+    MmapSniffer.__init__(self, filterRules=filterRules, packetCount=packetCount, timeout=timeout, iface='lo', 
+                          ringSize=ringSize, blockTimeout=blockTimeout, blockSize=max(tpacket.BLOCK_SIZE, 4*SNAPLEN))
+
+
 class PcapFileSniffer(Sniffer):
-  ''' Use scapy's offline mode to simulate network by reading a pcap file.
+  ''' Simulate network by reading a pcap file.
+    Classic pcap files are decoded without scapy, others go through scapy's offline mode.
   '''
   def __init__(self, pcapfile, filterRules='tcp', packetCount=0):
     Sniffer.__init__(self, filterRules=filterRules, packetCount=packetCount)
     self.pcapfile = pcapfile
+
+  def _readRaw(self):
+    ''' returns False if that is not a classic pcap file '''
+    parse = decode.parseFrame
+    enqueue = self.enqueue
+    f = open(self.pcapfile, 'rb')
+    try:
+      for ts, linktype, frame in decode.readPcapFile(f):
+        segment = parse(frame, linktype)
+        if segment is not None:
+          enqueue(segment)
+    except ValueError, e:
+      log.debug('%s: %s'%(self.pcapfile, e))
+      return False
+    finally:
+      f.close()
+    return True
+
   def run(self):
-    from scapy.all import sniff
-    sniff(store=0, prn=self.enqueue, offline=self.pcapfile)
+    if not self._readRaw():
+      from scapy.all import sniff
+      sniff(store=0, prn=self.enqueue, offline=self.pcapfile)
     log.info('Finishing the pcap reading')
-    for v, k in list(self.streams.items()):
-      st,q = k
+    for flow in list(self.flows):
+      st,q = flow.stream, flow.queue
       if not q.empty():
-        log.debug('waiting on %s'%(repr(v)))
+        log.debug('waiting on %s'%(repr(flow)))
         q.join()
-      del self.streams[v]
+      self.flows.remove(flow.key)
       del q
-      st.pleaseStop()
+      if st is not None:
+        st.pleaseStop()
 
     log.info('============ SNIFF Terminated ====================')
 
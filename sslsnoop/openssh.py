@@ -16,14 +16,18 @@ import struct
 import sys
 import time
 import threading
+import multiprocessing
 import Queue
 
 # todo : replace by one empty shell of ours
 #from paramiko.transport import Transport
 
 import output
+import sessionlog
 import haystack 
 import network
+import stream
+import timers
 import utils
 
 #our impl
@@ -31,6 +35,20 @@ from paramiko_packet import Packetizer, PACKET_MAX_SIZE
 
 log=logging.getLogger('sslsnoop-openssh')
 
+# seconds to wait for the reader of the data before a gap to finish
+RESYNC_TIMEOUT = 10
+# the first packet after a gap is looked for in that many bytes
+RESYNC_WINDOW = 64*1024
+# counter values tried after a gap, before giving up on the CTR resync
+RESYNC_MAX_BLOCKS = 1 << 20
+# packets decrypted to validate an alignment. Longer chains make less false
+# alignments, but wait for more traffic.
+ALIGN_CHAIN_LENGTH = 3
+# seconds to wait for the traffic that validates an alignment
+ALIGN_TIMEOUT = 2
+# RFC 4250, message numbers above 127 are for local extensions
+MSG_TYPE_MAX = 127
+
 W  = "\033[0m";  # white (normal)
 BLA= "\033[30m"; # black
 R  = "\033[31m"; # red
@@ -152,7 +170,13 @@ class OpenSSHLiveDecryptatator(OpenSSHKeysFinder):
     Decrypt SSH traffic in live.
     This class only works on Live PID.
   '''
-  def __init__(self, pid, sessionStateAddr=None, scapyThread = None, autoalign=True):
+  # a sessionlog.SessionLogWriter recording all the messages, or None
+  sessionLog = None
+  def __init__(self, pid, sessionStateAddr=None, scapyThread = None, autoalign=True, backend=stream.BACKEND_SOCKET):
+    '''
+    @param backend: stream.BACKEND_SOCKET to read the TCP streams through a socketpair,
+      stream.BACKEND_PIPE to read them from an in-memory pipe.
+    '''
     OpenSSHKeysFinder. __init__(self, pid)
     self.scapy = scapyThread
     self.session_state_addr = sessionStateAddr
@@ -160,12 +184,13 @@ class OpenSSHLiveDecryptatator(OpenSSHKeysFinder):
     self.inbound = Dummy()
     self.outbound = Dummy()
     self.autoalign = autoalign
+    self.backend = backend
     return
   
   def _initSniffer(self):
     ''' use existing sniffer or create a new one '''
     if self.scapy is None:
-      self.scapy = utils.launchScapy()
+      self.scapy = utils.launchScapy(self.connection)
     elif not self.scapy.thread.isAlive():
       self.scapy.thread.start()
     log.info(G+'[+] Sniffer online'+W)
@@ -184,7 +209,7 @@ class OpenSSHLiveDecryptatator(OpenSSHKeysFinder):
   
   def _initStream(self):
     ''' create a stream from scapy thread '''
-    self.stream = self.scapy.makeStream(self.connection)
+    self.stream = self.scapy.makeStream(self.connection, self.backend)
     self.inbound.state = self.stream.getInbound()
     self.outbound.state = self.stream.getOutbound()
     log.debug('Streams loaded')
@@ -208,12 +233,13 @@ class OpenSSHLiveDecryptatator(OpenSSHKeysFinder):
     return 
 
   @classmethod
-  def _attachEngine(cls, packetizer, context):
-    ''' activate the packetizer with a cipher engine '''
+  def _attachEngine(cls, packetizer, context, engine=None):
+    ''' activate the packetizer with a cipher engine, a new one by default '''
     from paramiko.transport import Transport
     from engine import CIPHERS    
     # find Engine from engine.ciphers
-    engine = CIPHERS[context.name](context) 
+    if engine is None:
+      engine = CIPHERS[context.name](context) 
     log.debug( 'cipher:%s block_size: %d key_len: %d '%(context.name, context.block_size, context.key_len ) )
     mac = context.mac
     if mac is not None:
@@ -232,22 +258,156 @@ class OpenSSHLiveDecryptatator(OpenSSHKeysFinder):
     
   def _initOutputs(self):
     ''' init output engine. File Writers.'''
+    if self.sessionLog is not None:
+      connection = utils.connectionToString(self.stream.connection)
+      name = 'ssh-%s'%( utils.connectionToString(self.stream.connection, reverse=True) )
+      self.inbound.filewriter = output.SSHStreamToLog(self.inbound.packetizer, self.inbound, name, 
+                                      self.sessionLog, connection, sessionlog.INBOUND)
+      name = 'ssh-%s'%( connection )
+      self.outbound.filewriter = output.SSHStreamToLog(self.outbound.packetizer, self.outbound, name, 
+                                      self.sessionLog, connection, sessionlog.OUTBOUND)
+      log.debug('Outputs created, logging to %s'%(self.sessionLog.fname))
+      return
     name = 'ssh-%s'%( utils.connectionToString(self.stream.connection, reverse=True) )
-    self.inbound.filewriter = output.SSHStreamToFile(self.inbound.packetizer, self.inbound, name)
+    self.inbound.filewriter = output.SSHStreamToFile(self.inbound.packetizer, self.inbound, name, block=False)
 
     name = 'ssh-%s'%( utils.connectionToString(self.stream.connection) )
-    self.outbound.filewriter =  output.SSHStreamToFile(self.outbound.packetizer, self.outbound, name)
+    self.outbound.filewriter =  output.SSHStreamToFile(self.outbound.packetizer, self.outbound, name, block=False)
     log.debug('Outputs created')
     return 
 
   def _initWorker(self):
     ''' worker to poll on data for decryption '''
     self.worker = output.Supervisor()
-    self.worker.add( self.inbound.state.getSocket() ,  self.inbound.filewriter.process  )
-    self.worker.add( self.outbound.state.getSocket(), self.outbound.filewriter.process )
+    for way in (self.inbound, self.outbound):
+      self.worker.add( way.state.getSocket(), way.filewriter.process, way.filewriter.pending, name=way.state.name )
     log.debug('Worker created')
     return
         
+  def _initGapRecovery(self):
+    ''' skip lost TCP data and resynchronize the cipher after it '''
+    for way in (self.inbound, self.outbound):
+      way.state.onGap = lambda state, missing, way=way: self._onGap(way, missing)
+      # one resync thread per direction. resyncGap counts the gaps, resyncing
+      # is the gap the thread is working on, or None.
+      way.resyncLock = threading.Lock()
+      way.resyncGap = 0
+      way.resyncing = None
+      way.resyncMissing = 0
+      way.resyncThread = None
+    return
+
+  def _packetState(self, way):
+    if way is self.inbound:
+      return self.ciphers.session_state.incoming_packet
+    return self.ciphers.session_state.outgoing_packet
+
+  def _onGap(self, way, missing):
+    ''' called from the stream thread, before the data after the gap is queued.
+    Data after the gap goes to a new socket, until a new packetizer is aligned on it.
+    A gap during a resync makes it stale, the resync thread starts again.
+    '''
+    way.resyncLock.acquire()
+    try:
+      way.state.setSearchMode()
+      way.state.resetSocket()
+      way.resyncGap += 1
+      way.resyncMissing += missing
+      if way.resyncThread is not None:
+        log.warning('%s: %d more bytes missing during the resynchronization'%(way.state.name, missing))
+        return
+      way.resyncThread = threading.Thread(target=self._resyncLoop, args=(way,), name='resync %s'%(way.state.name))
+      way.resyncThread.start()
+    finally:
+      way.resyncLock.release()
+    return
+
+  def _resyncLoop(self, way):
+    ''' resync way until no gap came during the last resync. '''
+    exact = True
+    while True:
+      way.resyncLock.acquire()
+      try:
+        if way.resyncing == way.resyncGap:
+          way.resyncing = None
+          way.resyncThread = None
+          return
+        way.resyncing = way.resyncGap
+        missing, way.resyncMissing = way.resyncMissing, 0
+      finally:
+        way.resyncLock.release()
+      # a stale resync did not activate the stream, the counter is lost
+      try:
+        exact = self._resync(way, missing, exact)
+      except Exception, e:
+        log.error('%s: resynchronization failed: %s'%(way.state.name, e))
+        exact = False
+
+  # we can re-read the session_state in the live process
+  canRefresh = True
+
+  def _resync(self, way, missing, exact=True):
+    ''' realign the cipher of way on the data after a gap of missing bytes.
+    AES-CTR first looks for the counter of the first packet after the gap, 
+    counting from the last packet the previous reader decrypted. Otherwise, 
+    the session_state is read again and the engine aligned on the next packets.
+    If not exact, the previous reader did not decrypt the data before the gap.
+
+    returns True if the stream is active again.
+    '''
+    name = way.state.name
+    old = way.packetizer
+    # the previous reader has the engine until it gets EOF
+    way.filewriter.finished.wait(RESYNC_TIMEOUT)
+    finished = way.filewriter.finished.isSet()
+    packetizer = Packetizer( way.state.getSocket() )
+    packetizer.set_log(logging.getLogger('%s.packetizer'%(name)))
+    ctr = hasattr(way.engine, 'getKeystreamBlock') and finished and exact
+    if ctr:
+      boundary, past, received = old.get_boundary()
+      # back to the counter of the last whole packet
+      way.engine.addCounter(-(past // way.engine.block_size))
+      distance = received - boundary + missing
+      self._attachEngine(packetizer, way.context, way.engine)
+    # one reader for the socket after the gap, whatever the alignment
+    self._follow(way, packetizer)
+    way.encrypted_flow = ''
+    if ctr:
+      if ctrGapAlign(way, distance, activate=not self.canRefresh) >= 0:
+        log.info(G+'[+] %s: resynchronized the counter after %d missing bytes'%(name, missing)+W)
+        return True
+      if way.resyncing != way.resyncGap:
+        return False
+      log.warning('%s: counter resynchronization failed'%(name))
+    elif not finished:
+      log.warning('%s: the reader before the gap did not finish'%(name))
+    if not self.canRefresh:
+      log.error('%s: can not resynchronize after %d missing bytes'%(name, missing))
+      return False
+    self._initCiphers()
+    receiveCtx,sendCtx = self.ciphers.getCiphers()
+    if way is self.inbound:
+      way.context = receiveCtx
+    else:
+      way.context = sendCtx
+    # the reader is registered, only its engine changes
+    way.engine = self._attachEngine(packetizer, way.context)
+    way.filewriter.engine = way.engine
+    # with the data the counter resync took from the stream
+    if alignEncryption(way, self._packetState(way), data=way.encrypted_flow) >= 0:
+      log.info(G+'[+] %s: resynchronized the session after %d missing bytes'%(name, missing)+W)
+      return True
+    return False
+
+  def _follow(self, way, packetizer):
+    ''' a new reader of way with packetizer, that continues the output files.
+    It is registered before the stream is activated, so that the stream never
+    blocks on a full socket. '''
+    way.packetizer = packetizer
+    way.filewriter = way.filewriter.follow(packetizer, way)
+    self.worker.add( way.state.getSocket(), way.filewriter.process, way.filewriter.pending, name=way.state.name )
+    return
+
   def _launchStreamProcessing(self):
     ''' run streams '''
     self.stream_t = threading.Thread(target=self.stream.run,name='stream' )
@@ -266,6 +426,7 @@ class OpenSSHLiveDecryptatator(OpenSSHKeysFinder):
     self._initSSH()
     self._initOutputs()
     self._initWorker()
+    self._initGapRecovery()
     log.info(G+'[+] Ready to catch some ssh traffic - please try `ls -l` in ssh if your just playing around...'+W)
     if self.autoalign:
       log.debug('trying to auto-align session keys and data')
@@ -300,9 +461,275 @@ class OpenSSHLiveDecryptatator(OpenSSHKeysFinder):
   def __str__(self):
     return "Decryption for pid %d, struct at 0x%lx"%(self.pid, self.session_state_addr)
 
-def alignEncryption(way, packet_state, block=True):
+class OpenSSHWorkerDecryptatator(OpenSSHLiveDecryptatator):
+  ''' 
+    Decrypt SSH traffic of a Live PID in a worker process.
+    The sniffer runs in another process, and feeds us TCP segments through 
+    a shared memory ring.SegmentQueue. 
+  '''
+  def __init__(self, pid, connection, queue, sessionStateAddr=None, backend=stream.BACKEND_SOCKET):
+    OpenSSHKeysFinder. __init__(self, pid)
+    self.scapy = None
+    self.session_state_addr = sessionStateAddr
+    self.connection = connection
+    self.queue = queue
+    self.inbound = Dummy()
+    self.outbound = Dummy()
+    self.autoalign = True
+    self.backend = backend
+    return
+
+  def _initSniffer(self):
+    ''' the sniffer is in the parent process '''
+    log.info(G+'[+] Sniffer is in process %d'%(os.getppid())+W)
+    return
+
+  def _initStream(self):
+    ''' create a stream on the shared queue, with its own gap timers '''
+    wheel = timers.TimerWheel()
+    wheel.start()
+    self.stream = stream.TCPStream(self.queue, self.connection, self.backend, wheel)
+    self.inbound.state = self.stream.getInbound()
+    self.outbound.state = self.stream.getOutbound()
+    log.debug('Streams loaded')
+    return
+
+  def __str__(self):
+    return "Decryption for pid %d, struct at 0x%lx in process %d"%(self.pid, self.session_state_addr, os.getpid())
+
+class OpenSSHReactorDecryptatator(OpenSSHLiveDecryptatator):
+  ''' 
+    Decrypt SSH traffic of a Live PID in one event loop, the output.Supervisor.
+    The sniffer is one of its handlers and triages segments inline into 
+    stream.BytePipe, the decryption of each direction runs in the Supervisor
+    workers. There is no sniffer nor stream thread, only the alignment threads
+    until they are done.
+  '''
+  def __init__(self, pid, sessionStateAddr=None, autoalign=True):
+    OpenSSHLiveDecryptatator.__init__(self, pid, sessionStateAddr, None, autoalign, stream.BACKEND_PIPE)
+    return
+
+  def _initSniffer(self):
+    ''' a sniffer in the handlers of the Supervisor '''
+    self.scapy = utils.makeSniffer(self.connection)
+    self.worker = output.Supervisor()
+    self.scapy.register(self.worker)
+    log.info(G+'[+] Sniffer online'+W)
+    return
+
+  def _launchStreamProcessing(self):
+    ''' start the event loop. The stream is triaged by the sniffer. '''
+    self.worker.start()
+    return
+
+  def _initWorker(self):
+    for way in (self.inbound, self.outbound):
+      self.worker.add( way.state.getSocket(), way.filewriter.process, way.filewriter.pending, name=way.state.name )
+    return
+
+  def loop(self):
+    # join() with a timeout, to get KeyboardInterrupt
+    while self.worker.isAlive():
+      self.worker.join(1)
+    self.scapy.close()
+    return
+
+
+def validPacketSize(packet_size, blocksize):
+  ''' the packet_size of a first block is below PACKET_MAX_SIZE, and blocks the packet '''
+  return 0 < packet_size <= PACKET_MAX_SIZE and (packet_size - (blocksize-4)) % blocksize == 0
+
+def ctrAlignCandidates(data, keystream, blocksize, end=None):
+  ''' yields the offsets of data where a CTR packet could start.
+  The keystream of the first block is the same at every offset, so there is no
+  need to decrypt anything: packet_size is data[i:i+4] ^ keystream[:4].
+  Offsets are checked up to end, len(data)-blocksize by default.
+  '''
+  if end is None:
+    end = len(data)-blocksize
+  if end <= 0:
+    return
+  ks = struct.unpack('>I', keystream[:4])[0]
+  # packet_size < 0x01000000, its first byte is 0 in clear, so data[i] == keystream[0].
+  # str.find skips the 255/256 other offsets at memchr speed.
+  first = keystream[0]
+  i = data.find(first, 0, end)
+  while i != -1:
+    if validPacketSize(struct.unpack_from('>I', data, i)[0] ^ ks, blocksize):
+      yield i
+    i = data.find(first, i+1, end)
+  return
+
+def ctrScanBack(data, key, counter, end, mac_len, blocksize, kStart, kStop):
+  ''' returns the smallest k in [kStart, kStop) for which a packet of k blocks
+  and its mac end at data[end], or None.
+  key is the AES_KEY as a str, counter is the CTR counter of the block at end,
+  as an int. The packet would start at end-mac_len-k*blocksize, with the counter
+  counter-k. That is an exact check on packet_size, plus the padding length.
+  '''
+  from engine import libopenssl
+  aes_key = ctypes.create_string_buffer(key, len(key))
+  ctr = ctypes.create_string_buffer(blocksize)
+  ks = ctypes.create_string_buffer(blocksize)
+  modulo = 1 << (8*blocksize)
+  for k in xrange(kStart, kStop):
+    i = end - mac_len - k*blocksize
+    if i < 0:
+      break
+    ctr.raw = ('%0*x'%(2*blocksize, (counter - k) % modulo)).decode('hex')
+    libopenssl.AES_encrypt(ctr, ks, aes_key)
+    packet_size, padding = struct.unpack_from('>IB', data, i)
+    packet_size ^= struct.unpack_from('>I', ks.raw)[0]
+    padding ^= ord(ks.raw[4])
+    if packet_size == k*blocksize-4 and 4 <= padding < packet_size:
+      return k
+  return None
+
+def _ctrScanBack(args):
+  ''' ctrScanBack for multiprocessing.Pool.imap '''
+  return ctrScanBack(*args)
+
+def ctrGapCandidates(engine, data, distance, mac_len, end=None):
+  ''' yields (i, k) where a CTR packet could start at data[i], k blocks after 
+  the counter of engine. engine is on a packet boundary, distance bytes of the
+  stream before data[0].
+  The bytes in between are n whole packets of at least one block, and their n
+  macs that are not encrypted. So distance+i == k*blocksize + n*mac_len. 
+  Candidates come by increasing k, which is the order of the packets.
+  Offsets are checked up to end, len(data)-blocksize by default.
+  '''
+  blocksize = engine.block_size
+  if end is None:
+    end = len(data)-blocksize
+  if end <= 0:
+    return
+  kStart = distance // (blocksize + mac_len)
+  kStop = (distance + end - mac_len) // blocksize + 1
+  if kStop - kStart > RESYNC_MAX_BLOCKS:
+    log.warning('%d counter values to try after a gap of %d bytes, that is too many'%(kStop - kStart, distance))
+    return
+  engine = engine.clone()
+  engine.addCounter(kStart)
+  for k in xrange(kStart, kStop):
+    keystream = engine.getKeystreamBlock()
+    engine.incCounter()
+    first = keystream[0]
+    ks = struct.unpack('>I', keystream[:4])[0]
+    base = k*blocksize - distance
+    if mac_len == 0:
+      offsets = [base] if 0 <= base < end and data[base] == first else []
+    else:
+      # 1 <= n <= k and 0 <= base + n*mac_len < end
+      nStart = max(1, -(base // mac_len))
+      nStop = min(k, (end - 1 - base) // mac_len)
+      if nStop < nStart:
+        continue
+      start = base + nStart*mac_len
+      # the packet_size first byte is 0 in clear, str.find skips the other offsets
+      column = data[start:base + nStop*mac_len + 1:mac_len]
+      offsets = []
+      j = column.find(first)
+      while j != -1:
+        offsets.append(start + j*mac_len)
+        j = column.find(first, j+1)
+    for i in offsets:
+      if validPacketSize(struct.unpack_from('>I', data, i)[0] ^ ks, blocksize):
+        yield i, k
+  return
+
+def decryptAlignCandidates(way, data, blocksize):
+  ''' yields the offsets of data where a packet could start, by decrypting 
+  the first block at every offset. For the chained modes.
+  '''
+  engine = way.engine
+  initial = engine.snapshot()
+  for i in range(0, len(data)-blocksize):
+    header = engine.decrypt( data[i:i+blocksize] )
+    packet_size = struct.unpack('>I', header[:4])[0]
+    # reset engine to initial state
+    engine.restore(initial)
+    if validPacketSize(packet_size, blocksize):
+      yield i
+  return
+
+def alignCandidates(way, data):
+  ''' yields the offsets of data where a packet could start '''
+  blocksize = way.engine.block_size
+  if hasattr(way.engine, 'getKeystreamBlock'):
+    return ctrAlignCandidates(data, way.engine.getKeystreamBlock(), blocksize)
+  return decryptAlignCandidates(way, data, blocksize)
+
+def validateAlignment(way, data, offset, length=None, engine=None):
+  ''' decrypts the headers of the packets following data[offset:], on a clone 
+  of engine, way.engine by default, and checks their packet_size, padding 
+  length and message type.
+  
+  returns True if length packets are consistent, False if one is not, 
+  and None if data ends before that.
+  '''
+  if length is None:
+    length = ALIGN_CHAIN_LENGTH
+  if engine is None:
+    engine = way.engine
+  engine = engine.clone()
+  blocksize = engine.block_size
+  mac_len = 0
+  if way.context.mac is not None:
+    mac_len = way.context.mac.mac_len
+  # the message type is compressed with the payload
+  compressed = way.context.comp.enabled != 0
+  for n in range(length):
+    if offset+blocksize > len(data):
+      return None
+    header = engine.decrypt( data[offset:offset+blocksize] )
+    packet_size, padding, msg_type = struct.unpack('>IBB', header[:6])
+    if not validPacketSize(packet_size, blocksize) or not 4 <= padding <= packet_size-2:
+      return False
+    if not compressed and not 0 < msg_type <= MSG_TYPE_MAX:
+      return False
+    if n == length-1:
+      break
+    end = offset+4+packet_size
+    if end > len(data):
+      return None
+    # move the engine to the next packet
+    engine.decrypt( data[offset+blocksize:end] )
+    offset = end+mac_len
+  return True
+
+def _setActiveMode(way, data=None):
+  ''' activates the stream of way, unless a gap came since the resync that
+  aligned it started. returns False if the alignment is stale. '''
+  lock = getattr(way, 'resyncLock', None)
+  if lock is None:
+    way.state.setActiveMode(data)
+    return True
+  lock.acquire()
+  try:
+    if way.resyncing is not None and way.resyncing != way.resyncGap:
+      log.warning('%s: another gap came, dropping the alignment'%(way.state.name))
+      return False
+    way.state.setActiveMode(data)
+  finally:
+    lock.release()
+  return True
+
+def _activate(way, data, i, index):
+  ''' activate the stream on an alignment at data[i:]. returns index, or -1 '''
+  if not _setActiveMode(way, data[i:]):
+    return -1
+  log.info('Alignement made on index %d'%(index))
+  # saving the index
+  way.offset = index
+  # save previous data
+  way.encrypted_flow+=data[:i]
+  return index
+
+def alignEncryption(way, packet_state, block=True, activate=True, data=''):
   ''' 
     try to align the engine on the stream before activating it. 
+    If activate is False, the stream stays in search mode when alignment fails.
+    data was already taken from the stream, it goes before the queued data.
     
     Question is: how do we know, at what offset of a packet the session keys state are.
     If there is no traffic beween the sniffer's start and alignTest(), the offset is 0 and obvious.
@@ -329,6 +756,7 @@ def alignEncryption(way, packet_state, block=True):
 
     => reality kills theory - occurence of bad offset with valid tests has been seen in tests 
     so much for the stats. On big packets (1500) , 10 occurrences on 1100 packets . @see packet truncation by scapy.
+    => each candidate is validated on the headers of the ALIGN_CHAIN_LENGTH next packets.
   '''
   # way.engine way.state
   name = threading.currentThread().name
@@ -341,11 +769,13 @@ def alignEncryption(way, packet_state, block=True):
   if packet_state.offset != packet_state.end: # the session_state has been captured while encryption was taking place
     log.error("%s: openssh was in the middle of processing a packet. I can't deal with that "%(name))
     log.warning(packet_state.toString())
-    way.state.setActiveMode() # it's gonna fail...
+    if activate:
+      _setActiveMode(way) # it's gonna fail...
     return -1
   # head 
   try:
-    data, qsize = way.state.getFirstPacketData(block=block)
+    if len(data) == 0:
+      data, qsize = way.state.getFirstPacketData(block=block)
     nbp = 1
     #if qsize > 1: # crowded traffic, lets cut to the point.
     #  for i in xrange(1, qsize/3):
@@ -355,65 +785,107 @@ def alignEncryption(way, packet_state, block=True):
     #  data, qsize = way.state.getFirstPacketData(block=block)
     #  nbp += 1
   except Queue.Empty,e:
-    way.state.setActiveMode() # it's on...
+    if activate:
+      _setActiveMode(way) # it's on...
     return -1
   # rest
+  blocksize = way.engine.block_size
   while True:
     log.debug('%s: packet next %d'%(name, nbp))
-    blocksize = way.engine.block_size
-    # try to find a packetlen
-    read_offset = 1 # len(data) # check only start of packet
-    #for i in range(0, len(data)-blocksize, len(data) ): # check only start of packet
-    for i in range(0, len(data)-blocksize, read_offset ): # check all offsets
     # tests shows Message are often data[blocksize:] 
-    # is that because data = data[len(data)-blocksize:] ???
-    #for i in range(0, len(data)-blocksize, blocksize ): 
-      #log.debug('trying index %d'%(i))
-      header = way.engine.decrypt( data[i:i+blocksize] )
-      packet_size = struct.unpack('>I', header[:4])[0]
-      # reset engine to initial state
-      way.engine.sync(way.context)
-      if  0 < packet_size <= PACKET_MAX_SIZE:
-        log.debug('%s: Auto align done: We found a acceptable packet size(%d) at %d on packet num %d'%(name, packet_size, i, nbp))
-        if (packet_size - (blocksize-4)) % blocksize == 0 :
-          log.debug('%s: Auto align found : packet size(%d) at %d on packet num %d '%(name, packet_size, i, nbp))
-          log.info('Alignement made on index %d'%(index))
-          way.state.setActiveMode(data[i:])
-          # saving the index
-          way.offset = index
-          # save previous data
-          way.encrypted_flow+=data[:i]
-          return index
-          # continue for test debug
-        else:
-          log.debug('%s: bad blocking packetsize %d is not correct for blocksize'%(name, (packet_size - (blocksize-4)) % blocksize))    
-      # goto next byte
-      index += read_offset
-    # save previous data
-    way.encrypted_flow+=data[:len(data)-blocksize]
-    data = data[len(data)-blocksize:]
-    #data = ''
+    pending = None
+    for i in alignCandidates(way, data):
+      valid = validateAlignment(way, data, i)
+      if valid is None:
+        pending = i
+        break
+      elif valid:
+        log.debug('%s: Auto align found : packet at %d on packet num %d '%(name, i, nbp))
+        return _activate(way, data, i, index+i)
+      log.debug('%s: inconsistent packets after %d on packet num %d '%(name, i, nbp))
+    if pending is not None:
+      # keep the data from that candidate, until the next packets validate it
+      index += pending
+      way.encrypted_flow+=data[:pending]
+      data = data[pending:]
+    else:
+      index += max(0, len(data)-blocksize)
+      # save previous data
+      way.encrypted_flow+=data[:len(data)-blocksize]
+      data = data[len(data)-blocksize:]
     log.debug('%s: trying next packet '%(name))
     try:
-      d, qsize = way.state.getFirstPacketData(block=False)
+      d, qsize = way.state.getFirstPacketData(block=pending is not None, timeout=ALIGN_TIMEOUT)
       data += d
       nbp += 1
     except Queue.Empty,e:
+      if pending is not None:
+        log.warning('%s: no traffic to validate the alignment after %d tries, using it anyway'%(name, nbp))
+        return _activate(way, data, 0, index)
       log.warning('%s: no packets waiting for us after %d tries, offset is long gone... alignEncryption failed'%(name, nbp))
-      way.state.setActiveMode() # it's gonna fail...
+      if activate:
+        _setActiveMode(way) # it's gonna fail...
       return -1
     pass
 
+def ctrGapAlign(way, distance, activate=True):
+  ''' aligns the CTR engine of way on the first packet after a gap, and 
+  activates the stream. The engine is on the packet boundary distance bytes
+  before the data queued after the gap, its counter is moved to the packet found.
+  If activate is False, the stream stays in search mode when alignment fails,
+  and the data taken from the stream is left in way.encrypted_flow for another
+  alignment.
+  
+  returns the index of the packet in the data after the gap, or -1.
+  '''
+  name = threading.currentThread().name
+  mac_len = 0
+  if way.context.mac is not None:
+    mac_len = way.context.mac.mac_len
+  way.encrypted_flow = ''
+  data = ''
+  while len(data) < RESYNC_WINDOW + way.engine.block_size:
+    try:
+      d, qsize = way.state.getFirstPacketData(timeout=ALIGN_TIMEOUT)
+      data += d
+    except Queue.Empty,e:
+      break
+  end = min(len(data) - way.engine.block_size, RESYNC_WINDOW)
+  for i, k in ctrGapCandidates(way.engine, data, distance, mac_len, end):
+    engine = way.engine.clone()
+    engine.addCounter(k)
+    valid = validateAlignment(way, data, i, engine=engine)
+    while valid is None:
+      try:
+        d, qsize = way.state.getFirstPacketData(timeout=ALIGN_TIMEOUT)
+        data += d
+        valid = validateAlignment(way, data, i, engine=engine)
+      except Queue.Empty,e:
+        log.warning('%s: no traffic to validate the alignment after the gap, using it anyway'%(name))
+        valid = True
+    if valid:
+      log.debug('%s: packet at %d after the gap, %d blocks after the last one'%(name, i, k))
+      way.engine.addCounter(k)
+      return _activate(way, data, i, i)
+  log.warning('%s: no packet after the gap of %d bytes'%(name, distance))
+  if activate:
+    _setActiveMode(way) # it's gonna fail...
+  else:
+    way.encrypted_flow = data
+  return -1
+
+
 class OpenSSHPcapDecrypt(OpenSSHLiveDecryptatator):
   ''' 
   Decrypt ssh traffic from a dumped session_state and a pcap capture.
   '''
-  def __init__(self, pcapfilename, connection, ssfile):
+  def __init__(self, pcapfilename, connection, ssfile, backend=stream.BACKEND_SOCKET):
     self.scapy = None
     self.session_state_addr = None
     self.inbound = Dummy()
     self.outbound = Dummy()
     self.autoalign = True
+    self.backend = backend
     # now...
     self.ssfile = ssfile
     self.pcapfilename = pcapfilename
@@ -429,6 +901,9 @@ class OpenSSHPcapDecrypt(OpenSSHLiveDecryptatator):
     log.debug('sniffer created: %s'%(self.scapy))
     return
   
+  # the session_state is a file
+  canRefresh = False
+
   def _initCiphers(self):
     ''' ptrace the ssh process to get sessions keys '''
     import sslsnoop.ctypes_openssh
@@ -455,17 +930,52 @@ class OpenSSHPcapDecrypt(OpenSSHLiveDecryptatator):
     self.worker.run()
     return
 
-def launchLiveDecryption(pid, sniffer, addr=None): 
+def launchLiveDecryption(pid, sniffer, addr=None, backend=stream.BACKEND_SOCKET): 
   ''' launch a live decryption '''
   # sniffer is a running thread
   # when ready, will have to launch tcpstream as a Thread
-  decryptatator = OpenSSHLiveDecryptatator(pid, sessionStateAddr=addr, scapyThread=sniffer )
+  decryptatator = OpenSSHLiveDecryptatator(pid, sessionStateAddr=addr, scapyThread=sniffer, backend=backend )
   decryptatator.run()
   return
 
-def launchPcapDecryption(pcap, connection, ssfile): 
+def launchReactorDecryption(pid, addr=None):
+  ''' launch a live decryption in one event loop '''
+  decryptatator = OpenSSHReactorDecryptatator(pid, sessionStateAddr=addr)
+  decryptatator.run()
+  return
+
+def _runWorkerDecryption(pid, connection, queue, addr, backend):
+  decryptatator = OpenSSHWorkerDecryptatator(pid, connection, queue, sessionStateAddr=addr, backend=backend)
+  decryptatator.run()
+  return
+
+def launchProcessDecryption(pid, sniffer, addr=None, backend=stream.BACKEND_SOCKET): 
+  ''' launch a live decryption in a worker process.
+  Capture stays in this process, reassembly and decryption happen in the worker.
+  If sniffer is None, a new one is started after the fork.
+
+  @return: the worker multiprocessing.Process
+  '''
+  connection = utils.getConnectionForPID(pid)
+  if not connection:
+    raise ValueError('No ESTABLISHED connection for pid %d'%(pid))
+  start = sniffer is None
+  if start:
+    sniffer = utils.makeSniffer(connection)
+    sniffer.thread = threading.Thread(target=sniffer.run, name='scapy')
+  queue = sniffer.makeSharedStream(connection)
+  worker = multiprocessing.Process(target=_runWorkerDecryption, args=(pid, connection, queue, addr, backend),
+                                   name='decrypt-%d'%(pid))
+  worker.start()
+  log.info(G+'[+] Decryption of pid %d in process %d'%(pid, worker.pid)+W)
+  # fork before starting the sniffer thread
+  if start:
+    sniffer.thread.start()
+  return worker
+
+def launchPcapDecryption(pcap, connection, ssfile, backend=stream.BACKEND_SOCKET): 
   ''' launch a decryption from a pcap file and a session state '''
-  decryptatator = OpenSSHPcapDecrypt(pcap, connection, ssfile)
+  decryptatator = OpenSSHPcapDecrypt(pcap, connection, ssfile, backend)
   decryptatator.run()
   return
 
@@ -478,11 +988,19 @@ def argparser():
   parser = argparse.ArgumentParser(prog='sshsnoop', description='Live decription of Openssh traffic.')
   parser.add_argument('--debug', action='store_const', const=True, default=False, help='debug mode')
   parser.add_argument('--quiet', action='store_const', const=True, default=False, help='quiet mode')
+  parser.add_argument('--backend', type=str, choices=stream.BACKENDS, default=stream.BACKEND_SOCKET, 
+                      help='how reassembled TCP data goes to the decrypter: socketpair or in-memory pipe')
 
   subparsers = parser.add_subparsers(help='sub-command help')
   live_parser = subparsers.add_parser('live', help='Decrypts traffic from a live PID.')
   live_parser.add_argument('pid', type=int, help='Target PID')
   live_parser.add_argument('--addr', type=str, help='active_context memory address')
+  live_parser.add_argument('--processes', action='store_const', const=True, default=False, 
+                      help='decrypt in a worker process, out of the sniffer GIL')
+  live_parser.add_argument('--loop', action='store_const', const=True, default=False, 
+                      help='capture and decrypt in one event loop, with the in-memory pipe backend')
+  live_parser.add_argument('--sessionlog', type=str, default=None, 
+                      help='also record all the decrypted messages in that session log file')
   live_parser.set_defaults(func=search)
 
   offline_parser = subparsers.add_parser('offline', help='Decrypts traffic from a pcap file, given a pickled session state.')
@@ -512,14 +1030,30 @@ def search(args):
   addr = None
   if args.addr != None:
     addr = int(args.addr,16)
-  launchLiveDecryption(pid, None, addr=addr)
+  if args.sessionlog is not None:
+    if args.processes:
+      log.error('--sessionlog is written by one process, it can not be used with --processes')
+      return
+    OpenSSHLiveDecryptatator.sessionLog = sessionlog.SessionLogWriter(args.sessionlog)
+  try:
+    if args.processes:
+      worker = launchProcessDecryption(pid, None, addr=addr, backend=args.backend)
+      worker.join()
+    elif args.loop:
+      launchReactorDecryption(pid, addr=addr)
+    else:
+      launchLiveDecryption(pid, None, addr=addr, backend=args.backend)
+  finally:
+    # writes the index of the session log
+    if OpenSSHLiveDecryptatator.sessionLog is not None:
+      OpenSSHLiveDecryptatator.sessionLog.close()
   sys.exit(0)
   return
 
 def searchOffline(args):
   import utils 
   connection = utils.Connection(args.src,args.sport, args.dst,args.dport)
-  launchPcapDecryption(args.pcapfile.name, connection, args.sessionstatefile)
+  launchPcapDecryption(args.pcapfile.name, connection, args.sessionstatefile, args.backend)
   sys.exit(0)
   return
 
@@ -127,7 +127,7 @@ class OpenvpnLiveDecryptatator(OpenvpnKeysFinder):
     self.inbound['packetizer'].set_log(logging.getLogger('inbound.packetizer'))
     self.inbound['engine'] = self.activate_cipher(self.inbound['packetizer'], receiveCtx )
     name = 'ssh-%s'%( connectionToString(self.stream.connection) )
-    self.inbound['filewriter'] =  output.SSHStreamToFile(self.inbound['packetizer'], self.inbound, name)
+    self.inbound['filewriter'] =  output.SSHStreamToFile(self.inbound['packetizer'], self.inbound, name, block=False)
 
     # out bound
     log.info('activate OUTBOUND send')
@@ -137,7 +137,7 @@ class OpenvpnLiveDecryptatator(OpenvpnKeysFinder):
     self.outbound['packetizer'].set_log(logging.getLogger('outbound.packetizer'))
     self.outbound['engine'] = self.activate_cipher(self.outbound['packetizer'], self.outbound['context'] )
     name = 'ssh-%s'%( connectionToString(self.stream.connection, reverse=True) )
-    self.outbound['filewriter'] =  output.SSHStreamToFile(self.outbound['packetizer'], self.outbound, name)
+    self.outbound['filewriter'] =  output.SSHStreamToFile(self.outbound['packetizer'], self.outbound, name, block=False)
     
     # worker to watch out for data for decryption
     self.worker = output.Supervisor()
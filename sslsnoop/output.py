@@ -6,6 +6,10 @@
 
 __author__ = "Loic Jaquemet loic.jaquemet+python@gmail.com"
 
+import atexit
+import collections
+import copy
+import errno
 import os
 import logging
 import sys
@@ -15,6 +19,7 @@ import select
 import socket
 import pickle
 import threading
+import Queue
 from threading import Thread
 
 from paramiko_packet import NeedRekeyException
@@ -22,11 +27,22 @@ from paramiko.ssh_exception import SSHException
 from paramiko.common import *
 
 from stream import MissingDataException
+from lrucache import LRUCache
+import sessionlog
 
 
 log=logging.getLogger('output')
 
 MAX_KEYS=255
+# handler calls per socket in a round of the Supervisor
+HANDLER_BUDGET=4
+# threads running the Supervisor handlers. 0 runs them in the Supervisor thread.
+WORKERS=4
+# channel data is written out when a file buffers that much, or that old
+WRITE_BUFFER_SIZE=64*1024
+WRITE_DELAY=1.0
+# output files kept open, for all the streams
+MAX_OPEN_FILES=64
 
 
 class FileWriter:
@@ -50,6 +66,145 @@ class FileWriter:
     pickle.dump(instance)
     return fname
 
+class ChannelFiles:
+  ''' Buffered appends to many output files, through a bounded pool of file
+    descriptors.
+    The data of a file is kept in memory until it holds bufferSize bytes or
+    is delay seconds old, then written in one syscall. The least recently
+    written files are closed past maxOpen, and reopened in append mode.
+    A daemon thread flushes the old buffers of idle files.
+  '''
+  def __init__(self, bufferSize=WRITE_BUFFER_SIZE, delay=WRITE_DELAY, maxOpen=MAX_OPEN_FILES):
+    self.bufferSize = bufferSize
+    self.delay = delay
+    # name: [chunks, size, time of the first chunk]
+    self.buffers = dict()
+    # files already truncated, they are appended to from now on
+    self.created = set()
+    self.fds = LRUCache(maxOpen, onEvict=self._evict)
+    self.lock = threading.RLock()
+    self.writes = 0
+    self.thread = None
+    return
+
+  def _evict(self, name, fd):
+    log.debug('closing idle output %s'%(name))
+    os.close(fd)
+
+  def _fd(self, name):
+    if name in self.fds:
+      return self.fds[name]
+    flags = os.O_WRONLY|os.O_CREAT|os.O_APPEND
+    if name not in self.created:
+      flags |= os.O_TRUNC
+      self.created.add(name)
+      log.info("New Output Filename is %s"%(name))
+    fd = os.open(name, flags, 0644)
+    self.fds[name] = fd
+    return fd
+
+  def _flush(self, name):
+    buf = self.buffers.pop(name, None)
+    if buf is None:
+      return
+    # python2 has no os.writev, a join is one copy and one syscall
+    data = ''.join(buf[0])
+    fd = self._fd(name)
+    offset = 0
+    while offset < len(data):
+      offset += os.write(fd, buffer(data, offset))
+    self.writes += 1
+    return
+
+  def write(self, name, data):
+    ''' buffers data for the file name. returns len(data) '''
+    self.lock.acquire()
+    try:
+      buf = self.buffers.get(name)
+      if buf is None:
+        buf = self.buffers[name] = [[], 0, time.time()]
+        self._startFlusher()
+      buf[0].append(data)
+      buf[1] += len(data)
+      if buf[1] >= self.bufferSize:
+        self._flush(name)
+    finally:
+      self.lock.release()
+    return len(data)
+
+  def flush(self, name=None):
+    ''' writes out the buffer of name, or of all the files '''
+    self.lock.acquire()
+    try:
+      if name is not None:
+        self._flush(name)
+      else:
+        for name in self.buffers.keys():
+          self._flush(name)
+    finally:
+      self.lock.release()
+    return
+
+  def flushExpired(self):
+    ''' writes out the buffers older than delay. '''
+    limit = time.time() - self.delay
+    self.lock.acquire()
+    try:
+      for name in [n for n, buf in self.buffers.items() if buf[2] <= limit]:
+        self._flush(name)
+    finally:
+      self.lock.release()
+    return
+
+  def close(self, name):
+    ''' flushes and closes the file name. A later write reopens it. '''
+    self.lock.acquire()
+    try:
+      self._flush(name)
+      if name in self.fds:
+        os.close(self.fds[name])
+        del self.fds[name]
+    finally:
+      self.lock.release()
+    return
+
+  def closeAll(self):
+    ''' flushes all the buffers, which may reopen files, then closes them '''
+    self.lock.acquire()
+    try:
+      self.flush()
+      for name in list(self.fds):
+        self.close(name)
+    finally:
+      self.lock.release()
+    return
+
+  def _startFlusher(self):
+    if self.thread is None:
+      self.thread = threading.Thread(target=self._flusher, name='flusher')
+      self.thread.daemon = True
+      self.thread.start()
+    return
+
+  def _flusher(self):
+    while True:
+      time.sleep(self.delay/2)
+      try:
+        self.flushExpired()
+      except (IOError, OSError), e:
+        log.error('flushing outputs: %s'%(e))
+    return
+
+_channelFiles = None
+def channelFiles():
+  ''' the ChannelFiles shared by all the stream writers '''
+  global _channelFiles
+  if _channelFiles is None:
+    _channelFiles = ChannelFiles()
+    atexit.register(_channelFiles.closeAll)
+  return _channelFiles
+
+
 class SSHStreamToFile():
   ''' Pipes the data from a (ssh) socket into a different file for each packet type. 
     supposedly, this would demux channels into files.
@@ -57,27 +212,59 @@ class SSHStreamToFile():
      between upload and download.
   '''
   BUFSIZE=4096
-  def __init__(self, packetizer, ctx, basename, folder='outputs', fmt="%Y%m%d-%H%M%S"):
+  def __init__(self, packetizer, ctx, basename, folder='outputs', fmt="%Y%m%d-%H%M%S", files=None, block=True):
+    ''' without block, process() returns when the socket holds no whole 
+    packet, it is called again on the next data. Supervisor handlers must not
+    block, a handler waiting in a worker for the end of a packet holds the 
+    worker. '''
     self.packetizer = packetizer
+    self.block = block
     self.datename = "%s"%time.strftime(fmt,time.gmtime())
     self.fname = os.path.sep.join([folder,basename])
-    self.outs = dict()
+    if files is None:
+      files = channelFiles()
+    self.files = files
+    # the names of our output files
+    self.outs = set()
     self.engine = ctx.engine
     self.socket = ctx.state.getSocket()
     ##
     self.lastMessage=None
     self.decrypt_errors=0
+    # the packetizer stopped on its batch size, it may hold more messages
+    self.more = False
+    # set when the socket is closed
+    self.finished = threading.Event()
     return
 
+  def follow(self, packetizer, ctx):
+    ''' returns a new writer for the packetizer of ctx, that continues our 
+    output files. '''
+    writer = copy.copy(self) # shares self.outs and self.files
+    writer.packetizer = packetizer
+    writer.engine = ctx.engine
+    writer.socket = ctx.state.getSocket()
+    writer.lastMessage = None
+    writer.decrypt_errors = 0
+    writer.more = False
+    writer.finished = threading.Event()
+    return writer
+
   def _outputStream(self, channel):
     name="%s.%s.%d"%(self.fname, self.datename, channel )
-    if name in self.outs:
-      return self.outs[name]
-    else:
-      self.outs[name] = io.FileIO(name , 'w' )
-      log.info("New Output Filename is %s"%(name))
+    self.outs.add(name)
     log.debug("Output Filename is %s"%(name))
-    return self.outs[name]
+    return name
+
+  def close(self):
+    ''' flushes and closes our output files '''
+    for name in self.outs:
+      self.files.close(name)
+    return
+
+  def pending(self):
+    ''' True if the last read may have left complete messages in the packetizer '''
+    return self.more
 
   def process(self):
     try:
@@ -90,23 +277,21 @@ class SSHStreamToFile():
       #self.decrypt_errors+=1
       log.error('SSH exception catched on %s - %s - killing this channel'%(self.fname,e))
       #return
+      self.close()
+      self.finished.set()
       raise EOFError(e)
+    except EOFError:
+      self.close()
+      self.finished.set()
+      raise
 
 
   def _process(self):
-    ''' m can be rewind()-ed , __str__ ()-ed or others...
-  '''
-    _expected_packet = tuple()
+    ''' reads all the messages available and process them.
+    returns the last message.
+    '''
     try:
-      ptype, m = self.packetizer.read_message()
-      self.lastMessage=m
-      chanid = m.get_int()
-      log.debug('Got msg:%d for channel:%d value:%s'%(ptype, chanid, repr(m)))
-      m.rewind()
-      #log.error("now  message was (%d) : %s"%(len(str(m)),repr(str(m))) )
-      #self.lastCounter=self.engine.getCounter()
-      if ptype != MSG_CHANNEL_DATA: # MSG_CHANNEL_DATA
-        log.debug("===================== ptype:%d len:%d "%(ptype, len(str(m)) ) )
+      messages = self.packetizer.read_messages(block=self.block)
     except NeedRekeyException,e:
       log.warning('=============================== Please refresh keys for rekey')
       return e
@@ -117,6 +302,25 @@ class SSHStreamToFile():
     except MissingDataException, e:
       log.warning('=============================== Missing data. Please refresh keys for rekey')
       return e
+    self.more = len(messages) >= self.packetizer.BATCH_MAX_MESSAGES
+    ret = None
+    for ptype, m in messages:
+      ret = self._processMessage(ptype, m)
+    return ret
+
+  def _processMessage(self, ptype, m):
+    ''' m can be rewind()-ed , __str__ ()-ed or others...
+  '''
+    _expected_packet = tuple()
+    self.lastMessage=m
+    if log.isEnabledFor(logging.DEBUG):
+      chanid = m.get_int()
+      log.debug('Got msg:%d for channel:%d value:%s'%(ptype, chanid, repr(m)))
+      m.rewind()
+    #log.error("now  message was (%d) : %s"%(len(str(m)),repr(str(m))) )
+    #self.lastCounter=self.engine.getCounter()
+    if ptype != MSG_CHANNEL_DATA: # MSG_CHANNEL_DATA
+      log.debug("===================== ptype:%d len:%d "%(ptype, len(str(m)) ) )
       
     if ptype == MSG_IGNORE:
       log.warning('================================== MSG_IGNORE')
@@ -145,11 +349,37 @@ class SSHStreamToFile():
     if ptype == MSG_CHANNEL_DATA:
       chanid = m.get_int()
       out=self._outputStream(chanid)
-      ret=out.write( str(m.get_string()) ) # TODO: as this is a PoC we assume its printable characters by default on channel_data
-      out.flush() # beuahhh
+      ret=self.files.write(out, str(m.get_string()) ) # TODO: as this is a PoC we assume its printable characters by default on channel_data
       log.debug("%d bytes written for channel %d"%(ret, ptype))
     return m
 
+class SSHStreamToLog(SSHStreamToFile):
+  ''' Records all the messages of a stream in a sessionlog.SessionLogWriter, 
+    with their sequence number, type and channel. The channel data is still 
+    written to the channel files.
+  '''
+  def __init__(self, packetizer, ctx, basename, writer, connection, direction, folder='outputs', fmt="%Y%m%d-%H%M%S", files=None):
+    SSHStreamToFile.__init__(self, packetizer, ctx, basename, folder=folder, fmt=fmt, files=files)
+    self.writer = writer
+    self.connection = writer.connection(connection)
+    self.direction = direction
+    return
+
+  def _processMessage(self, ptype, m):
+    channel = sessionlog.NO_CHANNEL
+    # the recipient channel comes first, but in MSG_CHANNEL_OPEN
+    if MSG_CHANNEL_OPEN_SUCCESS <= ptype <= MSG_CHANNEL_FAILURE:
+      channel = m.get_int()
+      m.rewind()
+    self.writer.write(self.connection, self.direction, getattr(m, 'seqno', 0), ptype, channel, str(m))
+    return SSHStreamToFile._processMessage(self, ptype, m)
+
+  def close(self):
+    SSHStreamToFile.close(self)
+    self.writer.flush()
+    return
+
+
 class pcapWriter():
   ''' Use scapy to write a data packet to a pcap file '''
   def __init__(self,fname,src,sport,dst,dport):
@@ -171,79 +401,290 @@ class SSHStreamToPcap(SSHStreamToFile):
     SSHStreamToFile.__init__(self, packetizer, ctx, basename, folder='outputs', fmt="%Y%m%d-%H%M%S")
     self.fname = os.path.sep.join([self.fname,'pcap'])
     self.pcapwriter = pcapWriter(name, src,sport,dst,dport)
-  def _outputStream(self, channel):
-    name="%s.%s.%d"%(self.fname, self.datename, channel )
-    log.debug("Output Filename is %s"%(name))
-    return self.pcapwriter
+  def _processMessage(self, ptype, m):
+    if ptype != MSG_CHANNEL_DATA:
+      return SSHStreamToFile._processMessage(self, ptype, m)
+    self.lastMessage=m
+    chanid = m.get_int()
+    self.pcapwriter.write( str(m.get_string()) )
+    return m
 
   
+class Handler(object):
+  ''' A socket registered in the Supervisor, with its service statistics '''
+  __slots__ = ('socket', 'fd', 'handler', 'pending', 'budget', 'name', 'interval', 'due',
+               'busy', 'dirty', 'queuedAt', 'calls', 'service', 'maxService', 'runs', 'wait', 'maxWait')
+  def __init__(self, socket_, handler, pending, budget, name, interval=None):
+    self.socket = socket_
+    self.fd = socket_.fileno()
+    self.handler = handler
+    self.pending = pending
+    self.budget = budget
+    self.name = name
+    self.interval = interval
+    self.due = None
+    if interval is not None:
+      self.due = time.time() + interval
+    self.busy = False # queued or running in a worker
+    self.dirty = False # an event came while busy
+    self.queuedAt = 0
+    self.calls = 0
+    self.service = 0.0
+    self.maxService = 0.0
+    self.runs = 0
+    self.wait = 0.0
+    self.maxWait = 0.0
+
+  def stats(self):
+    return dict(calls=self.calls, service=self.service, maxService=self.maxService, 
+                runs=self.runs, wait=self.wait, maxWait=self.maxWait)
+
+  def __repr__(self):
+    return '<Handler %s fd:%d calls:%d>'%(self.name, self.fd, self.calls)
+
+
 class Supervisor(threading.Thread):
-  def __init__(self ):
+  ''' Runs the handlers of the sockets that have data to read.
+    Sockets are registered edge-triggered on an epoll. A ready socket stays 
+    ready until it is drained, and its handler is called at most budget times
+    in a row, so that a bulk transfer does not starve the interactive channels.
+
+    With workers, ready handlers run in a pool of threads. A handler is never
+    run by two workers at once, as the cipher state of a direction is 
+    sequential. Otherwise, they run in the Supervisor thread.
+
+    Handlers must not block when there is nothing to read, or only a part of
+    a message: a handler waiting for the rest holds its worker. Handlers with
+    an interval are also run periodically.
+  '''
+  def __init__(self, workers=WORKERS, useEpoll=hasattr(select, 'epoll')):
+    threading.Thread.__init__(self, name='supervisor')
     self.stopSwitch=threading.Event()
-    self.readables=dict()
-    self.selectables=set()
-    self._readables=dict()
-    self._selectables=set()
+    self.handlers=dict() # fd: Handler
+    self.ready=collections.deque()
     self.lock=threading.Lock()
-    self.todo=False
+    if useEpoll:
+      self.poller = select.epoll()
+      self._mask = select.EPOLLIN | select.EPOLLET
+      self._timeout = lambda t: t # seconds
+    else: # level-triggered
+      self.poller = select.poll()
+      self._mask = select.POLLIN
+      self._timeout = lambda t: t if t < 0 else int(t*1000)
+    # pleaseStop() writes here
+    self._wakeup_r, self._wakeup_w = os.pipe()
+    self.poller.register(self._wakeup_r, self._mask)
+    self.workers = workers
+    self.queue = Queue.Queue()
+    self.maxDepth = 0
+    self._threads = []
     return
   
-  def add(self, socket, handler):
+  def add(self, socket, handler, pending=None, budget=HANDLER_BUDGET, name=None, interval=None):
     '''
-      @param soket: the socket to select() onto  
+      @param socket: the socket to poll, or anything with a fileno()
       @param handler: the callable to run when data arrives.
+      @param pending: a callable returning True when the handler has read 
+        more data than it processed, and should be called again.
+      @param budget: calls of handler in a row
+      @param name: the name of that handler in stats()
+      @param interval: seconds between runs of the handler, even without data.
+      @raise ValueError: if the socket is already registered. A handler is
+        the only reader of its socket, sub() it first.
     '''
+    h = Handler(socket, handler, pending, budget, name, interval)
+    if name is None:
+      h.name = 'fd %d'%(h.fd)
     self.lock.acquire()
-    self.readables[socket] = handler
-    self.selectables.add(socket)
-    self.todo=True
-    self.lock.release()
+    try:
+      if h.fd in self.handlers:
+        raise ValueError('fd %d is already registered for %s'%(h.fd, self.handlers[h.fd].name))
+      self.handlers[h.fd] = h
+      # data that is already there is reported by the first poll
+      self.poller.register(h.fd, self._mask)
+    finally:
+      self.lock.release()
     return
   
   def sub(self, socket):
+    fd = socket.fileno()
     self.lock.acquire()
-    del self.readables[socket]
-    self.selectables.discard(socket)
-    self.todo=True
-    self.lock.release()
+    try:
+      if self.handlers.pop(fd, None) is not None:
+        try:
+          self.poller.unregister(fd)
+        except (IOError, OSError, KeyError), e:
+          log.debug('unregister %d: %s'%(fd, e))
+    finally:
+      self.lock.release()
     return
-    
-  def _syncme(self):
+
+  def stats(self):
+    ''' returns (queue depth, max queue depth, {name: handler stats}) '''
     self.lock.acquire()
-    self._readables = dict(self.readables)
-    self._selectables = set(self.selectables)
-    self.todo=False
-    self.lock.release()
-    return 
+    try:
+      handlers = dict((h.name, h.stats()) for h in self.handlers.values())
+    finally:
+      self.lock.release()
+    return self.queue.qsize(), self.maxDepth, handlers
 
   def runCheck(self):
     return not self.stopSwitch.isSet() 
 
   def pleaseStop(self):
-    return self.stopSwitch.set() 
+    self.stopSwitch.set() 
+    os.write(self._wakeup_w, 'x')
+    return
 
-  def run(self):
-     # thread inbound reads and writes  
+  def _readable(self, h):
+    ''' is there something left to read for that handler '''
+    if h.pending is not None and h.pending():
+      return True
+    socket_ = h.socket
+    if hasattr(socket_, 'pending'): # stream.BytePipe, network.Sniffer
+      return socket_.pending() > 0 or getattr(socket_, 'closed', False)
+    try:
+      socket_.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+      return True # data or EOF
+    except socket.error, e:
+      if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+        return False
+      return True # the handler gets the error
+
+  def _runHandler(self, h):
+    ''' calls the handler up to its budget. returns True if it is still ready. '''
+    if self.handlers.get(h.fd) is not h:
+      return False
+    for i in xrange(h.budget):
+      start = time.time()
+      try:
+        h.handler()
+        log.debug("read and write done for %s"%(h.socket))
+      except EOFError, e:
+        log.debug('forgetting about this output engine: %s'%(e))
+        self.sub(h.socket)
+        # after EOF, nobody reads it again. A TCPState reset gives a new socket.
+        h.socket.close()
+        return False
+      finally:
+        spent = time.time() - start
+        h.calls += 1
+        h.service += spent
+        h.maxService = max(h.maxService, spent)
+      if not self._readable(h):
+        return False
+    return True
+
+  def _submit(self, h):
+    ''' queue a handler that is not busy, for the workers, or in the ready list '''
+    h.busy = True
+    if self.workers > 0:
+      h.queuedAt = time.time()
+      self.queue.put(h)
+      self.maxDepth = max(self.maxDepth, self.queue.qsize())
+    else:
+      self.ready.append(h)
+
+  def _setReady(self, h):
+    self.lock.acquire()
+    try:
+      if h.busy:
+        h.dirty = True
+      else:
+        self._submit(h)
+    finally:
+      self.lock.release()
+
+  def _done(self, h, ready):
+    ''' after a run, requeue the handler at the tail if it is still ready '''
+    while True:
+      self.lock.acquire()
+      try:
+        if ready and self.handlers.get(h.fd) is h:
+          self._submit(h)
+          return
+        if not h.dirty:
+          h.busy = False
+          return
+        h.dirty = False
+      finally:
+        self.lock.release()
+      # the event may have come before our last check
+      ready = self._readable(h)
+
+  def _work(self):
     while True:
-      # check
-      if self.todo:
-        self._syncme
-      r,w,o = select.select(self.selectables,[],[],2)
-      if len(r) == 0:
-        log.debug("select waked up without anything to read... going back to select()")
-        if not self.runCheck():
-          return # quit
+      h = self.queue.get()
+      if h is None:
+        return
+      wait = time.time() - h.queuedAt
+      h.runs += 1
+      h.wait += wait
+      h.maxWait = max(h.maxWait, wait)
+      ready = False
+      try:
+        ready = self._runHandler(h)
+      except Exception, e:
+        log.error('handler %s failed: %s'%(h, e))
+        self.sub(h.socket)
+      self._done(h, ready)
+
+  def _startWorkers(self):
+    for i in range(self.workers):
+      t = threading.Thread(target=self._work, name='supervisor-%d'%(i))
+      t.daemon = True
+      t.start()
+      self._threads.append(t)
+
+  def _stopWorkers(self):
+    for t in self._threads:
+      self.queue.put(None)
+    for t in self._threads:
+      t.join()
+    self._threads = []
+
+  def _periodic(self):
+    ''' makes the periodic handlers that are due ready. returns the seconds
+    until the next one, or -1. '''
+    now = time.time()
+    timeout = -1
+    for h in self.handlers.values():
+      if h.interval is None:
         continue
-      # read them and write them
-      for socket_ in r:
+      if h.due <= now:
+        h.due = now + h.interval
+        self._setReady(h)
+      if timeout < 0 or h.due - now < timeout:
+        timeout = h.due - now
+    return timeout
+
+  def run(self):
+    self._startWorkers()
+    try:
+      while self.runCheck():
+        timeout = self._periodic()
+        # do not wait if some handlers are still ready
+        if len(self.ready) > 0:
+          timeout = 0
         try:
-          self.readables[socket_]()
-          log.debug("read and write done for %s"%(socket_))
-        except EOFError, e:
-          log.debug('forgetting about this output engine: %s'%(e))
-          self.sub(socket_)
-          continue
-      #loop
+          events = self.poller.poll(self._timeout(timeout))
+        except (IOError, select.error), e:
+          if e.args[0] == errno.EINTR:
+            continue
+          raise
+        for fd, event in events:
+          if fd == self._wakeup_r:
+            os.read(self._wakeup_r, 1)
+            continue
+          h = self.handlers.get(fd)
+          if h is not None:
+            self._setReady(h)
+        # one round in this thread, without workers
+        for i in xrange(len(self.ready)):
+          h = self.ready.popleft()
+          self._done(h, self._runHandler(h))
+    finally:
+      self._stopWorkers()
     log.info('Supervisor finished running') 
     return
 
@@ -63,6 +63,12 @@ class Packetizer (object):
     # they should probably be lower.
     REKEY_PACKETS = pow(2, 30)
     REKEY_BYTES = pow(2, 30)
+    # batched reads: max number of messages per read_messages() and
+    # min room made in the receive buffer for a read without blocking.
+    BATCH_MAX_MESSAGES = 64
+    BATCH_READ_SIZE = 4096
+    # initial size of the receive buffer. It grows to fit the biggest read.
+    RECV_BUFFER_SIZE = 64 * 1024
     
     def __init__(self, socket):
         self.__socket = socket
@@ -71,7 +77,20 @@ class Packetizer (object):
         self.__dump_packets = False
         self.__need_rekey = False
         self.__init_count = 0
-        self.__remainder = ''
+        # receive buffer, filled by recv_into(). [__rstart:__rend] is unread.
+        self.__rbuf = bytearray(self.RECV_BUFFER_SIZE)
+        self.__rview = memoryview(self.__rbuf)
+        self.__rstart = 0
+        self.__rend = 0
+        self.__pending = []
+        self.__pending_error = None
+        # bytes consumed from the socket, and where the last whole packet ended
+        self.__consumed = 0L
+        self.__boundary = 0L
+        # bytes decrypted past __boundary, the header of the next packet
+        self.__past = 0
+        # decrypted header of a packet whose body is not there yet
+        self.__header = None
         
         # used for noticing when to re-key:
         self.__sent_bytes = 0
@@ -151,6 +170,14 @@ class Packetizer (object):
     def get_mac_size_out(self):
         return self.__mac_size_out
 
+    def get_boundary(self):
+        """
+        Returns where the last whole packet ended, as a count of bytes read
+        from the socket, the number of bytes decrypted after it, and the
+        number of bytes read from the socket so far.
+        """
+        return self.__boundary, self.__past, self.__consumed + self.__rend - self.__rstart
+
     def need_rekey(self):
         """
         Returns C{True} if a new set of keys needs to be negotiated.  This
@@ -175,6 +202,9 @@ class Packetizer (object):
         """
         Read as close to N bytes as possible, blocking as long as necessary.
         
+        Reads from the socket go in the receive buffer, as much as the socket
+        gives (over-reading), so most packets cost one recv() or none.
+
         @param n: number of bytes to read
         @type n: int
         @return: the data read
@@ -182,23 +212,14 @@ class Packetizer (object):
         @raise EOFError: if the socket was closed before all the bytes could
             be read
         """
-        out = ''
-        # handle over-reading from reading the banner line
-        if len(self.__remainder) > 0:
-            out = self.__remainder[:n]
-            self.__remainder = self.__remainder[n:]
-            n -= len(out)
         if PY22:
-            return self._py22_read_all(n, out)
-        while n > 0:
+            self._py22_read_all(n)
+        while self.__rend - self.__rstart < n:
             got_timeout = False
             try:
-                self._log(DEBUG,'self.__socket.recv(%d) %d'%(n,self.__received_bytes))
-                x = self.__socket.recv(n)
-                if len(x) == 0:
+                self._log(DEBUG,'self.__socket.recv_into(%d) %d'%(n,self.__received_bytes))
+                if self._recv_into_buffer(n - (self.__rend - self.__rstart)) == 0:
                     raise EOFError()
-                out += x
-                n -= len(x)
             except socket.timeout:
                 got_timeout = True
             except socket.error, e:
@@ -217,23 +238,22 @@ class Packetizer (object):
             if got_timeout:
                 if self.__closed:
                     raise EOFError()
-                if check_rekey and (len(out) == 0) and self.__need_rekey:
+                if check_rekey and (self.__rend == self.__rstart) and self.__need_rekey:
                     raise NeedRekeyException()
                 self._check_keepalive()
-        return out
+        return self._consume(n)
 
         
     def readline(self, timeout):
         """
-        Read a line from the socket.  We assume no data is pending after the
-        line, so it's okay to attempt large reads.
+        Read a line from the socket.  Data pending after the line stays in
+        the receive buffer.
         """
-        buf = self.__remainder
-        while not '\n' in buf:
-            buf += self._read_timeout(timeout)
-        n = buf.index('\n')
-        self.__remainder = buf[n+1:]
-        buf = buf[:n]
+        n = self.__rbuf.find('\n', self.__rstart, self.__rend)
+        while n < 0:
+            self._append(self._read_timeout(timeout))
+            n = self.__rbuf.find('\n', self.__rstart, self.__rend)
+        buf = self._consume(n + 1 - self.__rstart)[:-1]
         if (len(buf) > 0) and (buf[-1] == '\r'):
             buf = buf[:-1]
         return buf
@@ -244,39 +264,145 @@ class Packetizer (object):
         Only one thread should ever be in this function (no other locking is
         done).
         
+        Wrapper around L{read_messages}, messages decrypted in the same batch
+        are returned by the next calls.
+
         @raise SSHException: if the packet is mangled
         @raise NeedRekeyException: if the transport should rekey
         """
-        header = self.read_all(self.__block_size_in, check_rekey=True)
-        if self.__block_engine_in != None:
-            self._log(DEBUG, 'read %d header in paramiko before decrypt: %s '%(self.__block_size_in, repr(header) ));
-            header = self.__block_engine_in.decrypt(header)
-            self._log(DEBUG, 'DECRYPTING HEADER : %s'%( repr(header) ));
+        if len(self.__pending) == 0:
+            self.__pending = self.read_messages()
+        return self.__pending.pop(0)
+
+    def has_pending_messages(self):
+        """
+        Returns C{True} if L{read_message} has messages left from a batch.
+        """
+        return len(self.__pending) > 0
+
+    def read_messages(self, max_messages=None, block=True):
+        """
+        Read at least one message, and all the complete messages the socket
+        already holds, up to C{max_messages}.
+
+        Without C{block}, only the complete messages are returned, maybe none.
+        The decrypted header of an incomplete packet is kept for the next call.
+        
+        The body of a packet and the header of the next one are contiguous
+        in the cipher stream (the MAC is not encrypted), so they go through
+        one engine call. That is one call per packet instead of two.
+
+        Only one thread should ever be in this function (no other locking is
+        done).
+        
+        @param block: wait for a whole packet
+        @type block: bool
+        @return: a list of (cmd, msg)
+        @raise SSHException: if the first packet is mangled
+        @raise NeedRekeyException: if the transport should rekey
+        """
+        if self.__pending_error is not None:
+            e, self.__pending_error = self.__pending_error, None
+            raise e
+        if max_messages is None:
+            max_messages = self.BATCH_MAX_MESSAGES
+        block_size = self.__block_size_in
+        engine = self.__block_engine_in
+        header, self.__header = self.__header, None
+        if header is None:
+            if not block and not self._buffered(block_size):
+                return []
+            header = self.read_all(block_size, check_rekey=True)
+            if block:
+                self._read_available()
+            if engine != None:
+                self._log(DEBUG, 'read %d header in paramiko before decrypt: %s '%(block_size, repr(header) ));
+                header = engine.decrypt(header)
+                self.__past = block_size
+                self._log(DEBUG, 'DECRYPTING HEADER : %s'%( repr(header) ));
+        messages = []
+        while header is not None:
+            try:
+                packet_size = self._check_header(header)
+            except SSHException, e:
+                if len(messages) == 0:
+                    raise
+                # the previous messages are valid. raise on next call.
+                self.__pending_error = e
+                break
+            # leftover contains decrypted bytes from the first block (after the length field)
+            leftover = header[4:]
+            body_size = packet_size - len(leftover)
+            post_size = body_size + self.__mac_size_in
+            current, header = header, None
+            if (len(messages)+1 < max_messages) and (self.__rend - self.__rstart >= post_size + block_size):
+                # next header is already there. decrypt it with this body.
+                buf = self.read_all(post_size + block_size)
+                packet = buf[:body_size]
+                post_packet = buf[body_size:post_size]
+                if engine != None:
+                    packet = engine.decrypt(packet + buf[post_size:])
+                    self._log(DEBUG, 'DECRYPTING PACKET and next header %s'%( repr(packet) ));
+                    header = packet[body_size:]
+                    packet = packet[:body_size]
+                else:
+                    header = buf[post_size:]
+                self.__boundary = self.__consumed - block_size
+            else:
+                if not block and not self._buffered(post_size):
+                    self.__header = current
+                    break
+                buf = self.read_all(post_size)
+                self._log(DEBUG,"%d self.read_all(packet_size(%d) + self.__mac_size_in(%d) - len(leftover)(%d))"%( len(buf),
+                            packet_size,self.__mac_size_in,len(leftover)) )
+                packet = buf[:body_size]
+                post_packet = buf[body_size:]
+                if engine != None:
+                    self._log(DEBUG, 'body in paramiko before decrypt: %s '%( repr(buf) ));
+                    packet = engine.decrypt(packet)
+                    self._log(DEBUG, 'DECRYPTING PACKET %s'%( repr(packet) ));
+                self.__boundary = self.__consumed
+                self.__past = 0
+                if (len(messages)+1 < max_messages) and (self.__rend - self.__rstart >= block_size):
+                    # the body read brought the next header, do not leave it
+                    # in the buffer while the socket has nothing new.
+                    header = self.read_all(block_size)
+                    if engine != None:
+                        header = engine.decrypt(header)
+                        self.__past = block_size
+            try:
+                messages.append(self._build_message(packet_size, leftover + packet, post_packet))
+            except SSHException, e:
+                if len(messages) == 0:
+                    raise
+                self.__pending_error = e
+                break
+        return messages
+
+    def _check_header(self, header):
+        """
+        Returns the packet size of a decrypted header.
+
+        @raise SSHException: if the packet size is invalid
+        """
         if self.__dump_packets:
             self._log(DEBUG, util.format_binary(header, 'IN: '));
-
         packet_size = struct.unpack('>I', header[:4])[0]
         self._log(DEBUG, 'packet_size: %d max:%d'%(packet_size,PACKET_MAX_SIZE));
         if (packet_size > PACKET_MAX_SIZE):
-            self._log(DEBUG, 'packet_size: %d max:%d'%(packet_size,PACKET_MAX_SIZE));
             raise SSHException2('Invalid packet size')
-        # leftover contains decrypted bytes from the first block (after the length field)
-        leftover = header[4:]
-        if (packet_size - len(leftover)) % self.__block_size_in != 0:
+        if (packet_size - (len(header) - 4)) % self.__block_size_in != 0:
             raise SSHException('Invalid packet blocking')
-        buf = self.read_all(packet_size + self.__mac_size_in - len(leftover))
-        self._log(DEBUG,"%d self.read_all(packet_size(%d) + self.__mac_size_in(%d) - len(leftover)(%d))"%( len(buf),
-                    packet_size,self.__mac_size_in,len(leftover)) )
-        
-        packet = buf[:packet_size - len(leftover)]
-        post_packet = buf[packet_size - len(leftover):]
-        if self.__block_engine_in != None:
-            self._log(DEBUG, 'body in paramiko before decrypt: %s '%( repr(buf) ));
-            packet = self.__block_engine_in.decrypt(packet)
-            self._log(DEBUG, 'DECRYPTING PACKET %s'%( repr(packet) ));
+        return packet_size
+
+    def _build_message(self, packet_size, packet, post_packet):
+        """
+        Makes a message out of a decrypted packet (without the length field).
+
+        @raise SSHException: if the packet is mangled
+        """
         if self.__dump_packets:
             self._log(DEBUG, util.format_binary(packet, 'IN: '));
-        packet = leftover + packet
         ## XXX Tsssi... a protected method ould have been nice      
         if self._mac_enabled and self.__mac_size_in > 0:
             mac = post_packet[:self.__mac_size_in]
@@ -339,6 +465,88 @@ class Packetizer (object):
         else:
             self.__logger.log(level, msg)
 
+    def _read_available(self):
+        """
+        Move what the socket already holds to the receive buffer, without
+        blocking. That fills the free end of the buffer, which is only moved
+        or grown when less than BATCH_READ_SIZE is left. Returns the number of bytes received, 0 on EOF, or None if
+        there was nothing to read.
+        """
+        try:
+            return self._recv_into_buffer(self.BATCH_READ_SIZE, socket.MSG_DONTWAIT)
+        except socket.error, e:
+            if (type(e.args) is tuple) and (len(e.args) > 0) and (e.args[0] in (errno.EAGAIN, errno.EINTR)):
+                return None
+            elif self.__closed:
+                return None
+            raise
+
+    def _buffered(self, n):
+        """
+        Returns C{True} if the receive buffer holds n bytes, after taking what
+        the socket already has. Never blocks.
+
+        @raise EOFError: if the socket was closed before n bytes came
+        """
+        while self.__rend - self.__rstart < n:
+            got = self._read_available()
+            if got == 0:
+                raise EOFError()
+            if got is None:
+                if self.__closed:
+                    raise EOFError()
+                return False
+        return True
+
+    def _reserve(self, n):
+        """
+        Make room for n more bytes at the end of the receive buffer.
+        Unread data is moved to the front, the buffer grows if needed.
+        """
+        unread = self.__rend - self.__rstart
+        if self.__rend + n <= len(self.__rbuf):
+            return
+        if unread + n > len(self.__rbuf):
+            rbuf = bytearray(max(2 * len(self.__rbuf), unread + n))
+            rbuf[:unread] = self.__rview[self.__rstart:self.__rend]
+            self.__rbuf = rbuf
+            self.__rview = memoryview(rbuf)
+        elif unread > 0:
+            self.__rbuf[:unread] = self.__rbuf[self.__rstart:self.__rend]
+        self.__rstart = 0
+        self.__rend = unread
+
+    def _recv_into_buffer(self, n, flags=0):
+        """
+        One recv() of at least n bytes of room, at most what fits in the
+        receive buffer. Returns the number of bytes received.
+        """
+        self._reserve(n)
+        free = len(self.__rbuf) - self.__rend
+        if not hasattr(self.__socket, 'recv_into'):
+            # file-like sockets
+            return self._append(self.__socket.recv(free, flags))
+        got = self.__socket.recv_into(self.__rview[self.__rend:], free, flags)
+        self.__rend += got
+        return got
+
+    def _append(self, data):
+        self._reserve(len(data))
+        self.__rbuf[self.__rend:self.__rend+len(data)] = data
+        self.__rend += len(data)
+        return len(data)
+
+    def _consume(self, n):
+        """
+        Returns n bytes from the receive buffer. One copy.
+        """
+        out = self.__rview[self.__rstart:self.__rstart+n].tobytes()
+        self.__rstart += len(out)
+        self.__consumed += len(out)
+        if self.__rstart == self.__rend:
+            self.__rstart = self.__rend = 0
+        return out
+
     def _check_keepalive(self):
         if (not self.__keepalive_interval) or (not self.__block_engine_out) or \
             self.__need_rekey:
@@ -349,20 +557,18 @@ class Packetizer (object):
             self.__keepalive_callback()
             self.__keepalive_last = now
     
-    def _py22_read_all(self, n, out):
-        while n > 0:
+    def _py22_read_all(self, n):
+        while self.__rend - self.__rstart < n:
             r, w, e = select.select([self.__socket], [], [], 0.1)
             if self.__socket not in r:
                 if self.__closed:
                     raise EOFError()
                 self._check_keepalive()
             else:
-                x = self.__socket.recv(n)
+                x = self.__socket.recv(n - (self.__rend - self.__rstart))
                 if len(x) == 0:
                     raise EOFError()
-                out += x
-                n -= len(x)
-        return out
+                self._append(x)
 
     def _py22_read_timeout(self, timeout):
         start = time.time()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Loic Jaquemet loic.jaquemet+python@gmail.com
+#
+
+__author__ = "Loic Jaquemet loic.jaquemet+python@gmail.com"
+
+import ctypes
+import logging
+import multiprocessing
+import struct
+import time
+import Queue
+
+import stream
+
+log=logging.getLogger('ring')
+
+# bytes of shared memory per connection
+RING_SIZE = 8*1024*1024
+
+_LEN = struct.Struct('I')
+# inbound, seq, flags. scapy gives the 9 TCP flags, with NS (0x100)
+_SEGMENT = struct.Struct('!?IH')
+
+
+class SharedRing:
+  ''' Single producer, single consumer ring of bytes records, in shared memory.
+
+    The ring is created before fork(), the producer and the consumer can then
+    live in different processes. Records are copied in and out of the ring
+    outside of the lock, the lock only protects the head and tail counters.
+  '''
+  def __init__(self, size=RING_SIZE):
+    self.size = size
+    self.buf = multiprocessing.RawArray(ctypes.c_char, size)
+    # total bytes read and written. never wrapped.
+    self.head = multiprocessing.RawValue(ctypes.c_ulonglong, 0)
+    self.tail = multiprocessing.RawValue(ctypes.c_ulonglong, 0)
+    self.cond = multiprocessing.Condition()
+    self._base = ctypes.addressof(self.buf)
+    return
+
+  def _write(self, pos, data):
+    off = pos % self.size
+    n = min(len(data), self.size - off)
+    ctypes.memmove(self._base + off, data, n)
+    if n < len(data):
+      ctypes.memmove(self._base, data[n:], len(data) - n)
+
+  def _read(self, pos, n):
+    off = pos % self.size
+    if off + n <= self.size:
+      return ctypes.string_at(self._base + off, n)
+    first = self.size - off
+    return ctypes.string_at(self._base + off, first) + ctypes.string_at(self._base, n - first)
+
+  def _wait(self, predicate, block, timeout, exception):
+    ''' waits under self.cond until predicate() '''
+    if predicate():
+      return
+    if not block:
+      raise exception()
+    end = None
+    if timeout is not None:
+      end = time.time() + timeout
+    while not predicate():
+      if end is not None:
+        remaining = end - time.time()
+        if remaining <= 0:
+          raise exception()
+        self.cond.wait(remaining)
+      else:
+        self.cond.wait()
+    return
+
+  def put(self, data, block=True, timeout=None):
+    ''' append a record. raises Queue.Full if there is no room. '''
+    need = _LEN.size + len(data)
+    if need > self.size:
+      raise ValueError('record of %d bytes is bigger than the ring'%(len(data)))
+    self.cond.acquire()
+    try:
+      self._wait(lambda: self.size - (self.tail.value - self.head.value) >= need, block, timeout, Queue.Full)
+      tail = self.tail.value
+    finally:
+      self.cond.release()
+    # only we write there
+    self._write(tail, _LEN.pack(len(data)))
+    self._write(tail + _LEN.size, data)
+    self.cond.acquire()
+    self.tail.value = tail + need
+    self.cond.notify_all()
+    self.cond.release()
+    return
+
+  def get(self, block=True, timeout=None):
+    ''' returns all the pending records. raises Queue.Empty if there is none. '''
+    self.cond.acquire()
+    try:
+      self._wait(lambda: self.tail.value != self.head.value, block, timeout, Queue.Empty)
+      head, tail = self.head.value, self.tail.value
+    finally:
+      self.cond.release()
+    # only we read there
+    records = []
+    pos = head
+    while pos < tail:
+      n = _LEN.unpack(self._read(pos, _LEN.size))[0]
+      records.append(self._read(pos + _LEN.size, n))
+      pos += _LEN.size + n
+    self.cond.acquire()
+    self.head.value = pos
+    self.cond.notify_all()
+    self.cond.release()
+    return records
+
+  def pending(self):
+    ''' bytes waiting to be read '''
+    return self.tail.value - self.head.value
+
+  def join(self, timeout=None):
+    ''' waits until the consumer has read everything. '''
+    self.cond.acquire()
+    try:
+      self._wait(lambda: self.tail.value == self.head.value, True, timeout, Queue.Full)
+    finally:
+      self.cond.release()
+
+
+class SegmentQueue:
+  ''' A Queue.Queue look-alike carrying the TCP segments of one connection
+  through a SharedRing, for a Stream running in another process.
+
+    The sniffer side put_nowait() (packet, inbound), the packet being a scapy
+    packet or a stream.Segment. Only the direction, seq, flags and payload 
+    bytes cross the ring, no pickle.
+    The Stream side get() the list of all pending (stream.Segment, inbound).
+  '''
+  def __init__(self, connection, size=RING_SIZE):
+    self.connection = connection
+    self.ring = SharedRing(size)
+    self.local_address = tuple(connection.local_address)
+    self.remote_address = tuple(connection.remote_address)
+    return
+
+  def put_nowait(self, item):
+    self.put(item, block=False)
+
+  def put(self, item, block=True, timeout=None):
+    ''' puts item, a (packet, inbound) tuple '''
+    packet, inbound = item
+    if not isinstance(packet, stream.Segment):
+      packet = packet['TCP']
+    payload = packet.payload
+    if len(payload) == 0: # acks and stuff. the stream ignores them.
+      return
+    if isinstance(packet, stream.Segment):
+      load = packet.load
+    else:
+      load = str(payload)
+    record = _SEGMENT.pack(inbound, packet.seq, int(packet.flags)) + load
+    self.ring.put(record, block, timeout)
+
+  def get(self, block=True, timeout=None):
+    segments = []
+    for record in self.ring.get(block, timeout):
+      inbound, seq, flags = _SEGMENT.unpack_from(record)
+      load = record[_SEGMENT.size:]
+      if inbound:
+        (src, sport), (dst, dport) = self.remote_address, self.local_address
+      else:
+        (src, sport), (dst, dport) = self.local_address, self.remote_address
+      segments.append((stream.Segment(src, sport, dst, dport, seq, flags, load), inbound))
+    return segments
+
+  def task_done(self):
+    pass
+
+  def qsize(self):
+    return self.ring.pending()
+
+  def empty(self):
+    return self.ring.pending() == 0
+
+  def join(self):
+    self.ring.join()
+
+  def __str__(self):
+    return "<SegmentQueue %s:%s-%s:%s %d bytes pending>"%(self.local_address+self.remote_address+(self.qsize(),))
+
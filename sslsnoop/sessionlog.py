@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Loic Jaquemet loic.jaquemet+python@gmail.com
+#
+
+__author__ = "Loic Jaquemet loic.jaquemet+python@gmail.com"
+
+'''
+An append-only binary log of the decrypted messages of many sessions.
+
+The file is a header, a list of length-prefixed records, and an index footer
+written on close:
+
+  header   MAGIC
+  record   size, kind, timestamp, connection, direction, seqno, msgtype, channel
+           then size bytes of payload
+  footer   the offsets of the message records, then a trailer with the offset
+           of the footer, the record count and FOOTER_MAGIC
+
+Connection names are records too, so a log whose writer died without a
+footer is read back by scanning the records, and appended to again.
+'''
+
+import collections
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+log=logging.getLogger('sessionlog')
+
+MAGIC = 'SSLSLOG\x01'
+FOOTER_MAGIC = 'SSLSIDX\x01'
+
+# size, kind, timestamp, connection, direction, seqno, msgtype, channel
+RECORD = struct.Struct('<IBdIBIBi')
+# footer offset, message count, FOOTER_MAGIC
+TRAILER = struct.Struct('<QQ8s')
+OFFSET = struct.Struct('<Q')
+# offsets packed at once in the footer
+FOOTER_CHUNK = 4096
+
+KIND_MESSAGE = 0
+KIND_CONNECTION = 1
+
+INBOUND = 0
+OUTBOUND = 1
+
+# the channel of messages that are not about a channel
+NO_CHANNEL = -1
+
+Record = collections.namedtuple('Record', 'timestamp connection direction seqno msgtype channel payload')
+
+
+class SessionLogError(Exception):
+  pass
+
+
+def _scan(buf, start, end):
+  ''' reads the records of buf[start:end].
+  returns (message offsets, {connection id: name}, end of the last whole record)
+  '''
+  offsets = []
+  connections = dict()
+  pos = start
+  while pos + RECORD.size <= end:
+    size, kind, ts, conn, direction, seqno, msgtype, channel = RECORD.unpack_from(buf, pos)
+    if pos + RECORD.size + size > end:
+      break
+    if kind == KIND_MESSAGE:
+      offsets.append(pos)
+    elif kind == KIND_CONNECTION:
+      connections[conn] = buf[pos+RECORD.size:pos+RECORD.size+size]
+    else:
+      break
+    pos += RECORD.size + size
+  return offsets, connections, pos
+
+
+def _readFooter(buf, size):
+  ''' returns (footer offset, message count) from the trailer, or None '''
+  if size < len(MAGIC) + TRAILER.size:
+    return None
+  footer, count, magic = TRAILER.unpack_from(buf, size - TRAILER.size)
+  if magic != FOOTER_MAGIC or footer + OFFSET.size*count + TRAILER.size != size:
+    return None
+  return footer, count
+
+
+class SessionLogWriter:
+  ''' Appends records to a session log. Thread safe.
+    An existing log is continued, its footer is rewritten on close.
+  '''
+  def __init__(self, fname):
+    self.fname = fname
+    self.lock = threading.Lock()
+    self.connections = dict()
+    if os.path.exists(fname) and os.path.getsize(fname) > 0:
+      self._reopen()
+    else:
+      self.file = open(fname, 'wb')
+      self.file.write(MAGIC)
+      self.offsets = []
+      self.pos = len(MAGIC)
+    return
+
+  def _reopen(self):
+    self.file = open(self.fname, 'r+b')
+    reader = SessionLog(self.fname)
+    try:
+      self.offsets = [reader.offset(i) for i in xrange(len(reader))]
+      self.pos = reader.end
+      for conn, name in reader.connections.items():
+        self.connections[name] = conn
+    finally:
+      reader.close()
+    # drop the footer, or a partial record
+    self.file.truncate(self.pos)
+    self.file.seek(self.pos)
+    log.info('continuing %s after %d messages'%(self.fname, len(self.offsets)))
+    return
+
+  def _append(self, kind, ts, conn, direction, seqno, msgtype, channel, payload):
+    self.file.write(RECORD.pack(len(payload), kind, ts, conn, direction, seqno, msgtype, channel))
+    self.file.write(payload)
+    offset = self.pos
+    self.pos += RECORD.size + len(payload)
+    return offset
+
+  def connection(self, name):
+    ''' returns the id of the connection name, recorded on first use '''
+    self.lock.acquire()
+    try:
+      conn = self.connections.get(name)
+      if conn is None:
+        conn = self.connections[name] = len(self.connections)
+        self._append(KIND_CONNECTION, time.time(), conn, 0, 0, 0, NO_CHANNEL, name)
+    finally:
+      self.lock.release()
+    return conn
+
+  def write(self, conn, direction, seqno, msgtype, channel, payload, timestamp=None):
+    ''' appends a message of the connection id conn. returns its index '''
+    self.lock.acquire()
+    try:
+      # under the lock, so that the timestamps are in the order of the records
+      if timestamp is None:
+        timestamp = time.time()
+      self.offsets.append(self._append(KIND_MESSAGE, timestamp, conn, direction, seqno, msgtype, channel, payload))
+      index = len(self.offsets) - 1
+    finally:
+      self.lock.release()
+    return index
+
+  def flush(self):
+    self.lock.acquire()
+    try:
+      self.file.flush()
+    finally:
+      self.lock.release()
+
+  def close(self):
+    ''' writes the index footer and closes the file '''
+    self.lock.acquire()
+    try:
+      if self.file.closed:
+        return
+      for i in xrange(0, len(self.offsets), FOOTER_CHUNK):
+        chunk = self.offsets[i:i+FOOTER_CHUNK]
+        self.file.write(struct.pack('<%dQ'%(len(chunk)), *chunk))
+      self.file.write(TRAILER.pack(self.pos, len(self.offsets), FOOTER_MAGIC))
+      self.file.close()
+    finally:
+      self.lock.release()
+    return
+
+
+class SessionLog:
+  ''' Random access to the messages of a session log, on a read only mmap.
+    log[i] is the i-th message, as a Record. The offsets are read in the
+    footer on demand.
+    A log without a footer, of a running or dead writer, is indexed by a scan.
+  '''
+  def __init__(self, fname):
+    self.fname = fname
+    self.file = open(fname, 'rb')
+    size = os.fstat(self.file.fileno()).st_size
+    if size < len(MAGIC):
+      self.file.close()
+      raise SessionLogError('%s is not a session log'%(fname))
+    self.mm = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+    if self.mm[:len(MAGIC)] != MAGIC:
+      self.close()
+      raise SessionLogError('%s is not a session log'%(fname))
+    footer = _readFooter(self.mm, size)
+    if footer is not None:
+      self.end, self.count = footer
+      self.offsets = None
+      self.connections = self._scanConnections()
+    else:
+      log.debug('%s has no index, scanning it'%(fname))
+      self.offsets, self.connections, self.end = _scan(self.mm, len(MAGIC), size)
+      self.count = len(self.offsets)
+    return
+
+  def _scanConnections(self):
+    ''' returns the connection names. They are recorded before the first
+    message of their connection, so only the gaps between messages are read. '''
+    connections = dict()
+    pos = len(MAGIC)
+    for i in xrange(self.count + 1):
+      if i < self.count:
+        offset = self.offset(i)
+      else:
+        offset = self.end
+      if pos < offset:
+        connections.update(_scan(self.mm, pos, offset)[1])
+      if i < self.count:
+        pos = offset + RECORD.size + RECORD.unpack_from(self.mm, offset)[0]
+    return connections
+
+  def offset(self, index):
+    ''' the file offset of message index '''
+    if self.offsets is not None:
+      return self.offsets[index]
+    return OFFSET.unpack_from(self.mm, self.end + OFFSET.size*index)[0]
+
+  def __len__(self):
+    return self.count
+
+  def _record(self, offset):
+    size, kind, ts, conn, direction, seqno, msgtype, channel = RECORD.unpack_from(self.mm, offset)
+    start = offset + RECORD.size
+    return Record(ts, self.connections.get(conn, conn), direction, seqno, msgtype, channel, self.mm[start:start+size])
+
+  def __getitem__(self, index):
+    if index < 0:
+      index += self.count
+    if not 0 <= index < self.count:
+      raise IndexError(index)
+    return self._record(self.offset(index))
+
+  def __iter__(self):
+    for i in xrange(self.count):
+      yield self._record(self.offset(i))
+
+  def timestamp(self, index):
+    ''' the timestamp of message index, without reading its payload '''
+    return RECORD.unpack_from(self.mm, self.offset(index))[2]
+
+  def find(self, timestamp):
+    ''' returns the index of the first message at or after timestamp.
+    Messages are in the order they were written, so that is a bisection. '''
+    lo, hi = 0, self.count
+    while lo < hi:
+      mid = (lo + hi)//2
+      if self.timestamp(mid) < timestamp:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def select(self, connection=None, direction=None, msgtype=None, channel=None, start=None, stop=None):
+    ''' yields the messages matching all the given fields, between the
+    timestamps start and stop. '''
+    first = 0
+    if start is not None:
+      first = self.find(start)
+    for i in xrange(first, self.count):
+      offset = self.offset(i)
+      size, kind, ts, conn, d, seqno, t, chan = RECORD.unpack_from(self.mm, offset)
+      if stop is not None and ts >= stop:
+        break
+      if ((connection is not None and self.connections.get(conn) != connection) or
+          (direction is not None and d != direction) or
+          (msgtype is not None and t != msgtype) or
+          (channel is not None and chan != channel)):
+        continue
+      yield self._record(offset)
+    return
+
+  def close(self):
+    self.mm.close()
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
@@ -6,16 +6,30 @@
 
 __author__ = "Loic Jaquemet loic.jaquemet+python@gmail.com"
 
-import logging, os, socket, sys, time
+import array, bisect, collections, errno, logging, os, socket, sys, threading, time, zlib
 import multiprocessing, Queue
 
 from lrucache import LRUCache
 
 WAIT_RETRANSMIT = 20
 QSIZE = 5000
+# segments remembered per direction to check retransmissions
+HISTORY_SIZE = 256
+# keep the full packets of the history too, to log them
+DEBUG_RETRANSMIT = False
+# max bytes queued in a BytePipe before the writer blocks
+PIPE_SIZE = 16*1024*1024
+
+# how TCPState hands ordered data to its reader
+BACKEND_SOCKET = 'socket'
+BACKEND_PIPE = 'pipe'
+BACKENDS = [BACKEND_SOCKET, BACKEND_PIPE]
 
 log=logging.getLogger('stream')
 
+# TCP sequence numbers are 32 bits serial numbers (RFC 1982)
+SEQ_MASK = 0xffffffff
+
 
 def hexify(data):
   s=''
@@ -38,13 +52,327 @@ class BadStateError (Exception):
   pass
 
 
+class Segment(object):
+  ''' A TCP segment without scapy. 
+    It quacks like the scapy TCP layer for what Stream and TCPState use: 
+    seq, sport, dport, underlayer.src, underlayer.dst, payload.load and len(payload).
+  '''
+  __slots__ = ('src', 'sport', 'dst', 'dport', 'seq', 'flags', 'load')
+  def __init__(self, src, sport, dst, dport, seq, flags, load):
+    self.src = src
+    self.sport = sport
+    self.dst = dst
+    self.dport = dport
+    self.seq = seq
+    self.flags = flags
+    self.load = load
+
+  # we are our own IP layer and our own payload
+  payload = property(lambda self: self)
+  underlayer = property(lambda self: self)
+
+  def __len__(self):
+    return len(self.load)
+
+  def __getitem__(self, layer):
+    return self
+
+  def __iter__(self):
+    ''' like a scapy packet, iterating yields the packet '''
+    yield self
+
+  def __repr__(self):
+    return "<Segment %s:%s > %s:%s seq:%d len:%d>"%(self.src, self.sport, self.dst, self.dport, self.seq, len(self.load))
+
+
+def seqDiff(a, b):
+  ''' returns a-b for two sequence numbers, in [-2**31, 2**31[ '''
+  return ((a - b + 0x80000000) & SEQ_MASK) - 0x80000000
+
+def _slice(packet, start, end, seq):
+  ''' returns a Segment with packet payload[start:end], at seq '''
+  ip = packet.underlayer
+  return Segment(ip.src, packet.sport, ip.dst, packet.dport, seq & SEQ_MASK, int(packet.flags), packet.payload.load[start:end])
+
+
+class SegmentStore:
+  ''' Out of order TCP segments of one direction, as sorted runs of contiguous data.
+
+    Segments are stored at their stream offset, an unwrapped 64 bits seq.
+    starts is the sorted list of the first offset of each run, searched with bisect.
+    ends gives the end of each run, so a segment filling a hole merges the runs
+    on both sides without touching their segments. A byte is never stored twice,
+    segments overlapping stored data are trimmed to the new bytes.
+  '''
+  def __init__(self):
+    self.starts = []
+    self.ends = {} # run start -> run end
+    self.segments = {} # offset -> segment, no overlaps
+    self.size = 0 # bytes stored
+
+  def __len__(self):
+    return len(self.segments)
+
+  def first(self):
+    ''' returns the seq of the first stored byte, or None '''
+    if len(self.starts) == 0:
+      return None
+    return self.starts[0]
+
+  def add(self, seq, packet):
+    ''' stores the bytes of packet, at stream offset seq, that are not stored yet.
+    returns the number of new bytes. '''
+    starts, ends = self.starts, self.ends
+    end = seq + len(packet.payload)
+    i = bisect.bisect_right(starts, seq) - 1
+    cur = seq
+    if i >= 0 and ends[starts[i]] > cur:
+      cur = ends[starts[i]]
+      if cur >= end: # duplicate
+        return 0
+    # the holes covered by this packet
+    holes = []
+    j = i + 1
+    while cur < end:
+      if j < len(starts) and starts[j] < end:
+        if starts[j] > cur:
+          holes.append((cur, starts[j]))
+        cur = max(cur, ends[starts[j]])
+        j += 1
+      else:
+        holes.append((cur, end))
+        break
+    added = 0
+    for a, b in holes:
+      if (a, b) == (seq, end):
+        self._insert(a, b, packet)
+      else:
+        self._insert(a, b, _slice(packet, a-seq, b-seq, a))
+      added += b-a
+    return added
+
+  def _insert(self, start, end, packet):
+    ''' stores a segment over a hole, merging the runs around it '''
+    starts, ends = self.starts, self.ends
+    self.segments[start] = packet
+    self.size += end - start
+    i = bisect.bisect_left(starts, start)
+    if i > 0 and ends[starts[i-1]] == start:
+      run = starts[i-1]
+    else:
+      starts.insert(i, start)
+      run = start
+      i += 1
+    ends[run] = end
+    if i < len(starts) and starts[i] == end:
+      ends[run] = ends.pop(end)
+      del starts[i]
+    return
+
+  def _popRun(self):
+    ''' removes and returns the segments of the first run '''
+    start = self.starts.pop(0)
+    end = self.ends.pop(start)
+    segments = []
+    pos = start
+    while pos < end:
+      p = self.segments.pop(pos)
+      segments.append(p)
+      pos += len(p.payload)
+    self.size -= end - start
+    return start, segments
+
+  def pop(self, seq):
+    ''' removes and returns the contiguous segments starting at seq. 
+    Stored bytes before seq are dropped. '''
+    starts = self.starts
+    while len(starts) > 0 and self.ends[starts[0]] <= seq:
+      self._popRun()
+    if len(starts) == 0 or starts[0] > seq:
+      return []
+    pos, segments = self._popRun()
+    while pos + len(segments[0].payload) <= seq:
+      pos += len(segments.pop(0).payload)
+    if pos < seq:
+      p = segments[0]
+      segments[0] = _slice(p, seq-pos, len(p.payload), seq)
+    return segments
+
+
+class RetransmitHistory:
+  ''' The last segments accepted in one direction, as (seq, len, crc32) in 
+    array rings. Tells a plain retransmission from one carrying other data.
+    Full packets are only kept with keepPackets, for debugging.
+  '''
+  def __init__(self, size=HISTORY_SIZE, keepPackets=DEBUG_RETRANSMIT):
+    self.size = size
+    self.seqs = array.array('I', [0])*size
+    self.lens = array.array('I', [0])*size
+    self.crcs = array.array('i', [0])*size
+    self.pos = 0
+    self.packets = None
+    if keepPackets:
+      self.packets = LRUCache(size)
+
+  def add(self, packet):
+    load = packet.payload.load
+    i = self.pos % self.size
+    self.seqs[i] = packet.seq
+    self.lens[i] = len(load)
+    self.crcs[i] = zlib.crc32(load)
+    self.pos += 1
+    if self.packets is not None:
+      self.packets[packet.seq] = packet
+
+  def _find(self, seq):
+    try:
+      i = self.seqs.index(seq)
+    except ValueError:
+      return None
+    if self.lens[i] > 0:
+      return i
+    # seq 0 matched an empty slot
+    for i in xrange(self.size):
+      if self.seqs[i] == seq and self.lens[i] > 0:
+        return i
+    return None
+
+  def check(self, packet):
+    ''' returns True if packet is the same as the remembered one at its seq, 
+    False if it carries other data, None if it is unknown or of another size.'''
+    i = self._find(packet.seq)
+    if i is None:
+      return None
+    load = packet.payload.load
+    if self.lens[i] != len(load):
+      return None
+    return self.crcs[i] == zlib.crc32(load)
+
+  def get(self, seq):
+    ''' returns the remembered packet at seq, with keepPackets only '''
+    if self.packets is None or seq not in self.packets:
+      return None
+    return self.packets[seq]
+
+
+class BytePipe:
+  ''' In-memory simplex byte pipe, with the socket methods a Packetizer uses.
+    
+    Chunks are queued by reference, there is no syscall and no kernel copy per
+    segment. The reader copies them once, in recv_into().
+    fileno() is a file descriptor readable when data or EOF is pending, so 
+    the pipe can be select()-ed like a socket. It is only written on the 
+    empty to non-empty transition.
+  '''
+  def __init__(self, maxsize=PIPE_SIZE):
+    self.maxsize = maxsize
+    self.chunks = collections.deque()
+    self.size = 0 # bytes queued
+    self.offset = 0 # bytes already read in chunks[0]
+    self.closed = False
+    self.cond = threading.Condition()
+    self._rfd, self._wfd = os.pipe()
+    self._signaled = False
+
+  def _signal(self):
+    if not self._signaled:
+      os.write(self._wfd, 'x')
+      self._signaled = True
+
+  def _unsignal(self):
+    if self._signaled:
+      os.read(self._rfd, 1)
+      self._signaled = False
+
+  def fileno(self):
+    return self._rfd
+
+  def lock(self):
+    ''' the pipe lock. Writes are atomic under it. '''
+    return self.cond
+
+  def send(self, data, block=True):
+    ''' queue data. blocks while the pipe is full, if block is True. '''
+    self.cond.acquire()
+    try:
+      if self.closed:
+        raise socket.error(errno.EPIPE, 'BytePipe is closed')
+      while block and self.size >= self.maxsize and not self.closed:
+        self.cond.wait()
+      self.chunks.append(data)
+      self.size += len(data)
+      self._signal()
+      self.cond.notify_all()
+    finally:
+      self.cond.release()
+    return len(data)
+
+  sendall = send
+
+  def recv_into(self, buf, nbytes=0, flags=0):
+    ''' copies at most nbytes of queued data into buf.
+    blocks until data is available, returns 0 on EOF. '''
+    if nbytes == 0:
+      nbytes = len(buf)
+    self.cond.acquire()
+    try:
+      while self.size == 0:
+        if self.closed:
+          return 0
+        if flags & socket.MSG_DONTWAIT:
+          raise socket.error(errno.EAGAIN, 'BytePipe is empty')
+        self.cond.wait()
+      got = 0
+      while got < nbytes and self.size > 0:
+        chunk = self.chunks[0]
+        n = min(nbytes - got, len(chunk) - self.offset)
+        buf[got:got+n] = memoryview(chunk)[self.offset:self.offset+n]
+        got += n
+        self.size -= n
+        self.offset += n
+        if self.offset == len(chunk):
+          self.chunks.popleft()
+          self.offset = 0
+      if self.size == 0 and not self.closed:
+        self._unsignal()
+      self.cond.notify_all()
+      return got
+    finally:
+      self.cond.release()
+
+  def recv(self, n, flags=0):
+    buf = bytearray(n)
+    got = self.recv_into(buf, n, flags)
+    return str(buf[:got])
+
+  def pending(self):
+    ''' returns the number of bytes waiting to be read '''
+    return self.size
+
+  def close(self):
+    ''' no more data. The reader gets EOF after the queued data. '''
+    self.cond.acquire()
+    self.closed = True
+    self._signal()
+    self.cond.notify_all()
+    self.cond.release()
+
+  def __del__(self):
+    for fd in (self._rfd, self._wfd):
+      try:
+        os.close(fd)
+      except OSError:
+        pass
+
+
 class State:
   pass
 
 
 class TCPState(State):
   ''' TCP state. 
-    enqueueRaw is used by TCP Stream to triage packet in one direction.
+    checkState is used by TCP Stream to triage packet in one direction.
+    Future packets wait in a SegmentStore until the missing data comes in.
     STATE SEARCH: packets are then ordered into orderedQueue following a simple TCP seq state machine
     STATE ACTIVE: packets payload are added to the socket in an ordered fashion following a simple TCP seq state machine
     orderedQueue contains ordered packets waiting to be processed
@@ -54,6 +382,9 @@ class TCPState(State):
       - setActiveMode() set the state to write packets payload
     write_socket is used to put data from ordered TCP packets.
     read_socket is used by a reader ( Packetizer) to read data in active mode.
+    
+    With BACKEND_SOCKET, write_socket and read_socket are the two ends of a socketpair.
+    With BACKEND_PIPE, they are the same in-memory BytePipe.
 
   '''
   name = None
@@ -62,70 +393,106 @@ class TCPState(State):
   start_seq = None
   max_seq = 0
   expected_seq = 0
-  rawQueue = None
+  # expected_seq, unwrapped. Never wraps around 2**32.
+  offset = 0
+  segments = None
   orderedQueue = None
   write_socket = None
   read_socket = None
   ts_missing = None
-  # for variable size retransmission
-  packets = None
+  # to check retransmissions
+  history = None
   activeLock = None
-  def __init__(self,name):
+  # gap timeouts. the timer puts (self, gap) in expired, the stream thread calls gapTimeout(gap)
+  timers = None
+  expired = None
+  _gapTimer = None
+  _gap = 0
+  # onGap(state, missing) is called before skipping missing bytes. Without it, a gap is fatal.
+  onGap = None
+  def __init__(self, name, backend=BACKEND_SOCKET, timers=None, expired=None):
+    '''
+    @param timers: a timers.TimerWheel for gap timeouts. Without it, they are polled on each packet.
+    @param expired: the deque where the gap timer puts this state
+    '''
     self.name=name
-    self.rawQueue = {}
+    self.backend = backend
+    self.timers = timers
+    self.expired = expired
+    self.segments = SegmentStore()
     self.orderedQueue = Queue.Queue(QSIZE)
-    self.packets = LRUCache(QSIZE)
+    self.history = RetransmitHistory()
     self.activeLock   = multiprocessing.Lock()
-    # make socket UNIX way. non existent in Windows
-    read, write = socket.socketpair()
-    self.read_socket  = socket.socket(_sock=read) ## useless to get a python object we do not override after all?
-    self.write_socket = write
+    self._makeSockets()
     # ok
     self.setSearchMode()
     log.debug('%s: created in search mode'%(self.name))
     return 
 
+  def _makeSockets(self):
+    if self.backend == BACKEND_PIPE:
+      self.read_socket = self.write_socket = BytePipe()
+    elif self.backend == BACKEND_SOCKET:
+      # make socket UNIX way. non existent in Windows
+      read, write = socket.socketpair()
+      self.read_socket  = socket.socket(_sock=read) ## useless to get a python object we do not override after all?
+      self.write_socket = write
+    else:
+      raise ValueError('unknown backend %s'%(self.backend))
+    return
+
+  def resetSocket(self):
+    ''' the current reader gets EOF after the data already written, and a new
+    read_socket is made for the next reader. Use it in search mode. '''
+    if not self.searchMode:
+      raise BadStateError('State %s is in Active Mode. Can not reset the socket'%(self.name))
+    self.activeLock.acquire()
+    self.write_socket.close()
+    self._makeSockets()
+    self.activeLock.release()
+    return
+
   def _enqueueRaw(self, packet):
-    ''' the rawQueue gets all unexpected packets. 
+    ''' the segment store gets all unexpected packets. 
     reodering will happen before adding them to orderedQueue or socket '''
-    self.rawQueue[packet.seq]= packet
+    self.segments.add(self.offset + seqDiff(packet.seq, self.expected_seq), packet)
     return
 
   def _isMissing(self):
     return not (self.ts_missing is None)
   def _resetMissing(self):
     self.ts_missing = None
+    if self._gapTimer is not None:
+      self.timers.cancel(self._gapTimer)
+      self._gapTimer = None
   def _setMissing(self):
     self.ts_missing = time.time()
+    if self.timers is not None:
+      if self._gapTimer is not None:
+        self.timers.cancel(self._gapTimer)
+      self._gap += 1
+      self._gapTimer = self.timers.schedule(WAIT_RETRANSMIT, self.expired.append, (self, self._gap))
+
 
+  def _advance(self, nb):
+    self.offset += nb
+    self.expected_seq = self.offset & SEQ_MASK
 
   def _requeue(self):
     ''' Internal func .
-        get packets from rawQueue and put them in processing orderedQueue or in socket '''
-    queue = self.rawQueue.values()
-    queue.sort(key=lambda p: p.seq)
-    # add the first and the next that are in perfect suite.
-    toadd = [queue.pop(0),]
-    log.debug('%s: _requeue : Poped packet seq : %s'%(self.name, toadd[0].seq))
-    for i in xrange(0,len(queue)):
-      if toadd[-1].seq + len(toadd[-1].payload) == queue[0].seq :
-        toadd.append(queue.pop(0))
-      else:
-        log.debug('Stop prequeuing  toadd[-1].seq+len(toadd[-1].payload): %d , queue[0].seq: %d'%(toadd[-1].seq+len(toadd[-1].payload) , queue[0].seq ))
-        break
-    # let remaining in state.queue
-    self.rawQueue=dict( [ (p.seq, p) for p in queue])
+        get the contiguous packets at expected_seq from the segment store and put them in processing orderedQueue or in socket '''
+    toadd = self.segments.pop(self.offset)
     # add to output 
     for p in toadd:
       self.addPacket( p )
-    log.debug('Prequeued %d packets, remaining %d, queued from %d to %d '%(
-                        len(toadd), len(self.rawQueue), toadd[0].seq, (toadd[-1].seq + len(toadd[-1].payload)) 
-                        ))
-    # set expected 
-    self.max_seq = toadd[-1].seq
-    self.expected_seq = toadd[-1].seq + len(toadd[-1].payload) 
+      self.history.add(p)
+      self._advance(len(p.payload))
+    if len(toadd) > 0:
+      log.debug('Prequeued %d packets, remaining %d, queued from %d to %d '%(
+                        len(toadd), len(self.segments), toadd[0].seq, self.expected_seq))
+      self.max_seq = toadd[-1].seq
     # reset time counter
-    if len(self.rawQueue) > 0:
+    if len(self.segments) > 0:
       self._setMissing()
     else:
       self._resetMissing()
@@ -148,6 +515,14 @@ class TCPState(State):
     log.debug('%s: Adding packet to socket - %d bytes added'%(self.name, cnt))
     return True
 
+  def _addPacketToPipe(self, packet):
+    ''' active mode, BytePipe backend. The pipe has its own lock. '''
+    cnt = self.write_socket.send( packet.payload.load )
+    self.byte_count   += cnt
+    self.packet_count += 1
+    log.debug('%s: Adding packet to pipe - %d bytes added'%(self.name, cnt))
+    return True
+
   def _checkStateFalse(self, packet):
     return False
 
@@ -158,6 +533,7 @@ class TCPState(State):
     if self.start_seq is None:
       self.start_seq=seq
       self.expected_seq=seq
+      self.offset=seq
       # head done. switch to normal behaviour
       self.checkState = self._checkState
       log.debug('%s: Switching to regular checkState'%(self.name))
@@ -172,23 +548,27 @@ class TCPState(State):
     if payloadLen == 0:
       return False
     seq = packet.seq
-    log.debug('%s: Checking state of packet %d exp: %d len: %d'%(self.name, packet.seq, self.expected_seq, len(packet.payload.load)))
+    if log.isEnabledFor(logging.DEBUG):
+      log.debug('%s: Checking state of packet %d exp: %d len: %d'%(self.name, packet.seq, self.expected_seq, payloadLen))
     
+    delta = seqDiff(seq, self.expected_seq)
     # packet is expected 
-    if seq == self.expected_seq: # JIT
+    if delta == 0: # JIT
       log.debug('%s: got a good paket, adding..'%(self.name))
       self.max_seq = seq
-      self.expected_seq = seq + payloadLen
+      self._advance(payloadLen)
       self.addPacket(packet)
-      # 
-      self.packets[seq] = packet # debug the packets
-      self._resetMissing()
+      self.history.add(packet)
+      if self._isMissing():
+        self._resetMissing()
+        if len(self.segments) > 0:
+          self._setMissing()
       # check if next is already in self.queue , if expected has changed
       self.checkForExpectedPackets()
       return True
 
     # packet is future
-    elif seq > self.expected_seq:
+    elif delta > 0:
       log.debug('%s: Future packet, queuing it...'%(self.name)) 
       # seq is in advance, add it to queue
       self._enqueueRaw(packet)
@@ -204,35 +584,26 @@ class TCPState(State):
       return False
 
     # packet is a retranmission 
-    elif seq < self.expected_seq:
-      # TCP retransmission
-      log.debug('TCP retransmit - We just received %d when we already processed %d'%(seq, self.max_seq))
-      # never hitted
-      if seq+payloadLen > self.expected_seq :
-        log.warning(' ***** EXTRA DATA FOUND ON TCP RETRANSMISSION ')
-        # we need to recover the extra data to put it in the stream
-        nb   = (seq+payloadLen) - self.expected_seq
-        data = packet.payload.load[-nb:]
-        log.warning('packet seq %d has already been received'%(seq))
-        log.warning('recent  packet : %s'%(repr(packet.underlayer) ))
-        log.warning('first   packet : %s'%(repr(self.packets[seq].underlayer ) ))
-        seq2 = seq+len(self.packets[seq].payload)
-        log.warning('first+1 packet : %s'%(repr(self.packets[seq2].underlayer ) ))
-        packet.payload.load = data
-        log.warning('NEW     packet : %s'%(repr(packet.underlayer) ))
-        # updates seq
-        self.max_seq = seq
-        self.expected_seq = seq2
-        # save it
-        self.packets[seq]=packet 
-        # we can process this (new) one, it's containing only the non-used remains
-        self.addPacket(packet)        
-        return True
-      # ignore it, it's a retransmission
-      return False
-    # else, seq < expected_seq and seq >= self.max_seq. That's not possible... it's current packet.
-    # it's a dup already dedupped ? partial fragment ?
-    log.warning('received a bogus fragment seq: %d for %s'%(seq, self))
+    # TCP retransmission
+    log.debug('TCP retransmit - We just received %d when we already processed %d'%(seq, self.max_seq))
+    if delta + payloadLen > 0 :
+      # a bigger retransmission. Only the bytes after expected_seq are new.
+      nb = delta + payloadLen
+      log.debug('%s: %d new bytes on TCP retransmission of seq %d'%(self.name, nb, seq))
+      packet = _slice(packet, -delta, payloadLen, self.expected_seq)
+      self.max_seq = self.expected_seq
+      self._advance(nb)
+      self.addPacket(packet)
+      self.history.add(packet)
+      self.checkForExpectedPackets()
+      return True
+    # ignore it, it's a retransmission
+    if self.history.check(packet) is False:
+      log.warning('%s: retransmission of seq %d carries other data than the first transmission'%(self.name, seq))
+      first = self.history.get(seq)
+      if first is not None:
+        log.warning('first   packet : %s'%(repr(first.underlayer)))
+        log.warning('recent  packet : %s'%(repr(packet.underlayer)))
     return False
     
   ################ PUBLIC METHODS 
@@ -248,26 +619,58 @@ class TCPState(State):
     ''' check for some internal expectation. '''
     ret = False
     log.debug('time to check the raw queue for expected packets ')
-    if self.expected_seq in self.rawQueue : 
+    first = self.segments.first()
+    if first is not None and first <= self.offset : 
       log.debug('requeue all expected packets to ordered queue ')
       self._requeue()
       ret = True
-    # waiting for too long
-    elif self._isMissing() and  time.time() > ( self.ts_missing + WAIT_RETRANSMIT) : 
+    # waiting for too long. Polled only without a timer wheel.
+    elif self.timers is None and self._isMissing() and  time.time() > ( self.ts_missing + WAIT_RETRANSMIT) : 
+      self.gapTimeout()
+    return ret
+
+  def gapTimeout(self, gap=None):
+    ''' the missing data did not come in time. Skip it if there is an onGap
+    handler, otherwise stop processing that direction.
+    @param gap: the gap timer generation, to ignore stale timers.
+    '''
+    if not self._isMissing() or (gap is not None and gap != self._gap):
+      return
+    self._gapTimer = None
+    first = self.segments.first()
+    missing = 0
+    if first is not None:
+      missing = first - self.offset
+    if self.onGap is None:
       log.error('%s: Some data is missing. the sniffer losts some packets ? Dying. '%(self.name))      
       #raise MissingDataException()
       self.checkState = self._checkStateFalse
-    return ret
+      return
+    log.warning('%s: %d bytes are missing after seq %d, skipping them'%(self.name, missing, self.expected_seq))
+    self.onGap(self, missing)
+    self.skipGap()
+    return
+
+  def skipGap(self):
+    ''' give up on the missing data, resume at the first stored segment.
+    returns the number of bytes skipped '''
+    first = self.segments.first()
+    if first is None or first <= self.offset:
+      return 0
+    missing = first - self.offset
+    self._advance(missing)
+    self._requeue()
+    return missing
 
   def getSocket(self):
     return self.read_socket
 
-  def getFirstPacketData(self, block=False):
+  def getFirstPacketData(self, block=False, timeout=None):
     ''' pop the first packet '''
     if not self.searchMode:
       raise BadStateError('State %s is in Active Mode. Not poping allowed')
     # wait for it     if self.orderedQueue.qsize() == 0: or except Queue.Empty
-    p = self.orderedQueue.get(block=block)
+    p = self.orderedQueue.get(block=block, timeout=timeout)
     d = p.payload.load
     self.orderedQueue.task_done()
     #log.info('orderedQueue size : %d'%(self.orderedQueue.qsize()))
@@ -281,29 +684,38 @@ class TCPState(State):
     ''' go in active mode.
       all ordered packets will be written to the socket for subsequent use...
       
-      WARNING: you should have a thread running on read_socket, otherwise, 
+      WARNING: with BACKEND_SOCKET, you should have a thread running on read_socket, otherwise, 
       the socket buffer space will quickly be overflown and this will block on socket.send()
+      With BACKEND_PIPE, this never blocks.
       
     @param data:  some data can be pre-written to the socket  .
     '''
     # stop any data from behing inserted in socket witouht proper timing
     log.debug('Activating the active mode. Data will be decrypted')
-    self.activeLock.acquire()
+    if self.backend == BACKEND_PIPE:
+      lock = self.write_socket.lock()
+      addPacket = self._addPacketToPipe
+      send = lambda d: self.write_socket.send(d, block=False)
+    else:
+      lock = self.activeLock
+      addPacket = self._addPacketToSocket
+      send = self.write_socket.send
+    lock.acquire()
     self.searchMode = False
-    self.addPacket = self._addPacketToSocket
+    self.addPacket = addPacket
     if data is not None:
       log.debug('Prepended %d bytes of data before remaining packets'%(len(data) ) )
-      self.byte_count   += self.write_socket.send( data )
+      self.byte_count   += send( data )
       self.packet_count += 1
     # push data
     queue = self.orderedQueue
     self.orderedQueue = Queue.Queue(QSIZE)
     while not queue.empty():
       packet = queue.get()
-      self.byte_count   += self.write_socket.send( packet.payload.load )
+      self.byte_count   += send( packet.payload.load )
       self.packet_count += 1
     log.debug('%d bytes written for %d packets'%(self.byte_count, self.packet_count))
-    self.activeLock.release()
+    lock.release()
     # operation can now resume. the socket is active
     return 
   
@@ -322,9 +734,9 @@ class TCPState(State):
   
 class stack:
   ''' A stream is duplex. '''
-  def __init__(self):
-    self.inbound=TCPState('inbound')
-    self.outbound=TCPState('outbound')
+  def __init__(self, backend=BACKEND_SOCKET, timers=None, expired=None):
+    self.inbound=TCPState('inbound', backend, timers, expired)
+    self.outbound=TCPState('outbound', backend, timers, expired)
   def __str__(self):
     return "\n%s\n%s"%(self.inbound,self.outbound)
   
@@ -338,16 +750,20 @@ class Stream:
     
   '''
   worker=None
-  def __init__(self, inQueue, connection, protocolName):
+  def __init__(self, inQueue, connection, protocolName, backend=BACKEND_SOCKET, timers=None):
     ''' 
     @param inQueue: packet Queue from socket_scapy   ## from multiprocessing import Process, Queue
     @param connectionTuple: connection Metadata to identify inbound/outbound
+    @param backend: BACKEND_SOCKET or BACKEND_PIPE, how ordered data is given to the reader
+    @param timers: the sniffer timers.TimerWheel, for gap timeouts
     '''
     self.inQueue = inQueue # triage must happen 
     self.connection = connection
     self.protocolName = protocolName
+    # TCPStates whose gap timer expired. Handled in our thread.
+    self._expired = collections.deque()
     # contains TCP state & packets queue before reordering    
-    self.stack = stack()  # duplex context
+    self.stack = stack(backend, timers, self._expired)  # duplex context
     self.running = True
 
   def getInbound(self):
@@ -356,9 +772,6 @@ class Stream:
   def getOutbound(self):
     return self.stack.outbound
 
-  def _isInbound(self, packet):
-    raise NotImplementedError()
-
   def check(self):
     return self.running
 
@@ -366,21 +779,31 @@ class Stream:
     self.running = False
    
   def run(self):
-    ''' loops on self.inQueue and calls triage '''
+    ''' loops on self.inQueue and calls triage. The queue gives lists of
+    (packet, inbound) '''
     while self.check():
       try:
-        for p in self.inQueue.get(block=True, timeout=1):
-          self.triage(p)
+        for p, inbound in self.inQueue.get(block=True, timeout=1):
+          self.triage(p, inbound)
           self.inQueue.task_done()
       except Queue.Empty,e:
         log.debug('Empty queue')
         pass
+      self.checkExpired()
     self.finish()
     pass
 
-  def triage(self, obj):
+  def checkExpired(self):
+    ''' handle the expired gap timers '''
+    while len(self._expired) > 0:
+      state, gap = self._expired.popleft()
+      state.gapTimeout(gap)
+    return
+
+  def triage(self, obj, inbound=False):
     ''' pile packets in the right state machine and call the processing 
       @param obj: the packet
+      @param inbound: the direction of the packet, from the sniffer flow table
     '''
     # check queues only
     if obj is None:
@@ -394,16 +817,14 @@ class Stream:
     if pLen == 0: # ignore acks and stuff 
       return None
     # real triage
-    if self._isInbound(packet):
+    if inbound:
       log.debug('Packet is Inbound')
       if self.stack.inbound.checkState( packet ) and pLen > 0:
         log.debug('packet added')
-    elif self._isOutbound(packet):
+    else:
       log.debug('Packet is Outbound')
       if self.stack.outbound.checkState( packet ) and pLen > 0:
         log.debug('packet added')
-    else:
-      log.warning('This packet is nor outbound, nor inbound by my standards. Your network sniffer queuing system sucks.')
     return
 
   def finish(self):
@@ -417,18 +838,8 @@ class Stream:
 
 class TCPStream(Stream):
   ''' Simple subclass for TCP packets '''
-  def __init__(self, inQueue, connection ):
-    Stream.__init__(self, inQueue, connection, protocolName='TCP')
-
-  def _isInbound(self, packet):
-    ''' check if the connection metadata corrects '''
-    host,port = self.connection.local_address
-    return host == packet.underlayer.dst and port == packet.dport
-
-  def _isOutbound(self, packet):
-    ''' check if the connection metadata corrects '''
-    host,port = self.connection.local_address
-    return host == packet.underlayer.src and port == packet.sport
+  def __init__(self, inQueue, connection, backend=BACKEND_SOCKET, timers=None):
+    Stream.__init__(self, inQueue, connection, protocolName='TCP', backend=backend, timers=timers)
     
 
 
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Loic Jaquemet loic.jaquemet+python@gmail.com
+#
+
+__author__ = "Loic Jaquemet loic.jaquemet+python@gmail.com"
+
+'''
+A hierarchical timer wheel, for the TCP gap timeouts of all the streams of
+a sniffer. Scheduling and cancelling are O(1), the wheel thread sleeps while
+no timer is pending.
+'''
+
+import logging
+import threading
+import time
+
+log=logging.getLogger('timers')
+
+TICK = 0.1 # seconds
+SLOTS = 256
+# 3 levels of 256 slots of 0.1s is about 19 days.
+LEVELS = 3
+
+
+class Timer(object):
+  __slots__ = ('expires', 'callback', 'args', 'bucket')
+  def __init__(self, expires, callback, args):
+    self.expires = expires # in ticks
+    self.callback = callback
+    self.args = args
+    self.bucket = None
+
+  def __repr__(self):
+    return '<Timer at tick %d %s>'%(self.expires, self.callback)
+
+
+class TimerWheel:
+  ''' Timers are placed in the level whose slots span their delay, and cascade
+    down to the lower level when the upper slot comes around.
+    Callbacks run in the wheel thread, they should be quick.
+  '''
+  def __init__(self, tick=TICK, slots=SLOTS, levels=LEVELS):
+    self.tick = tick
+    self.slots = slots
+    self.levels = levels
+    self.spans = [slots**l for l in range(levels+1)]
+    self.wheels = [[set() for i in range(slots)] for l in range(levels)]
+    self.now = 0
+    self.pending = 0
+    self.start_time = time.time()
+    self.cond = threading.Condition()
+    self.thread = None
+    self.running = False
+    return
+
+  def _ticks(self):
+    return int((time.time() - self.start_time)/self.tick)
+
+  def _place(self, timer):
+    delta = timer.expires - self.now
+    for level in range(self.levels):
+      if delta < self.spans[level+1]:
+        break
+    # else, too far. the top level will place it again when its slot comes.
+    bucket = self.wheels[level][(timer.expires // self.spans[level]) % self.slots]
+    bucket.add(timer)
+    timer.bucket = bucket
+
+  def schedule(self, delay, callback, *args):
+    ''' calls callback(*args) in delay seconds. returns the Timer, for cancel() '''
+    self.cond.acquire()
+    try:
+      if self.pending == 0:
+        # the wheel was idle, catch up with the clock
+        self.now = self._ticks()
+      timer = Timer(self.now + max(1, int(round(delay/self.tick))), callback, args)
+      self._place(timer)
+      self.pending += 1
+      self.cond.notify()
+    finally:
+      self.cond.release()
+    return timer
+
+  def cancel(self, timer):
+    self.cond.acquire()
+    try:
+      if timer.bucket is not None:
+        timer.bucket.discard(timer)
+        timer.bucket = None
+        self.pending -= 1
+    finally:
+      self.cond.release()
+    return
+
+  def _advance(self, target):
+    ''' moves the wheel up to the tick target. returns the expired timers. '''
+    expired = []
+    while self.now < target and self.pending > 0:
+      self.now += 1
+      # cascade the upper levels first, timers due now land in level 0
+      for level in range(self.levels-1, 0, -1):
+        span = self.spans[level]
+        if self.now % span == 0:
+          bucket = self.wheels[level][(self.now // span) % self.slots]
+          timers = list(bucket)
+          bucket.clear()
+          for timer in timers:
+            self._place(timer)
+      bucket = self.wheels[0][self.now % self.slots]
+      for timer in bucket:
+        timer.bucket = None
+      expired.extend(bucket)
+      self.pending -= len(bucket)
+      bucket.clear()
+    if self.pending == 0:
+      self.now = target
+    return expired
+
+  def _fire(self, expired):
+    for timer in expired:
+      try:
+        timer.callback(*timer.args)
+      except Exception, e:
+        log.error('timer %s: %s'%(timer, e))
+    return
+
+  def expire(self):
+    ''' runs the expired timers in the calling thread. 
+    For an event loop driving a wheel that is not start()-ed. '''
+    self.cond.acquire()
+    try:
+      expired = self._advance(self._ticks())
+    finally:
+      self.cond.release()
+    self._fire(expired)
+    return len(expired)
+
+  def run(self):
+    while self.running:
+      self.cond.acquire()
+      try:
+        while self.pending == 0 and self.running:
+          self.cond.wait()
+        expired = self._advance(self._ticks())
+      finally:
+        self.cond.release()
+      self._fire(expired)
+      time.sleep(self.tick)
+    return
+
+  def start(self):
+    ''' starts the wheel thread, once '''
+    self.cond.acquire()
+    try:
+      if self.thread is None:
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='timers')
+        self.thread.daemon = True
+        self.thread.start()
+    finally:
+      self.cond.release()
+    return
+
+  def stop(self):
+    self.cond.acquire()
+    self.running = False
+    self.cond.notify()
+    self.cond.release()
+
+  def __len__(self):
+    return self.pending
+
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2011 Loic Jaquemet loic.jaquemet+python@gmail.com
+#
+
+__author__ = "Loic Jaquemet loic.jaquemet+python@gmail.com"
+
+'''
+Linux AF_PACKET capture on a TPACKET_V3 memory mapped ring.
+
+The kernel fills whole blocks of frames and hands them over in one wakeup.
+Frames are read in place in the mmap, with struct.unpack_from, and given back
+to the kernel one block at a time.
+The socket is SOCK_DGRAM, so frames start at the network header whatever the
+link type of the interface.
+'''
+
+import ctypes
+import ctypes.util
+import fcntl
+import logging
+import mmap
+import select
+import socket
+import struct
+
+log=logging.getLogger('tpacket')
+
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+ETH_P_ALL = 0x0003
+SO_ATTACH_FILTER = 26
+SIOCGIFINDEX = 0x8933
+
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+# sockaddr_ll.sll_pkttype
+PACKET_HOST = 0
+PACKET_OUTGOING = 4
+
+# default ring: 64 blocks of 1MB, retired after 100ms if not full
+BLOCK_SIZE = 1 << 20
+BLOCK_COUNT = 64
+BLOCK_TIMEOUT = 100
+FRAME_SIZE = 1 << 11
+
+DLT_RAW = 12 # what BPF sees on a SOCK_DGRAM packet socket
+
+# struct tpacket_req3
+_REQ3 = struct.Struct('7I')
+# struct tpacket_block_desc: version, offset_to_priv, then tpacket_hdr_v1
+# block_status, num_pkts, offset_to_first_pkt
+_BLOCK_STATUS = 8
+_BLOCK_DESC = struct.Struct('8x3I')
+# struct tpacket3_hdr: tp_next_offset, 2x ts, tp_snaplen, tp_len, tp_status, tp_mac, tp_net
+_HDR3 = struct.Struct('I8xIIIHH')
+# struct sockaddr_ll, after the TPACKET_ALIGN-ed tpacket3_hdr: protocol, ifindex, pkttype
+_SLL_OFFSET = 48
+_SLL = struct.Struct('=2xHi2xB') # sll_protocol is in network order
+# struct tpacket_stats_v3
+_STATS = struct.Struct('III')
+
+
+class sock_filter(ctypes.Structure):
+  _fields_ = [('code', ctypes.c_ushort), ('jt', ctypes.c_ubyte), ('jf', ctypes.c_ubyte), ('k', ctypes.c_uint)]
+
+class bpf_program(ctypes.Structure):
+  _fields_ = [('bf_len', ctypes.c_uint), ('bf_insns', ctypes.POINTER(sock_filter))]
+
+class sock_fprog(ctypes.Structure):
+  _fields_ = [('len', ctypes.c_ushort), ('filter', ctypes.POINTER(sock_filter))]
+
+
+_libpcap = None
+def _loadLibpcap():
+  global _libpcap
+  if _libpcap is None:
+    name = ctypes.util.find_library('pcap')
+    _libpcap = False
+    if name is not None:
+      try:
+        _libpcap = ctypes.CDLL(name)
+      except OSError, e:
+        log.warning('could not load %s: %s'%(name, e))
+  return _libpcap
+
+def compileFilter(rules, snaplen=65535, linktype=DLT_RAW):
+  ''' returns the BPF instructions of that pcap filter, as a list of
+  (code, jt, jf, k), or None if libpcap is not available.
+  @raise ValueError: if libpcap does not understand the filter
+  '''
+  lib = _loadLibpcap()
+  if not lib:
+    return None
+  prog = bpf_program()
+  if lib.pcap_compile_nopcap(snaplen, linktype, ctypes.byref(prog), rules, 1, 0xffffffff) != 0:
+    raise ValueError('bad filter: %s'%(rules))
+  try:
+    insns = [(i.code, i.jt, i.jf, i.k) for i in prog.bf_insns[:prog.bf_len]]
+  finally:
+    lib.pcap_freecode(ctypes.byref(prog))
+  return insns
+
+def attachFilter(sock, insns):
+  ''' attach BPF instructions to a socket. The kernel swaps filters atomically. '''
+  array = (sock_filter*len(insns))(*[sock_filter(*i) for i in insns])
+  prog = sock_fprog(len(insns), ctypes.cast(array, ctypes.POINTER(sock_filter)))
+  # the kernel copies the program during setsockopt
+  sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, ctypes.string_at(ctypes.addressof(prog), ctypes.sizeof(prog)))
+  return
+
+
+def ifIndex(name):
+  ''' returns the index of that network interface '''
+  s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  try:
+    ifreq = fcntl.ioctl(s.fileno(), SIOCGIFINDEX, struct.pack('16si', name, 0))
+  finally:
+    s.close()
+  return struct.unpack('16si', ifreq)[1]
+
+
+class PacketRing:
+  ''' A TPACKET_V3 receive ring on an AF_PACKET socket.
+
+    @param iface: the interface name, or None/'any' for all interfaces.
+    @param blockSize: bytes per block, a multiple of the page size.
+    @param blockCount: number of blocks. The ring is blockSize*blockCount bytes.
+    @param blockTimeout: ms before the kernel hands over a block that is not full.
+  '''
+  def __init__(self, iface=None, blockSize=BLOCK_SIZE, blockCount=BLOCK_COUNT, blockTimeout=BLOCK_TIMEOUT, frameSize=FRAME_SIZE):
+    self.iface = iface
+    self.blockSize = blockSize
+    self.blockCount = blockCount
+    self.blockTimeout = blockTimeout
+    self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_DGRAM, socket.htons(ETH_P_ALL))
+    try:
+      self.sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+      req = _REQ3.pack(blockSize, blockCount, frameSize, (blockSize*blockCount)//frameSize, blockTimeout, 0, 0)
+      self.sock.setsockopt(SOL_PACKET, PACKET_RX_RING, req)
+      self.mm = mmap.mmap(self.sock.fileno(), blockSize*blockCount, mmap.MAP_SHARED, mmap.PROT_READ|mmap.PROT_WRITE)
+      if iface is not None and iface != 'any':
+        self.sock.bind((iface, ETH_P_ALL))
+    except:
+      self.sock.close()
+      raise
+    self.poller = select.poll()
+    self.poller.register(self.sock.fileno(), select.POLLIN|select.POLLERR)
+    self.block = 0
+    self.filtered = False
+    return
+
+  def setFilter(self, rules):
+    ''' returns False if the filter could not be compiled (no libpcap) '''
+    insns = compileFilter(rules)
+    if insns is None:
+      if not self.filtered:
+        log.warning('libpcap is not available, can not compile BPF filters. Everything is captured.')
+      return False
+    attachFilter(self.sock, insns)
+    self.filtered = True
+    return True
+
+  def _ready(self, block):
+    return _BLOCK_DESC.unpack_from(self.mm, block*self.blockSize)[0] & TP_STATUS_USER
+
+  def _release(self, block):
+    struct.pack_into('I', self.mm, block*self.blockSize + _BLOCK_STATUS, TP_STATUS_KERNEL)
+
+  def frames(self, timeout=None):
+    ''' yields (offset, snaplen, wirelen, protocol, ifindex, pkttype) for the
+    frames of all the blocks handed over by the kernel. The frame bytes are
+    self.mm[offset:offset+snaplen], valid until the next iteration.
+    Each block is given back to the kernel once all its frames are read.
+
+    @param timeout: seconds to wait for a first block. None waits forever.
+    '''
+    if not self._ready(self.block):
+      ms = -1 if timeout is None else int(timeout*1000)
+      if not self.poller.poll(ms):
+        return
+    mm = self.mm
+    while self._ready(self.block):
+      base = self.block*self.blockSize
+      try:
+        status, count, pos = _BLOCK_DESC.unpack_from(mm, base)
+        pos += base
+        for i in xrange(count):
+          nextOffset, snaplen, wirelen, status, mac, net = _HDR3.unpack_from(mm, pos)
+          protocol, ifindex, pkttype = _SLL.unpack_from(mm, pos + _SLL_OFFSET)
+          yield pos + net, snaplen, wirelen, socket.ntohs(protocol), ifindex, pkttype
+          pos += nextOffset
+      finally:
+        self._release(self.block)
+        self.block = (self.block + 1) % self.blockCount
+    return
+
+  def stats(self):
+    ''' returns (packets, drops) since the last call '''
+    packets, drops, freezes = _STATS.unpack(self.sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, _STATS.size))
+    return packets, drops
+
+  def fileno(self):
+    return self.sock.fileno()
+
+  def close(self):
+    self.mm.close()
+    self.sock.close()
+
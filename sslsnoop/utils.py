@@ -7,6 +7,7 @@
 __author__ = "Loic Jaquemet loic.jaquemet+python@gmail.com"
 
 import logging
+import os
 import pickle
 import sys
 import socket
@@ -60,10 +61,23 @@ class Connection:
 
 
 
-def launchScapy():
-  from threading import Thread
+def makeSniffer(connection=None):
+  ''' returns a sniffer for that connection. 
+  Loopback connections get a LoopbackSniffer on linux, as root.
+  Otherwise libpcap without scapy if pypcap is there.
+  '''
   sshfilter = "tcp "
-  soscapy = network.Sniffer(sshfilter)
+  if (connection is not None and network.isLoopback(connection) 
+        and sys.platform.startswith('linux') and os.geteuid() == 0):
+    return network.LoopbackSniffer(sshfilter)
+  if network.got_pypcap:
+    return network.PcapSniffer(sshfilter)
+  return network.Sniffer(sshfilter)
+
+def launchScapy(connection=None):
+  ''' starts a sniffer thread. '''
+  from threading import Thread
+  soscapy = makeSniffer(connection)
   sniffer = Thread(target=soscapy.run)
   soscapy.thread = sniffer
   sniffer.start()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests the frame decoder of sslsnoop.decode."""
+
+import socket
+import struct
+import StringIO
+import unittest
+
+from sslsnoop import decode
+
+__author__ = "Loic Jaquemet"
+__copyright__ = "Copyright (C) 2012 Loic Jaquemet"
+__email__ = "loic.jaquemet+python@gmail.com"
+__license__ = "GPL"
+__maintainer__ = "Loic Jaquemet"
+__status__ = "Production"
+
+
+def tcp(payload, seq=1000, flags=0x18, options=''):
+  doff = (20 + len(options)) // 4
+  return struct.pack('!HHIIBBHHH', 22, 4242, seq, 0, doff << 4, flags, 1024, 0, 0) + options + payload
+
+def ipv4(segment, options='', proto=decode.IPPROTO_TCP, frag=0):
+  ihl = (20 + len(options)) // 4
+  return struct.pack('!BBHHHBBH4s4s', 0x40 | ihl, 0, 20 + len(options) + len(segment), 1, frag, 64, proto, 0,
+                     socket.inet_aton('10.0.0.1'), socket.inet_aton('10.0.0.2')) + options + segment
+
+def ipv6(segment, extensions=()):
+  ''' extensions is a list of (next header type, length in 8 bytes units - 1) '''
+  types = [t for t, n in extensions] + [decode.IPPROTO_TCP]
+  body = ''
+  for i, (t, n) in enumerate(extensions):
+    body += struct.pack('!BB', types[i+1], n) + '\0'*(6 + 8*n)
+  body += segment
+  return struct.pack('!IHBB16s16s', 0x60000000, len(body), types[0], 64,
+                     socket.inet_pton(socket.AF_INET6, 'fe80::1'), socket.inet_pton(socket.AF_INET6, 'fe80::2')) + body
+
+def ethernet(ethertype, packet, vlans=()):
+  head = '\x02'*6 + '\x04'*6
+  for tpid, vid in vlans:
+    head += struct.pack('!HH', tpid, vid)
+  return head + struct.pack('!H', ethertype) + packet
+
+def sll(ethertype, packet):
+  return struct.pack('!HHH8sH', 0, 1, 6, '\x02'*6, ethertype) + packet
+
+def sll2(ethertype, packet):
+  return struct.pack('!HHIHBB8s', ethertype, 0, 2, 1, 0, 6, '\x02'*6) + packet
+
+
+class TestParseFrame(unittest.TestCase):
+
+  def _check(self, segment, src='10.0.0.1', dst='10.0.0.2', load='hello'):
+    self.assertNotEqual(None, segment)
+    self.assertEquals((src, 22, dst, 4242, 1000, 0x18, load),
+                      (segment.src, segment.sport, segment.dst, segment.dport, segment.seq, segment.flags, segment.load))
+
+  def test_ethernet(self):
+    self._check(decode.parseFrame(ethernet(decode.ETH_P_IP, ipv4(tcp('hello'))), decode.DLT_EN10MB))
+    # ethernet padding after a short IP packet
+    frame = ethernet(decode.ETH_P_IP, ipv4(tcp('hello'))) + '\0'*6
+    self._check(decode.parseFrame(frame, decode.DLT_EN10MB))
+
+  def test_vlan(self):
+    frame = ethernet(decode.ETH_P_IP, ipv4(tcp('hello')), vlans=[(decode.ETH_P_8021Q, 42)])
+    self._check(decode.parseFrame(frame, decode.DLT_EN10MB))
+    # QinQ
+    frame = ethernet(decode.ETH_P_IPV6, ipv6(tcp('hello')), vlans=[(decode.ETH_P_8021AD, 1), (decode.ETH_P_8021Q, 42)])
+    self._check(decode.parseFrame(frame, decode.DLT_EN10MB), 'fe80::1', 'fe80::2')
+
+  def test_sll(self):
+    self._check(decode.parseFrame(sll(decode.ETH_P_IP, ipv4(tcp('hello'))), decode.DLT_LINUX_SLL))
+    self._check(decode.parseFrame(sll2(decode.ETH_P_IP, ipv4(tcp('hello'))), decode.DLT_LINUX_SLL2))
+    self._check(decode.parseFrame(sll2(decode.ETH_P_IPV6, ipv6(tcp('hello'))), decode.DLT_LINUX_SLL2), 'fe80::1', 'fe80::2')
+
+  def test_raw(self):
+    self._check(decode.parseFrame(ipv4(tcp('hello')), decode.DLT_RAW))
+    self._check(decode.parseFrame(ipv6(tcp('hello')), decode.LINKTYPE_RAW), 'fe80::1', 'fe80::2')
+    self._check(decode.parseFrame(struct.pack('=I', 2) + ipv4(tcp('hello')), decode.DLT_NULL))
+    self._check(decode.parseFrame(struct.pack('!I', 24) + ipv6(tcp('hello')), decode.DLT_LOOP), 'fe80::1', 'fe80::2')
+
+  def test_options(self):
+    ''' IPv4 and TCP options are skipped '''
+    packet = ipv4(tcp('hello', options='\x01'*12), options='\x01'*8)
+    self._check(decode.parseFrame(packet, decode.DLT_RAW))
+
+  def test_ipv6_extensions(self):
+    # hop-by-hop, routing, destination options
+    packet = ipv6(tcp('hello'), extensions=[(0, 0), (43, 1), (60, 0)])
+    self._check(decode.parseFrame(packet, decode.DLT_RAW), 'fe80::1', 'fe80::2')
+    # no IP reassembly
+    packet = ipv6(tcp('hello'), extensions=[(decode._IPV6_FRAGMENT, 0)])
+    self.assertEquals(None, decode.parseFrame(packet, decode.DLT_RAW))
+
+  def test_not_tcp(self):
+    self.assertEquals(None, decode.parseFrame(ipv4(tcp('hello'), proto=17), decode.DLT_RAW))
+    self.assertEquals(None, decode.parseFrame(ipv4(tcp('hello'), frag=0x2000), decode.DLT_RAW))
+    self.assertEquals(None, decode.parseFrame(ethernet(0x0806, '\0'*28), decode.DLT_EN10MB))
+
+  def test_truncated(self):
+    ''' a frame cut in the headers is not a segment, a frame cut in the
+    payload is the captured part of it '''
+    cases = [(decode.DLT_EN10MB, ethernet(decode.ETH_P_IP, ipv4(tcp('hello'))), 14+20+20),
+             (decode.DLT_EN10MB, ethernet(decode.ETH_P_IP, ipv4(tcp('hello')), vlans=[(decode.ETH_P_8021Q, 1)]), 18+20+20),
+             (decode.DLT_LINUX_SLL, sll(decode.ETH_P_IPV6, ipv6(tcp('hello'))), 16+40+20),
+             (decode.DLT_LINUX_SLL2, sll2(decode.ETH_P_IP, ipv4(tcp('hello'))), 20+20+20),
+             (decode.DLT_RAW, ipv6(tcp('hello'), extensions=[(0, 0), (60, 1)]), 40+8+16+20)]
+    for linktype, frame, headers in cases:
+      for cut in range(len(frame)):
+        segment = decode.parseFrame(frame[:cut], linktype)
+        if cut < headers:
+          self.assertEquals(None, segment, (linktype, cut))
+        else:
+          self.assertEquals('hello'[:cut-headers], segment.load)
+
+  def test_buffer(self):
+    ''' frames in a memoryview are decoded in place '''
+    frame = memoryview(ethernet(decode.ETH_P_IP, ipv4(tcp('hello'))))
+    self._check(decode.parseFrame(frame, decode.DLT_EN10MB))
+
+  def test_link_type(self):
+    self.assertEquals(decode.DLT_EN10MB, decode.checkLinkType(decode.DLT_EN10MB))
+    self.assertRaises(ValueError, decode.checkLinkType, 127) # radiotap
+    self.assertEquals(None, decode.parseFrame(ipv4(tcp('hello')), 127))
+
+
+class TestPcapFile(unittest.TestCase):
+
+  def _pcap(self, linktype, frames, endian='<'):
+    data = struct.pack(endian+'IHHiIII', decode.PCAP_MAGIC, 2, 4, 0, 0, 65535, linktype)
+    for i, frame in enumerate(frames):
+      data += struct.pack(endian+'IIII', 1000+i, 500000, len(frame), len(frame)) + frame
+    return StringIO.StringIO(data)
+
+  def test_read(self):
+    frames = [ipv4(tcp('a')), ipv4(tcp('b'))]
+    for endian in '<>':
+      records = list(decode.readPcapFile(self._pcap(decode.DLT_RAW, frames, endian)))
+      self.assertEquals([(1000.5, decode.DLT_RAW, frames[0]), (1001.5, decode.DLT_RAW, frames[1])], records)
+
+  def test_errors(self):
+    self.assertRaises(ValueError, list, decode.readPcapFile(StringIO.StringIO('\x0a\x0d\x0d\x0a' + '\0'*20)))
+    self.assertRaises(ValueError, list, decode.readPcapFile(self._pcap(127, [ipv4(tcp('a'))])))
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=0)
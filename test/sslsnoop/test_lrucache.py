@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests the LRU cache."""
+
+import unittest
+
+from sslsnoop.lrucache import LRUCache, CacheKeyError
+
+__author__ = "Loic Jaquemet"
+__copyright__ = "Copyright (C) 2012 Loic Jaquemet"
+__email__ = "loic.jaquemet+python@gmail.com"
+__license__ = "GPL"
+__maintainer__ = "Loic Jaquemet"
+__status__ = "Production"
+
+
+class TestLRUCache(unittest.TestCase):
+
+  def test_evicts_least_recently_used(self):
+    cache = LRUCache(3)
+    for i in range(3):
+      cache[i] = str(i)
+    cache[0] # 1 is now the LRU
+    cache[3] = '3'
+    self.assertEquals([2, 0, 3], list(cache))
+    self.assertFalse(1 in cache)
+    self.assertRaises(CacheKeyError, cache.__getitem__, 1)
+
+  def test_resize(self):
+    cache = LRUCache(10)
+    for i in range(10):
+      cache[i] = i
+    cache.size = 4
+    self.assertEquals([6, 7, 8, 9], list(cache))
+    del cache[7]
+    self.assertEquals(3, len(cache))
+    self.assertRaises(CacheKeyError, cache.__delitem__, 7)
+
+  def test_maxbytes(self):
+    evicted = []
+    cache = LRUCache(100, maxbytes=10, onEvict=lambda k, v: evicted.append(k))
+    cache['a'] = 'xxxx'
+    cache['b'] = 'xxxx'
+    self.assertEquals(8, cache.nbytes())
+    cache['c'] = 'xxxx'
+    self.assertEquals(['a'], evicted)
+    cache['b'] = 'x' # replacing updates the byte count
+    self.assertEquals(5, cache.nbytes())
+    # a single record bigger than maxbytes stays
+    cache['d'] = 'x'*20
+    self.assertEquals(['d'], list(cache))
+    self.assertEquals(['a', 'c', 'b'], evicted)
+
+  def test_mtime(self):
+    cache = LRUCache(10)
+    cache['a'] = 1
+    cache['b'] = 2
+    self.assertTrue(cache.mtime('a') < cache.mtime('b'))
+    before = cache.mtime('a')
+    cache['a'] # reading does not modify
+    self.assertEquals(before, cache.mtime('a'))
+    cache['a'] = 3
+    self.assertTrue(cache.mtime('a') > cache.mtime('b'))
+    self.assertRaises(CacheKeyError, cache.mtime, 'c')
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=0)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests the flow table of the sniffers."""
+
+import Queue
+import unittest
+
+from sslsnoop import stream
+from sslsnoop.stream import Segment
+
+try:
+  from sslsnoop import network
+except ImportError:
+  network = None
+
+__author__ = "Loic Jaquemet"
+__copyright__ = "Copyright (C) 2012 Loic Jaquemet"
+__email__ = "loic.jaquemet+python@gmail.com"
+__license__ = "GPL"
+__maintainer__ = "Loic Jaquemet"
+__status__ = "Production"
+
+
+class Connection:
+  def __init__(self, local, remote):
+    self.local_address = local
+    self.remote_address = remote
+
+
+def inbound(connection, seq=100, load='in'):
+  (lhost, lport), (rhost, rport) = connection.local_address, connection.remote_address
+  return Segment(rhost, rport, lhost, lport, seq, 0x18, load)
+
+def outbound(connection, seq=100, load='out'):
+  (lhost, lport), (rhost, rport) = connection.local_address, connection.remote_address
+  return Segment(lhost, lport, rhost, rport, seq, 0x18, load)
+
+
+@unittest.skipIf(network is None, 'needs scapy')
+class TestFlowTable(unittest.TestCase):
+
+  def setUp(self):
+    # the local address sorts before, and after, the remote one
+    self.connections = [Connection(('10.0.0.1', 4242), ('10.0.0.2', 22)),
+                        Connection(('10.0.0.9', 4242), ('10.0.0.2', 22))]
+
+  def test_directions(self):
+    ''' both directions of a connection map to one flow '''
+    table = network.FlowTable()
+    for c in self.connections:
+      table.add(c, None, None)
+    self.assertEquals(2, len(table))
+    for c in self.connections:
+      flows = []
+      for p, isInbound in [(inbound(c), True), (outbound(c), False)]:
+        flow, first = table.lookup(p.src, p.sport, p.dst, p.dport)
+        self.assertTrue(flow.connection is c)
+        self.assertEquals(isInbound, flow.isInbound(first))
+        flows.append(flow)
+      self.assertTrue(flows[0] is flows[1])
+      key, hits, drops = [s for s in table.stats() if s[0] == flows[0].key][0]
+      # local->remote, remote->local
+      self.assertEquals(((1, 1), (0, 0)), (hits, drops))
+    self.assertRaises(ValueError, table.add, self.connections[0], None, None)
+
+  def test_unknown(self):
+    table = network.FlowTable()
+    c = self.connections[0]
+    table.add(c, None, None)
+    other = Connection(('10.0.0.1', 4243), ('10.0.0.2', 22))
+    self.assertEquals((None, None), table.lookup(*network.getConnectionTuple(inbound(other))))
+    self.assertEquals(1, table.misses)
+    self.assertFalse(network.getConnectionTuple(inbound(other)) in table)
+    self.assertTrue(network.getConnectionTuple(outbound(c)) in table)
+
+  def test_remove(self):
+    ''' a dropped stream is not matched anymore, in both directions '''
+    sniffer = network.Sniffer()
+    c = self.connections[1]
+    sniffer.flows.add(c, None, Queue.Queue())
+    sniffer.dropStream(outbound(c))
+    self.assertEquals(0, len(sniffer.flows))
+    sniffer.enqueue(inbound(c))
+    self.assertEquals(1, sniffer.flows.misses)
+    self.assertEquals(None, sniffer.dropStream(inbound(c)))
+
+  def test_enqueue(self):
+    ''' the direction bit goes with the segment to the stream '''
+    sniffer = network.Sniffer()
+    c = self.connections[1]
+    q = Queue.Queue()
+    sniffer.flows.add(c, None, q)
+    p, o = inbound(c), outbound(c)
+    sniffer.enqueue(p)
+    sniffer.enqueue(o)
+    self.assertEquals([(p, True)], q.get_nowait())
+    self.assertEquals([(o, False)], q.get_nowait())
+
+  def test_triage(self):
+    ''' inline, the stream gets the direction from the flow table '''
+    sniffer = network.Sniffer()
+    sniffer.inline = True
+    c = self.connections[0]
+    st = stream.TCPStream(None, c, stream.BACKEND_PIPE, sniffer.timers)
+    sniffer.flows.add(c, st, None)
+    sniffer.enqueue(inbound(c, load='a'*10))
+    sniffer.enqueue(outbound(c, load='b'*20))
+    sniffer.enqueue(inbound(c, seq=110, load='c'*10))
+    self.assertEquals(['a'*10, 'c'*10], [st.getInbound().getFirstPacketData()[0] for i in range(2)])
+    self.assertEquals('b'*20, st.getOutbound().getFirstPacketData()[0])
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=0)
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests the Supervisor of the stream handlers."""
+
+import errno
+import os
+import random
+import select
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+  from sslsnoop import output
+  from sslsnoop.paramiko_packet import Packetizer
+except ImportError:
+  output = None
+
+__author__ = "Loic Jaquemet"
+__copyright__ = "Copyright (C) 2012 Loic Jaquemet"
+__email__ = "loic.jaquemet+python@gmail.com"
+__license__ = "GPL"
+__maintainer__ = "Loic Jaquemet"
+__status__ = "Production"
+
+
+def waitFor(cond, timeout=5.0):
+  ''' polls cond() until it is True or timeout. returns cond() '''
+  end = time.time() + timeout
+  while not cond() and time.time() < end:
+    time.sleep(0.01)
+  return cond()
+
+
+class Reader:
+  ''' a handler that reads its socket until it would block '''
+  def __init__(self, sock):
+    self.sock = sock
+    self.sock.setblocking(False)
+    self.data = ''
+    self.calls = 0
+  def __call__(self):
+    self.calls += 1
+    while True:
+      try:
+        d = self.sock.recv(4096)
+      except socket.error, e:
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+          return
+        raise
+      if d == '':
+        raise EOFError()
+      self.data += d
+
+
+class ByteReader(Reader):
+  ''' reads one byte per call, and tells that more may be there '''
+  def __init__(self, sock):
+    Reader.__init__(self, sock)
+    self.running = 0
+    self.overlaps = 0
+  def __call__(self):
+    self.calls += 1
+    self.running += 1
+    if self.running > 1:
+      self.overlaps += 1
+    try:
+      time.sleep(0.001)
+      try:
+        d = self.sock.recv(1)
+      except socket.error, e:
+        # poll() may report data that a previous run took
+        if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+          return
+        raise
+      if d == '':
+        raise EOFError()
+      self.data += d
+    finally:
+      self.running -= 1
+
+
+class Context:
+  ''' what SSHStreamToFile needs from a cipher context '''
+  class State:
+    def __init__(self, sock):
+      self.sock = sock
+    def getSocket(self):
+      return self.sock
+  def __init__(self, sock):
+    self.engine = None
+    self.state = Context.State(sock)
+
+
+def packet(data, channel=0):
+  ''' a clear text channel data packet '''
+  payload = chr(94) + struct.pack('>II', channel, len(data)) + data
+  padding = 8 - ((len(payload) + 5) % 8)
+  if padding < 4:
+    padding += 8
+  body = chr(padding) + payload + '\0'*padding
+  return struct.pack('>I', len(body)) + body
+
+
+@unittest.skipIf(output is None, 'needs paramiko')
+class TestSupervisor(unittest.TestCase):
+  useEpoll = hasattr(select, 'epoll')
+
+  def setUp(self):
+    self.supervisor = output.Supervisor(workers=1, useEpoll=self.useEpoll)
+    self.pairs = []
+
+  def tearDown(self):
+    if self.supervisor.isAlive():
+      self.supervisor.pleaseStop()
+      self.supervisor.join(5)
+    for a, b in self.pairs:
+      a.close()
+      b.close()
+
+  def _pair(self):
+    a, b = socket.socketpair()
+    self.pairs.append((a, b))
+    return a, b
+
+  def test_read(self):
+    a, b = self._pair()
+    reader = Reader(b)
+    self.supervisor.add(b, reader, name='reader')
+    self.supervisor.start()
+    a.sendall('hello')
+    self.assertTrue(waitFor(lambda: reader.data == 'hello'))
+    a.sendall(' world')
+    self.assertTrue(waitFor(lambda: reader.data == 'hello world'))
+    self.assertTrue(self.supervisor.stats()[2]['reader']['calls'] >= 2)
+
+  def test_pending_data(self):
+    ''' data sent before add() is reported by the first poll '''
+    a, b = self._pair()
+    a.sendall('early')
+    reader = Reader(b)
+    self.supervisor.add(b, reader)
+    self.supervisor.start()
+    self.assertTrue(waitFor(lambda: reader.data == 'early'))
+
+  def test_add_twice(self):
+    a, b = self._pair()
+    reader = Reader(b)
+    self.supervisor.add(b, reader)
+    self.assertRaises(ValueError, self.supervisor.add, b, Reader(b))
+    # the first handler is still the one that runs
+    self.supervisor.start()
+    a.sendall('data')
+    self.assertTrue(waitFor(lambda: reader.data == 'data'))
+    self.supervisor.sub(b)
+    other = Reader(b)
+    self.supervisor.add(b, other)
+    a.sendall('more')
+    self.assertTrue(waitFor(lambda: other.data == 'more'))
+    self.assertEquals('data', reader.data)
+
+  def test_budget(self):
+    ''' a handler that is still ready after its budget goes back in the
+    queue, behind the others '''
+    a, b = self._pair()
+    c, d = self._pair()
+    slow, fast = ByteReader(b), Reader(d)
+    self.supervisor.add(b, slow, budget=2, name='slow')
+    self.supervisor.add(d, fast, name='fast')
+    self.supervisor.start()
+    a.sendall('x'*50)
+    c.sendall('hello')
+    self.assertTrue(waitFor(lambda: fast.data == 'hello'))
+    self.assertTrue(len(slow.data) < 50)
+    self.assertTrue(waitFor(lambda: slow.data == 'x'*50))
+    stats = self.supervisor.stats()[2]['slow']
+    self.assertTrue(stats['calls'] >= 50)
+    self.assertTrue(stats['calls'] <= 2*stats['runs'])
+
+  def test_rearm(self):
+    ''' data that comes while the handler runs is read, by one worker at
+    a time '''
+    self.supervisor = output.Supervisor(workers=3, useEpoll=self.useEpoll)
+    a, b = self._pair()
+    reader = ByteReader(b)
+    self.supervisor.add(b, reader, budget=1)
+    self.supervisor.start()
+    for i in range(20):
+      a.sendall('y'*5)
+      time.sleep(0.002)
+    self.assertTrue(waitFor(lambda: reader.data == 'y'*100))
+    self.assertEquals(0, reader.overlaps)
+    h = self.supervisor.handlers[b.fileno()]
+    self.assertTrue(waitFor(lambda: not h.busy))
+    self.assertFalse(h.dirty)
+    # not busy, the next event runs it
+    a.sendall('z')
+    self.assertTrue(waitFor(lambda: reader.data.endswith('z')))
+
+  def test_eof(self):
+    ''' the socket of a handler that raised EOFError is closed and forgotten '''
+    a, b = self._pair()
+    reader = Reader(b)
+    fd = b.fileno()
+    self.supervisor.add(b, reader, name='reader')
+    self.supervisor.start()
+    a.sendall('bye')
+    a.close()
+    self.assertTrue(waitFor(lambda: fd not in self.supervisor.handlers))
+    self.assertEquals('bye', reader.data)
+    self.assertRaises(socket.error, b.recv, 1)
+    self.assertEquals({}, self.supervisor.stats()[2])
+
+  def test_partial_packet(self):
+    ''' a socket with half a packet does not hold the only worker '''
+    folder = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, folder)
+    files = output.ChannelFiles()
+    writers, feeds = [], []
+    for i in range(2):
+      a, b = self._pair()
+      packetizer = Packetizer(b)
+      packetizer.set_inbound_cipher(None, 8, None, 0, None)
+      w = output.SSHStreamToFile(packetizer, Context(b), 'w%d'%(i), folder=folder, files=files, block=False)
+      self.supervisor.add(b, w.process, w.pending, name='w%d'%(i))
+      writers.append(w)
+      feeds.append(a)
+    self.supervisor.start()
+    stalled = packet('stalled')
+    feeds[0].sendall(stalled[:-3])
+    time.sleep(0.1)
+    feeds[1].sendall(packet('hello')*3)
+    name = lambda w: list(w.outs)[0]
+    self.assertTrue(waitFor(lambda: len(writers[1].outs) == 1 and writers[1].files.buffers.get(name(writers[1])) is not None
+                                   and writers[1].files.buffers[name(writers[1])][1] == 15))
+    self.assertEquals(set(), writers[0].outs)
+    feeds[0].sendall(stalled[-3:])
+    self.assertTrue(waitFor(lambda: len(writers[0].outs) == 1))
+    files.closeAll()
+    self.assertEquals('hello'*3, open(name(writers[1])).read())
+    self.assertEquals('stalled', open(name(writers[0])).read())
+
+
+@unittest.skipIf(output is None, 'needs paramiko')
+class TestSupervisorPoll(TestSupervisor):
+  ''' the level-triggered poll() fallback '''
+  useEpoll = False
+
+
+@unittest.skipIf(output is None, 'needs paramiko')
+class TestChannelFiles(unittest.TestCase):
+
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.folder)
+
+  def _name(self, i):
+    return os.path.join(self.folder, 'channel.%d'%(i))
+
+  def _read(self, name):
+    return open(name).read()
+
+  def test_evict(self):
+    ''' more files than descriptors, evicted files are reopened in append
+    mode, all the data is there after closeAll() '''
+    files = output.ChannelFiles(bufferSize=100, delay=1000, maxOpen=3)
+    names = [self._name(i) for i in range(10)]
+    # an old output is truncated on the first open only
+    open(names[0], 'w').write('old data')
+    expected = dict((name, []) for name in names)
+    rand = random.Random(42)
+    for i in range(2000):
+      name = rand.choice(names)
+      data = '%s:%d;'%(os.path.basename(name), i)
+      files.write(name, data)
+      expected[name].append(data)
+      self.assertTrue(len(files.fds) <= 3)
+    self.assertTrue(files.writes > len(names))
+    files.closeAll()
+    self.assertEquals(0, len(files.fds))
+    self.assertEquals({}, files.buffers)
+    for name in names:
+      self.assertEquals(''.join(expected[name]), self._read(name))
+
+  def test_size(self):
+    ''' a buffer is written when it holds bufferSize bytes '''
+    files = output.ChannelFiles(bufferSize=10, delay=1000, maxOpen=3)
+    name = self._name(0)
+    files.write(name, 'a'*5)
+    self.assertFalse(os.path.exists(name))
+    files.write(name, 'b'*4)
+    self.assertFalse(os.path.exists(name))
+    files.write(name, 'c'*1)
+    self.assertEquals('a'*5 + 'b'*4 + 'c', self._read(name))
+    self.assertEquals(1, files.writes)
+    files.write(name, 'd'*20)
+    self.assertEquals('a'*5 + 'b'*4 + 'c' + 'd'*20, self._read(name))
+    self.assertEquals(2, files.writes)
+    files.closeAll()
+
+  def test_delay(self):
+    ''' the flusher writes the buffers of idle files '''
+    files = output.ChannelFiles(bufferSize=1000, delay=0.05, maxOpen=3)
+    names = [self._name(i) for i in range(2)]
+    files.write(names[0], 'idle')
+    self.assertTrue(waitFor(lambda: os.path.exists(names[0]) and self._read(names[0]) == 'idle'))
+    files.write(names[1], 'other')
+    self.assertTrue(waitFor(lambda: os.path.exists(names[1]) and self._read(names[1]) == 'other'))
+    self.assertEquals({}, files.buffers)
+    files.closeAll()
+    # the daemon flusher must not wake up during the interpreter shutdown
+    files.delay = 1000
+
+  def test_close(self):
+    ''' close() flushes first, a later write appends '''
+    files = output.ChannelFiles(bufferSize=1000, delay=1000, maxOpen=3)
+    name = self._name(0)
+    files.write(name, 'first')
+    files.close(name)
+    self.assertEquals('first', self._read(name))
+    self.assertFalse(name in files.fds)
+    files.write(name, ' second')
+    files.closeAll()
+    self.assertEquals('first second', self._read(name))
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=0)
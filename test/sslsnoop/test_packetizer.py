@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests the batched reads of the Packetizer."""
+
+import collections
+import hashlib
+import os
+import random
+import struct
+import unittest
+
+try:
+  from sslsnoop.paramiko_packet import Packetizer
+  from paramiko.ssh_exception import SSHException
+except ImportError:
+  Packetizer = None
+
+__author__ = "Loic Jaquemet"
+__copyright__ = "Copyright (C) 2012 Loic Jaquemet"
+__email__ = "loic.jaquemet+python@gmail.com"
+__license__ = "GPL"
+__maintainer__ = "Loic Jaquemet"
+__status__ = "Production"
+
+BLOCK_SIZE = 16
+MAC_LEN = 20
+MSG_CHANNEL_DATA = 94
+
+
+class XorEngine:
+  ''' a stream cipher, data xor md5(key, block number). The Packetizer only
+  needs decrypt(), and it must be called on the stream in order. '''
+  def __init__(self, key='key'):
+    self.key = key
+    self.pos = 0
+
+  def decrypt(self, data):
+    if len(data) == 0:
+      return ''
+    skip = self.pos % 16
+    first, end = self.pos // 16, (self.pos + len(data) + 15) // 16
+    keystream = ''.join(hashlib.md5('%s%d'%(self.key, i)).digest() for i in xrange(first, end))
+    keystream = keystream[skip:skip+len(data)]
+    self.pos += len(data)
+    x = int(data.encode('hex'), 16) ^ int(keystream.encode('hex'), 16)
+    return ('%0*x'%(2*len(data), x)).decode('hex')
+
+  encrypt = decrypt
+
+
+class ChunkSocket:
+  ''' gives data one chunk per recv, then EOF '''
+  def __init__(self, data, sizes):
+    ''' @param sizes: a callable returning the size of the next chunk '''
+    self.chunks = collections.deque()
+    i = 0
+    while i < len(data):
+      n = sizes()
+      self.chunks.append(data[i:i+n])
+      i += n
+    self.reads = 0
+
+  def recv_into(self, buf, nbytes=0, flags=0):
+    self.reads += 1
+    if len(self.chunks) == 0:
+      return 0
+    chunk = self.chunks.popleft()
+    n = min(len(chunk), nbytes or len(buf))
+    buf[:n] = chunk[:n]
+    if n < len(chunk):
+      self.chunks.appendleft(chunk[n:])
+    return n
+
+  def recv(self, n, flags=0):
+    buf = bytearray(n)
+    return str(buf[:self.recv_into(buf, n, flags)])
+
+
+def packet(engine, data, size=None):
+  ''' an encrypted channel data packet. size overrides the packet length '''
+  payload = chr(MSG_CHANNEL_DATA) + struct.pack('>II', 0, len(data)) + data
+  padding = BLOCK_SIZE - ((len(payload) + 5) % BLOCK_SIZE)
+  if padding < 4:
+    padding += BLOCK_SIZE
+  body = chr(padding) + payload + os.urandom(padding)
+  if size is None:
+    size = len(body)
+  return engine.encrypt(struct.pack('>I', size) + body) + os.urandom(MAC_LEN)
+
+def makeStream(payloads, key='key'):
+  engine = XorEngine(key)
+  return ''.join(packet(engine, data) for data in payloads)
+
+def packetizer(sock, key='key'):
+  p = Packetizer(sock)
+  p.set_inbound_cipher(XorEngine(key), BLOCK_SIZE, None, MAC_LEN, None)
+  return p
+
+def channelData(messages):
+  ret = []
+  for cmd, m in messages:
+    m.get_int()
+    ret.append(m.get_string())
+  return ret
+
+
+@unittest.skipIf(Packetizer is None, 'needs paramiko')
+class TestReadMessages(unittest.TestCase):
+
+  def setUp(self):
+    self.rand = random.Random(42)
+    self.payloads = [os.urandom(self.rand.choice([0, 1, 10, 100, self.rand.randint(0, 3000)])) for i in range(300)]
+    self.stream = makeStream(self.payloads)
+
+  def _readOne(self, sock):
+    p = packetizer(sock)
+    messages = []
+    try:
+      while True:
+        messages.append(p.read_message())
+    except EOFError:
+      pass
+    return messages
+
+  def _readBatches(self, sock, n):
+    p = packetizer(sock)
+    messages = []
+    try:
+      while True:
+        batch = p.read_messages(n)
+        self.assertTrue(1 <= len(batch) <= n)
+        messages.extend(batch)
+    except EOFError:
+      pass
+    return messages
+
+  def test_batch(self):
+    ''' read_messages(n) gives the messages of repeated read_message() '''
+    sizes = lambda: self.rand.randint(1, 5000)
+    one = self._readOne(ChunkSocket(self.stream, sizes))
+    for n in (1, 7, 64):
+      batches = self._readBatches(ChunkSocket(self.stream, sizes), n)
+      self.assertEquals([(cmd, str(m)) for cmd, m in one], [(cmd, str(m)) for cmd, m in batches])
+      self.assertEquals(range(len(self.payloads)), [m.seqno for cmd, m in batches])
+    self.assertEquals(self.payloads, channelData(one))
+
+  def test_split(self):
+    ''' packets split across many reads '''
+    messages = self._readBatches(ChunkSocket(self.stream, lambda: self.rand.randint(1, 17)), 64)
+    self.assertEquals(self.payloads, channelData(messages))
+
+  def test_whole(self):
+    ''' all the packets in one read, the batches are full '''
+    p = packetizer(ChunkSocket(self.stream, lambda: len(self.stream)))
+    messages = p.read_messages(64)
+    self.assertEquals(64, len(messages))
+    self.assertEquals(self.payloads[:64], channelData(messages))
+
+  def test_pending_error(self):
+    ''' the messages before a bad packet are returned, the error is raised
+    on the next call '''
+    engine = XorEngine()
+    data = ''.join(packet(engine, d) for d in ('one', 'two', 'three'))
+    data += packet(engine, 'bad', size=0x7fffffff)
+    p = packetizer(ChunkSocket(data, lambda: len(data)))
+    self.assertEquals(['one', 'two', 'three'], channelData(p.read_messages()))
+    self.assertRaises(SSHException, p.read_messages)
+    # a bad first packet raises at once
+    data = packet(XorEngine(), 'bad', size=0x7fffffff)
+    p = packetizer(ChunkSocket(data, lambda: len(data)))
+    self.assertRaises(SSHException, p.read_messages)
+
+
+@unittest.skipIf(Packetizer is None, 'needs paramiko')
+class TestReceiveBuffer(unittest.TestCase):
+
+  def setUp(self):
+    self.rand = random.Random(42)
+
+  def _size(self, p):
+    return len(p._Packetizer__rbuf)
+
+  def test_small_chunks(self):
+    ''' many small reads, the buffer is compacted, not grown '''
+    data = os.urandom(300*1024)
+    p = Packetizer(ChunkSocket(data, lambda: self.rand.randint(1, 3000)))
+    out = []
+    while sum(map(len, out)) < len(data):
+      out.append(p.read_all(min(self.rand.randint(1, 5000), len(data) - sum(map(len, out)))))
+    self.assertEquals(data, ''.join(out))
+    self.assertEquals(Packetizer.RECV_BUFFER_SIZE, self._size(p))
+    self.assertRaises(EOFError, p.read_all, 1)
+
+  def test_large_packet(self):
+    ''' packets larger than a batch read, and than the buffer '''
+    payloads = ['a'*10, os.urandom(Packetizer.BATCH_READ_SIZE + 10), 'b'*10,
+                os.urandom(Packetizer.RECV_BUFFER_SIZE + 1000), 'c'*10]
+    stream = makeStream(payloads)
+    for sizes in (lambda: len(stream), lambda: 1000, lambda: self.rand.randint(1, 70000)):
+      p = packetizer(ChunkSocket(stream, sizes))
+      messages = []
+      while len(messages) < len(payloads):
+        messages.extend(p.read_messages(64))
+      self.assertEquals(payloads, channelData(messages))
+      self.assertTrue(self._size(p) > Packetizer.RECV_BUFFER_SIZE)
+      self.assertRaises(EOFError, p.read_messages)
+
+  def test_readline(self):
+    ''' lines and data share the buffer '''
+    blocks = []
+    for i in range(200):
+      blocks.append((True, 'line %d\r\n'%(i), 'line %d'%(i)))
+      n = self.rand.choice([10, 3000, 40000])
+      if i == 100:
+        # the buffer grows, the next lines are read from the new one
+        n = Packetizer.RECV_BUFFER_SIZE * 2
+      data = os.urandom(n)
+      blocks.append((False, data, data))
+    stream = ''.join(raw for line, raw, out in blocks)
+    p = Packetizer(ChunkSocket(stream, lambda: self.rand.randint(1, 20000)))
+    for line, raw, out in blocks:
+      if line:
+        self.assertEquals(out, p.readline(1))
+      else:
+        self.assertEquals(out, p.read_all(len(raw)))
+    self.assertTrue(self._size(p) > Packetizer.RECV_BUFFER_SIZE)
+
+  def test_readline_first(self):
+    ''' the version line and the first packets in one read '''
+    payloads = ['one', 'two']
+    stream = 'SSH-2.0-OpenSSH_5.9\r\n' + makeStream(payloads)
+    p = packetizer(ChunkSocket(stream, lambda: len(stream)))
+    self.assertEquals('SSH-2.0-OpenSSH_5.9', p.readline(1))
+    self.assertEquals(payloads, channelData(p.read_messages()))
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=0)
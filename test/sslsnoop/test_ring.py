@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests the shared memory rings between the sniffer and the workers."""
+
+import multiprocessing
+import Queue
+import unittest
+
+from sslsnoop import ring
+from sslsnoop import stream
+from sslsnoop.ring import SharedRing, SegmentQueue
+
+__author__ = "Loic Jaquemet"
+__copyright__ = "Copyright (C) 2012 Loic Jaquemet"
+__email__ = "loic.jaquemet+python@gmail.com"
+__license__ = "GPL"
+__maintainer__ = "Loic Jaquemet"
+__status__ = "Production"
+
+
+class Connection:
+  local_address = ('10.0.0.1', 4242)
+  remote_address = ('10.0.0.2', 22)
+
+
+def _produce(r, records):
+  for record in records:
+    r.put(record)
+
+def _consume(r, count, results):
+  got = []
+  while len(got) < count:
+    got.extend(r.get(timeout=10))
+  results.put(got)
+
+
+class TestSharedRing(unittest.TestCase):
+
+  def test_wraparound(self):
+    r = SharedRing(64)
+    records = ['%02d'%(i)*(i%7+1) for i in range(50)]
+    got = []
+    for record in records:
+      r.put(record)
+      got.extend(r.get())
+    self.assertEquals(records, got)
+    self.assertTrue(r.tail.value > r.size)
+    self.assertEquals(0, r.pending())
+
+  def test_full(self):
+    r = SharedRing(64)
+    r.put('a'*40)
+    # 4 bytes of length, and the record
+    self.assertEquals(44, r.pending())
+    self.assertRaises(Queue.Full, r.put, 'b'*20, block=False)
+    self.assertRaises(Queue.Full, r.put, 'b'*20, timeout=0.01)
+    self.assertRaises(ValueError, r.put, 'c'*61)
+    r.put('b'*16, block=False)
+    self.assertEquals(['a'*40, 'b'*16], r.get())
+    self.assertRaises(Queue.Empty, r.get, block=False)
+    r.put('b'*20, block=False)
+    self.assertEquals(['b'*20], r.get())
+
+  def test_fork(self):
+    ''' the producer and the consumer in two processes, over a small ring '''
+    r = SharedRing(1024)
+    records = [chr(65+i%26)*(i%300) for i in range(2000)]
+    results = multiprocessing.Queue()
+    consumer = multiprocessing.Process(target=_consume, args=(r, len(records), results))
+    consumer.start()
+    producer = multiprocessing.Process(target=_produce, args=(r, records))
+    producer.start()
+    producer.join(30)
+    got = results.get(timeout=30)
+    consumer.join(30)
+    self.assertEquals(records, got)
+
+
+class TestSegmentQueue(unittest.TestCase):
+
+  def _segment(self, inbound, seq, load):
+    local, remote = Connection.local_address, Connection.remote_address
+    if inbound:
+      return stream.Segment(remote[0], remote[1], local[0], local[1], seq, 0x18, load)
+    return stream.Segment(local[0], local[1], remote[0], remote[1], seq, 0x10, load)
+
+  def _check(self, sent, got):
+    ''' got is a list of (segment, inbound) '''
+    self.assertEquals(len(sent), len(got))
+    local = Connection.local_address
+    for a, (b, inbound) in zip(sent, got):
+      self.assertEquals((a.dst, a.dport) == local, inbound)
+      self.assertEquals((a.src, a.sport, a.dst, a.dport, a.seq, a.flags, a.load),
+                        (b.src, b.sport, b.dst, b.dport, b.seq, b.flags, b.load))
+
+  def _put(self, q, segment, timeout=None):
+    inbound = (segment.dst, segment.dport) == Connection.local_address
+    if timeout is None:
+      q.put_nowait((segment, inbound))
+    else:
+      q.put((segment, inbound), timeout=timeout)
+
+  def test_header(self):
+    q = SegmentQueue(Connection(), 4096)
+    sent = [self._segment(True, 0xffffffff, 'in'), self._segment(False, 0, 'out'),
+            self._segment(True, 1234567, 'x'*1000)]
+    for s in sent:
+      self._put(q, s)
+    self.assertEquals(3*ring._SEGMENT.size + 1005 + 3*ring._LEN.size, q.qsize())
+    self._check(sent, q.get())
+    self.assertTrue(q.empty())
+
+  def test_ns_flag(self):
+    ''' the 9th TCP flag crosses the ring '''
+    q = SegmentQueue(Connection(), 4096)
+    local, remote = Connection.local_address, Connection.remote_address
+    sent = [stream.Segment(remote[0], remote[1], local[0], local[1], 100, 0x118, 'ns')]
+    self._put(q, sent[0])
+    self._check(sent, q.get())
+
+  def test_empty_payload(self):
+    ''' acks do not cross the ring '''
+    q = SegmentQueue(Connection(), 4096)
+    self._put(q, self._segment(True, 10, ''))
+    self.assertTrue(q.empty())
+    self.assertRaises(Queue.Empty, q.get, block=False)
+
+  def test_fork(self):
+    q = SegmentQueue(Connection(), 2048)
+    sent = [self._segment(i%2 == 0, (0xfffff000 + 100*i) & stream.SEQ_MASK, chr(i%256)*(i%200)) for i in range(500)]
+    results = multiprocessing.Queue()
+    consumer = multiprocessing.Process(target=_consume, args=(q, len([s for s in sent if len(s.load)]), results))
+    consumer.start()
+    for s in sent:
+      self._put(q, s, timeout=10)
+    got = results.get(timeout=30)
+    consumer.join(30)
+    self._check([s for s in sent if len(s.load)], got)
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=0)
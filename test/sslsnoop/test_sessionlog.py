@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests the session log records, footer and reader."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from sslsnoop import sessionlog
+from sslsnoop.sessionlog import SessionLog, SessionLogWriter, SessionLogError
+
+__author__ = "Loic Jaquemet"
+__copyright__ = "Copyright (C) 2012 Loic Jaquemet"
+__email__ = "loic.jaquemet+python@gmail.com"
+__license__ = "GPL"
+__maintainer__ = "Loic Jaquemet"
+__status__ = "Production"
+
+
+class TestSessionLog(unittest.TestCase):
+
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+    self.fname = os.path.join(self.folder, 'sessions.log')
+
+  def tearDown(self):
+    shutil.rmtree(self.folder)
+
+  def _write(self, count, close=True):
+    writer = SessionLogWriter(self.fname)
+    a = writer.connection('10.0.0.1:22-10.0.0.2:4242')
+    b = writer.connection('10.0.0.1:22-10.0.0.3:4343')
+    for i in range(count):
+      writer.write((a, b)[i%2], i%2, i, 94, i%3, 'data %d'%i, timestamp=1000.0+i)
+    if close:
+      writer.close()
+    else:
+      writer.file.flush()
+    return writer
+
+  def test_records(self):
+    self._write(10)
+    log = SessionLog(self.fname)
+    self.assertEquals(10, len(log))
+    r = log[3]
+    self.assertEquals(1003.0, r.timestamp)
+    self.assertEquals('10.0.0.1:22-10.0.0.3:4343', r.connection)
+    self.assertEquals(sessionlog.OUTBOUND, r.direction)
+    self.assertEquals((3, 94, 0, 'data 3'), (r.seqno, r.msgtype, r.channel, r.payload))
+    self.assertEquals('data 9', log[-1].payload)
+    self.assertEquals(['data %d'%i for i in range(10)], [r.payload for r in log])
+    self.assertRaises(IndexError, log.__getitem__, 10)
+    log.close()
+
+  def test_select(self):
+    self._write(100)
+    log = SessionLog(self.fname)
+    self.assertEquals(0, log.find(0))
+    self.assertEquals(42, log.find(1042.0))
+    self.assertEquals(100, log.find(2000.0))
+    seqnos = [r.seqno for r in log.select(connection='10.0.0.1:22-10.0.0.2:4242', channel=1, start=1010.0, stop=1040.0)]
+    self.assertEquals([10, 16, 22, 28, 34], seqnos)
+    self.assertEquals(50, len(list(log.select(direction=sessionlog.INBOUND))))
+    log.close()
+
+  def test_no_footer(self):
+    ''' a log without footer is scanned, a partial record is ignored '''
+    writer = self._write(5, close=False)
+    writer.file.write(sessionlog.RECORD.pack(100, sessionlog.KIND_MESSAGE, 0, 0, 0, 0, 0, 0)+'cut')
+    writer.file.flush()
+    log = SessionLog(self.fname)
+    self.assertEquals(5, len(log))
+    self.assertEquals('data 4', log[4].payload)
+    self.assertEquals('10.0.0.1:22-10.0.0.2:4242', log[0].connection)
+    log.close()
+
+  def test_append(self):
+    self._write(5)
+    writer = SessionLogWriter(self.fname)
+    self.assertEquals(1, writer.connection('10.0.0.1:22-10.0.0.3:4343'))
+    self.assertEquals(2, writer.connection('10.0.0.4:22-10.0.0.5:4545'))
+    self.assertEquals(5, writer.write(2, 0, 0, 2, sessionlog.NO_CHANNEL, 'more'))
+    writer.close()
+    log = SessionLog(self.fname)
+    self.assertEquals(6, len(log))
+    self.assertEquals('data 4', log[4].payload)
+    self.assertEquals(('10.0.0.4:22-10.0.0.5:4545', 'more'), (log[5].connection, log[5].payload))
+    log.close()
+
+  def test_not_a_log(self):
+    open(self.fname, 'wb').write('not a session log')
+    self.assertRaises(SessionLogError, SessionLog, self.fname)
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=0)
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests the TCP reassembly of sslsnoop.stream."""
+
+import collections
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from sslsnoop import stream
+from sslsnoop import timers
+from sslsnoop.stream import Segment, SegmentStore, TCPState
+
+try:
+  from sslsnoop import output
+except ImportError:
+  output = None
+
+__author__ = "Loic Jaquemet"
+__copyright__ = "Copyright (C) 2012 Loic Jaquemet"
+__email__ = "loic.jaquemet+python@gmail.com"
+__license__ = "GPL"
+__maintainer__ = "Loic Jaquemet"
+__status__ = "Production"
+
+
+def segment(seq, load):
+  return Segment('10.0.0.1', 22, '10.0.0.2', 4242, seq & stream.SEQ_MASK, 0x18, load)
+
+def readAll(sock):
+  ''' reads sock until EOF '''
+  data = ''
+  while True:
+    d = sock.recv(4096)
+    if d == '':
+      return data
+    data += d
+
+
+class TestSegmentStore(unittest.TestCase):
+
+  def _runs(self, store):
+    return [(start, store.ends[start]) for start in store.starts]
+
+  def _data(self, segments):
+    return ''.join(p.load for p in segments)
+
+  def test_merge_runs(self):
+    store = SegmentStore()
+    self.assertEquals(None, store.first())
+    self.assertEquals(10, store.add(100, segment(100, 'b'*10)))
+    self.assertEquals(10, store.add(140, segment(140, 'd'*10)))
+    self.assertEquals(10, store.add(120, segment(120, 'c'*10)))
+    self.assertEquals([(100, 110), (120, 130), (140, 150)], self._runs(store))
+    # fill the two holes around 120, the three runs make one
+    self.assertEquals(10, store.add(110, segment(110, 'x'*10)))
+    self.assertEquals(10, store.add(130, segment(130, 'y'*10)))
+    self.assertEquals([(100, 150)], self._runs(store))
+    self.assertEquals(50, store.size)
+    self.assertEquals(100, store.first())
+    self.assertEquals('b'*10+'x'*10+'c'*10+'y'*10+'d'*10, self._data(store.pop(100)))
+    self.assertEquals(0, len(store))
+    self.assertEquals(0, store.size)
+
+  def test_duplicates(self):
+    store = SegmentStore()
+    store.add(100, segment(100, 'a'*20))
+    self.assertEquals(0, store.add(100, segment(100, 'a'*20)))
+    self.assertEquals(0, store.add(105, segment(105, 'a'*10)))
+    self.assertEquals(1, len(store))
+    self.assertEquals(20, store.size)
+
+  def test_overlaps(self):
+    ''' only the bytes that are not stored yet are kept '''
+    store = SegmentStore()
+    store.add(100, segment(100, 'a'*10))
+    store.add(120, segment(120, 'c'*10))
+    # covers both runs, and the holes before, between and after them
+    self.assertEquals(20, store.add(95, segment(95, 'X'*40)))
+    self.assertEquals([(95, 135)], self._runs(store))
+    self.assertEquals('X'*5+'a'*10+'X'*10+'c'*10+'X'*5, self._data(store.pop(95)))
+
+  def test_pop(self):
+    store = SegmentStore()
+    store.add(100, segment(100, '0123456789'))
+    store.add(110, segment(110, 'abcdefghij'))
+    store.add(200, segment(200, 'z'*10))
+    self.assertEquals([], store.pop(90))
+    self.assertEquals(3, len(store))
+    # bytes before 105 are dropped, the first segment is sliced
+    segments = store.pop(105)
+    self.assertEquals('56789abcdefghij', self._data(segments))
+    self.assertEquals(105, segments[0].seq)
+    self.assertEquals([(200, 210)], self._runs(store))
+    # runs that end before seq are dropped
+    self.assertEquals([], store.pop(250))
+    self.assertEquals(None, store.first())
+
+
+class TestReassembly(unittest.TestCase):
+  ''' shuffled, duplicated and overlapping segments come out in order '''
+
+  def _reassemble(self, start, data, seed):
+    rand = random.Random(seed)
+    segments = []
+    pos = 0
+    while pos < len(data):
+      n = rand.randint(1, 300)
+      segments.append(segment(start + pos, data[pos:pos+n]))
+      # retransmissions, some of them bigger than the first transmission
+      if rand.random() < 0.3:
+        end = pos + n + rand.randint(0, 200)
+        begin = max(0, pos - rand.randint(0, 100))
+        segments.append(segment(start + begin, data[begin:end]))
+      pos += n
+    first = segments.pop(0)
+    rand.shuffle(segments)
+    state = TCPState('test', backend=stream.BACKEND_PIPE)
+    state.setActiveMode()
+    state.checkState(first)
+    for p in segments:
+      state.checkState(p)
+    state.write_socket.close()
+    self.assertEquals(0, len(state.segments))
+    return readAll(state.getSocket())
+
+  def test_shuffled(self):
+    data = os.urandom(20000)
+    for seed in range(10):
+      self.assertEquals(data, self._reassemble(1000, data, seed))
+
+  def test_wraparound(self):
+    ''' the sequence numbers wrap around 2**32 in the middle of the stream '''
+    data = os.urandom(20000)
+    for seed in range(10):
+      self.assertEquals(data, self._reassemble(2**32 - 10000, data, seed))
+
+
+class TestSeqDiff(unittest.TestCase):
+
+  def test_seqDiff(self):
+    self.assertEquals(0, stream.seqDiff(5, 5))
+    self.assertEquals(10, stream.seqDiff(110, 100))
+    self.assertEquals(-10, stream.seqDiff(100, 110))
+    # across the wrap
+    self.assertEquals(20, stream.seqDiff(10, 2**32 - 10))
+    self.assertEquals(-20, stream.seqDiff(2**32 - 10, 10))
+    # half the space each way
+    self.assertEquals(-2**31, stream.seqDiff(2**31, 0))
+    self.assertEquals(2**31 - 1, stream.seqDiff(2**31 - 1, 0))
+
+  def test_retransmit_across_wrap(self):
+    ''' a segment before the wrap is old data once expected_seq wrapped '''
+    state = TCPState('test', backend=stream.BACKEND_PIPE)
+    state.setActiveMode()
+    self.assertTrue(state.checkState(segment(2**32 - 100, 'a'*100)))
+    self.assertEquals(0, state.expected_seq)
+    self.assertTrue(state.checkState(segment(0, 'b'*100)))
+    self.assertFalse(state.checkState(segment(2**32 - 100, 'a'*100)))
+    # partly new data, sliced at expected_seq
+    self.assertTrue(state.checkState(segment(50, 'b'*50 + 'c'*50)))
+    self.assertEquals(150, state.expected_seq)
+    self.assertEquals(2**32 + 150, state.offset)
+    state.write_socket.close()
+    self.assertEquals('a'*100 + 'b'*100 + 'c'*50, readAll(state.getSocket()))
+
+
+class TestRetransmitHistory(unittest.TestCase):
+
+  def test_check(self):
+    history = stream.RetransmitHistory(size=8)
+    history.add(segment(100, 'hello'))
+    self.assertTrue(history.check(segment(100, 'hello')))
+    # same seq and size, other data
+    self.assertFalse(history.check(segment(100, 'HELLO')))
+    # another size, or an unknown seq
+    self.assertEquals(None, history.check(segment(100, 'hello world')))
+    self.assertEquals(None, history.check(segment(200, 'hello')))
+
+  def test_empty_slots(self):
+    ''' seq 0 does not match the zeroed slots of a new history '''
+    history = stream.RetransmitHistory(size=8)
+    self.assertEquals(None, history.check(segment(0, '')))
+    history.add(segment(50, 'a'))
+    history.add(segment(0, 'abc'))
+    self.assertTrue(history.check(segment(0, 'abc')))
+
+  def test_ring(self):
+    ''' once pos wrapped past size, the oldest segments are forgotten '''
+    history = stream.RetransmitHistory(size=4)
+    for i in range(6):
+      history.add(segment(2**32 - 300 + 100*i, chr(65+i)*100))
+    self.assertEquals(6, history.pos)
+    for i in range(2):
+      self.assertEquals(None, history.check(segment(2**32 - 300 + 100*i, chr(65+i)*100)))
+    for i in range(2, 6):
+      self.assertTrue(history.check(segment(2**32 - 300 + 100*i, chr(65+i)*100)))
+      self.assertFalse(history.check(segment(2**32 - 300 + 100*i, 'z'*100)))
+
+  def test_keepPackets(self):
+    history = stream.RetransmitHistory(size=2, keepPackets=True)
+    p = segment(100, 'a')
+    history.add(p)
+    self.assertTrue(history.get(100) is p)
+    self.assertEquals(None, history.get(101))
+    self.assertEquals(None, stream.RetransmitHistory(size=2, keepPackets=False).get(100))
+
+
+class TestGap(unittest.TestCase):
+  ''' a hole that is never filled is skipped on the gap timer, the data after
+  it goes to a new socket. '''
+
+  def _state(self, backend):
+    self.expired = collections.deque()
+    self.wheel = timers.TimerWheel()
+    state = TCPState('test', backend=backend, timers=self.wheel, expired=self.expired)
+    self.gaps = []
+    def onGap(state, missing):
+      self.gaps.append(missing)
+      state.setSearchMode()
+      state.resetSocket()
+    state.onGap = onGap
+    return state
+
+  def _fireGapTimer(self, state):
+    ''' runs the gap timer now, like the sniffer does when it expires '''
+    timer = state._gapTimer
+    self.assertNotEqual(None, timer)
+    self.wheel.cancel(timer)
+    timer.callback(*timer.args)
+    while len(self.expired) > 0:
+      s, gap = self.expired.popleft()
+      s.gapTimeout(gap)
+
+  def _testGap(self, backend):
+    state = self._state(backend)
+    state.setActiveMode()
+    old = state.getSocket()
+    self.assertTrue(state.checkState(segment(1000, 'a'*100)))
+    # 1100-1200 is lost
+    self.assertFalse(state.checkState(segment(1200, 'c'*100)))
+    self.assertFalse(state.checkState(segment(1300, 'd'*50)))
+    self._fireGapTimer(state)
+    self.assertEquals([100], self.gaps)
+    # the old reader gets the data before the gap, then EOF
+    self.assertEquals('a'*100, readAll(old))
+    new = state.getSocket()
+    self.assertNotEqual(old, new)
+    # the aligned data goes first, then the queued segments
+    data, qsize = state.getFirstPacketData()
+    self.assertEquals(('c'*100, 1), (data, qsize))
+    state.setActiveMode(data)
+    self.assertTrue(state.checkState(segment(1350, 'e'*10)))
+    state.write_socket.close()
+    self.assertEquals('c'*100 + 'd'*50 + 'e'*10, readAll(new))
+
+  def test_gap_socket(self):
+    self._testGap(stream.BACKEND_SOCKET)
+
+  def test_gap_pipe(self):
+    self._testGap(stream.BACKEND_PIPE)
+
+  def test_gap_filled(self):
+    ''' a hole filled in time cancels the gap timer '''
+    state = self._state(stream.BACKEND_PIPE)
+    state.setActiveMode()
+    state.checkState(segment(1000, 'a'*100))
+    state.checkState(segment(1200, 'c'*100))
+    timer = state._gapTimer
+    self.assertTrue(state.checkState(segment(1100, 'b'*100)))
+    self.assertEquals(None, state._gapTimer)
+    # a stale timer does nothing
+    timer.callback(*timer.args)
+    s, gap = self.expired.popleft()
+    s.gapTimeout(gap)
+    self.assertEquals([], self.gaps)
+    self.assertEquals(1300, state.expected_seq)
+
+  def test_gap_without_handler(self):
+    ''' without onGap, the direction stops '''
+    state = self._state(stream.BACKEND_PIPE)
+    state.onGap = None
+    state.checkState(segment(1000, 'a'*100))
+    state.checkState(segment(1200, 'c'*100))
+    self._fireGapTimer(state)
+    self.assertFalse(state.checkState(segment(1100, 'b'*100)))
+    self.assertEquals(1100, state.expected_seq)
+
+
+class FakeState:
+  def __init__(self, sock):
+    self.sock = sock
+  def getSocket(self):
+    return self.sock
+
+class FakeContext:
+  def __init__(self, sock):
+    self.engine = None
+    self.state = FakeState(sock)
+
+class FakePacketizer:
+  BATCH_MAX_MESSAGES = 64
+
+
+@unittest.skipIf(output is None, 'needs paramiko')
+class TestFollow(unittest.TestCase):
+  ''' the writer after a gap continues the output files '''
+
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.folder)
+
+  def test_follow(self):
+    from paramiko.common import MSG_CHANNEL_DATA
+    from paramiko.message import Message
+    files = output.ChannelFiles()
+    writer = output.SSHStreamToFile(FakePacketizer(), FakeContext(None), 'ssh', folder=self.folder, files=files)
+    writer.finished.set()
+    packetizer = FakePacketizer()
+    follower = writer.follow(packetizer, FakeContext(None))
+    self.assertTrue(follower.packetizer is packetizer)
+    self.assertTrue(follower.files is files)
+    self.assertFalse(follower.finished.isSet())
+    for w, data in [(writer, 'before'), (follower, 'after')]:
+      m = Message()
+      m.add_int(0)
+      m.add_string(data)
+      m.rewind()
+      w._processMessage(MSG_CHANNEL_DATA, m)
+    follower.close()
+    names = os.listdir(self.folder)
+    self.assertEquals(1, len(names))
+    self.assertEquals('beforeafter', open(os.path.join(self.folder, names[0])).read())
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=0)
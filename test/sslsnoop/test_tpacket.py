@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests the TPACKET_V3 capture ring on the loopback interface."""
+
+import os
+import socket
+import sys
+import time
+import unittest
+
+from sslsnoop import decode
+from sslsnoop import tpacket
+
+__author__ = "Loic Jaquemet"
+__copyright__ = "Copyright (C) 2012 Loic Jaquemet"
+__email__ = "loic.jaquemet+python@gmail.com"
+__license__ = "GPL"
+__maintainer__ = "Loic Jaquemet"
+__status__ = "Production"
+
+
+@unittest.skipUnless(sys.platform.startswith('linux') and os.geteuid() == 0, 'needs root on linux')
+class TestPacketRing(unittest.TestCase):
+
+  def setUp(self):
+    self.ring = tpacket.PacketRing('lo', blockSize=1<<16, blockCount=16, blockTimeout=10)
+    self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.server.bind(('127.0.0.1', 0))
+    self.server.listen(1)
+    self.client = socket.create_connection(self.server.getsockname())
+    self.peer, addr = self.server.accept()
+
+  def tearDown(self):
+    self.client.close()
+    self.peer.close()
+    self.server.close()
+    self.ring.close()
+
+  def _capture(self, sport, size, timeout=2):
+    ''' returns the payload sent from sport, by seq '''
+    data = {}
+    end = time.time() + timeout
+    while sum(len(d) for d in data.values()) < size and time.time() < end:
+      for offset, snaplen, wirelen, protocol, ifindex, pkttype in self.ring.frames(0.1):
+        if pkttype != tpacket.PACKET_OUTGOING: # loopback shows both sides
+          continue
+        segment = decode.parseNetwork(self.ring.mm, offset, protocol, offset + snaplen)
+        if segment is not None and segment.sport == sport and len(segment.load) > 0:
+          data[segment.seq] = segment.load
+    return ''.join(data[seq] for seq in sorted(data))
+
+  def test_capture(self):
+    payload = ''.join(chr(i%251) for i in range(100000))
+    self.client.sendall(payload)
+    received = ''
+    while len(received) < len(payload):
+      received += self.peer.recv(65536)
+    captured = self._capture(self.client.getsockname()[1], len(payload))
+    self.assertEquals(payload, captured)
+    packets, drops = self.ring.stats()
+    self.assertEquals(0, drops)
+
+
+if __name__ == '__main__':
+  unittest.main(verbosity=0)
+